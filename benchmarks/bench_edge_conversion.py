@@ -0,0 +1,49 @@
+"""Compares the per-reply CL-JSON conversion time of causality paths with
+and without the per-edge conversion cache.
+
+Usage: python benchmarks/bench_edge_conversion.py [GENE] [REL] [REPEATS]
+"""
+import sys
+import timeit
+from bioagents import Bioagent
+from indra.statements import stmts_from_json
+from kqml import KQMLList
+from causality_agent.causality_agent import CausalityAgent
+from causality_agent.causality_module import _resource_dir, make_indra_json
+from causality_agent.conversion_cache import EdgeConversionCache
+
+
+def convert_uncached(result):
+    indra_json = [make_indra_json(r) for r in result]
+    indra_stmts = stmts_from_json(indra_json)
+    return Bioagent.make_cljson(indra_stmts)
+
+
+def convert_edge(causality):
+    indra_stmt = stmts_from_json([make_indra_json(causality)])[0]
+    return Bioagent.make_cljson(indra_stmt)
+
+
+def main(gene='MAPK1', rel='phosphorylates', repeats=20):
+    ca = CausalityAgent(_resource_dir)
+    result = ca.find_causality_targets({'id': gene, 'rel': rel})
+    if not result:
+        print('No relations found for %s %s' % (gene, rel))
+        return
+
+    cache = EdgeConversionCache(convert_edge)
+    # The first reply fills the cache
+    cache.get_all(result)
+
+    uncached = timeit.timeit(lambda: convert_uncached(result), number=repeats) / repeats
+    cached = timeit.timeit(lambda: KQMLList(cache.get_all(result)), number=repeats) / repeats
+
+    print('%s %s: %d edges per reply' % (gene, rel, len(result)))
+    print('uncached: %.2f ms per reply' % (uncached * 1000))
+    print('cached:   %.2f ms per reply' % (cached * 1000))
+    print('speedup:  %.1fx' % (uncached / cached if cached else float('inf')))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(*args[:2], *[int(a) for a in args[2:3]])
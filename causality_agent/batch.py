@@ -0,0 +1,231 @@
+"""Runs CausalityAgent lookups for a JSONL file of queries on a process pool.
+
+Each input line is a JSON object with a "query" name and its arguments, e.g.
+
+    {"query": "mutsig", "gene": "TP53", "disease": "OV"}
+    {"query": "mutex", "gene": "TP53", "disease": "BRCA"}
+    {"query": "causality_targets", "gene": "MAPK1", "rel": "phosphorylates"}
+    {"query": "causality", "source": "MAPK1", "target": "JUND"}
+    {"query": "common_upstreams", "genes": ["AKT1", "BRAF"]}
+    {"query": "correlations", "gene": "AKT1", "limit": 50, "max_p": 0.0001}
+    {"query": "cellular_location", "genes": ["AKT1", "MAPK1"]}
+
+Results are written as JSONL in input order:
+
+    python -m causality_agent.batch queries.jsonl results.jsonl --processes 8
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from .causality_agent import CausalityAgent
+from .database_initializer import DatabaseInitializer, tcga_study_names
+
+
+_resource_dir = os.path.dirname(os.path.realpath(__file__)) + '/resources/'
+
+# The agent of the worker process
+_agent = None
+
+
+def _get_disease_abbr(ca, disease):
+    if disease.upper() in tcga_study_names:
+        return disease.upper()
+    return ca.get_tcga_abbr(disease.replace('-', ' ').lower())
+
+
+def _add_uri_strs(ca, causalities):
+    """The agent returns the evidence id of a relation, results carry its PC uri string as well"""
+    uri_strs = ca.get_uri_strs(causality['evidence_id'] for causality in causalities)
+    for causality in causalities:
+        causality['uri_str'] = uri_strs.get(causality['evidence_id'])
+
+
+def _find_causality(ca, query):
+    causality = ca.find_causality({'source': {'id': query['source']}, 'target': {'id': query['target']},
+                                   'direction': query.get('direction')})
+    if causality:
+        _add_uri_strs(ca, [causality])
+    return causality
+
+
+def _find_causality_targets(ca, query):
+    param = {'id': query['gene'], 'rel': query['rel']}
+    for key in ('offset', 'limit'):
+        if key in query:
+            param[key] = query[key]
+    targets = ca.find_causality_targets(param)
+    if targets:
+        _add_uri_strs(ca, targets)
+    return targets
+
+
+queries = {
+    'mutsig': lambda ca, q: ca.find_mutation_significance(q['gene'], _get_disease_abbr(ca, q['disease'])),
+    'mutex': lambda ca, q: ca.find_mutex(q['gene'], _get_disease_abbr(ca, q['disease'])),
+    'causality': _find_causality,
+    'causality_targets': _find_causality_targets,
+    'common_upstreams': lambda ca, q: ca.find_common_upstreams(q['genes']),
+    'correlations': lambda ca, q: ca.find_top_correlations(q['gene'], q.get('limit', 50), q.get('max_p'),
+                                                           q.get('min_corr')),
+    'cellular_location': lambda ca, q: ca.find_most_likely_cellular_location(q['genes']),
+    'tcga_abbr': lambda ca, q: ca.get_tcga_abbr(q['name'].lower()),
+}
+
+# Arguments each query needs, the others are optional
+query_arguments = {
+    'mutsig': ('gene', 'disease'),
+    'mutex': ('gene', 'disease'),
+    'causality': ('source', 'target'),
+    'causality_targets': ('gene', 'rel'),
+    'common_upstreams': ('genes',),
+    'correlations': ('gene',),
+    'cellular_location': ('genes',),
+    'tcga_abbr': ('name',),
+}
+
+
+def missing_arguments(name, query):
+    """
+    :param name: Query name
+    :param query: dict with the query arguments
+    :return: list of the arguments the query needs but doesn't have
+    """
+    return [arg for arg in query_arguments[name] if arg not in query]
+
+
+def _init_worker(path):
+    global _agent
+    _agent = CausalityAgent(path, read_only=True)
+
+
+def run_query(ca, query):
+    """
+    Runs a single query
+    :param ca: CausalityAgent
+    :param query: dict with the query name and its arguments
+    :return: dict with the query and its result or error
+    """
+    output = {'query': query}
+    name = query.get('query')
+    if name not in queries:
+        output['error'] = 'Unknown query %s' % name
+        return output
+    missing = missing_arguments(name, query)
+    if missing:
+        output['error'] = 'Missing argument %s' % ', '.join(missing)
+        return output
+
+    try:
+        output['result'] = queries[name](ca, query)
+    except Exception as e:
+        output['error'] = '%s: %s' % (type(e).__name__, e)
+    return output
+
+
+def _run_chunk(lines):
+    """Runs the queries of a chunk of input lines in a worker process"""
+    results = []
+    for line in lines:
+        try:
+            query = json.loads(line)
+        except ValueError as e:
+            results.append(json.dumps({'input': line, 'error': 'Invalid JSON: %s' % e}))
+            continue
+        results.append(json.dumps(run_query(_agent, query), default=str))
+    return results
+
+
+def _read_chunks(input_file, chunk_size):
+    chunk = []
+    for line in input_file:
+        line = line.strip()
+        if not line:
+            continue
+        chunk.append(line)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def run_batch(input_file, output_file, path=_resource_dir, processes=None, chunk_size=64,
+              max_pending=None, report_interval=10.0, log=sys.stderr):
+    """
+    Runs the queries of input_file on a process pool and writes the results to output_file in input order.
+    At most max_pending chunks are read ahead of the output, so memory does not grow with the input.
+    :param input_file: File object with one JSON query per line
+    :param output_file: File object the JSON results are written to
+    :param path: Resource folder with the database
+    :param processes: Number of worker processes, the number of cores by default
+    :param chunk_size: Number of queries sent to a worker at a time
+    :param max_pending: Number of chunks in flight, 4 per process by default
+    :param report_interval: Seconds between progress lines on log
+    :return: Number of queries run
+    """
+    processes = processes or os.cpu_count() or 1
+    max_pending = max_pending or 4 * processes
+
+    # Make sure the database is built before the workers open it read-only
+    db_initializer = DatabaseInitializer(path)
+    db_initializer.cadb.close()
+
+    start = time.time()
+    last_report = start
+    count = 0
+
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(path,)) as executor:
+        def write_first():
+            results = pending.popleft().result()
+            for result in results:
+                output_file.write(result + '\n')
+            return len(results)
+
+        for chunk in _read_chunks(input_file, chunk_size):
+            pending.append(executor.submit(_run_chunk, chunk))
+            if len(pending) >= max_pending:
+                count += write_first()
+
+                now = time.time()
+                if log and now - last_report >= report_interval:
+                    last_report = now
+                    log.write('%d queries, %.1f queries/s\n' % (count, count / (now - start)))
+
+        while pending:
+            count += write_first()
+
+    if log:
+        elapsed = time.time() - start
+        log.write('%d queries in %.2f s, %.1f queries/s\n' % (count, elapsed, count / elapsed if elapsed else 0.0))
+
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run CausalityAgent queries from a JSONL file on a process pool')
+    parser.add_argument('input', help="JSONL file of queries, '-' for stdin")
+    parser.add_argument('output', help="JSONL file for the results, '-' for stdout")
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--chunk-size', type=int, default=64, help='queries sent to a worker at a time')
+    parser.add_argument('--resources', default=_resource_dir, help='folder with the database')
+    args = parser.parse_args(argv)
+
+    input_file = sys.stdin if args.input == '-' else open(args.input, 'r')
+    output_file = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        run_batch(input_file, output_file, args.resources, args.processes, args.chunk_size)
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+        if output_file is not sys.stdout:
+            output_file.close()
+
+
+if __name__ == '__main__':
+    main()
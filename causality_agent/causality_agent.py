@@ -1,16 +1,82 @@
+import os
 import re
-from .database_initializer import DatabaseInitializer
+import threading
+import numpy as np
+from .database_initializer import DatabaseInitializer, opposite_rel
+from .explainability import CausalPriorIndex
+from .sif_graph import SifGraph
+from .neighborhood import NeighborhoodEngine
+from .correlation_store import CorrelationStore
+from .mutex_engine import MutexEngine, default_permutations
+from .sites import encode_site_str
+from .performance import timed
 import http.client, urllib.parse
 import requests
 
+# Causality rows with gene names in the column order of row_to_causality. Edge is twice
+# the rowid, plus one for a relation read from its target.
+_causality_columns = "g1.Symbol, c.PSite1, g2.Symbol, c.PSite2, c.Rel, c.EvidenceId, 2 * c.rowid AS Edge " \
+                     "FROM Causality c INNER JOIN Gene g1 ON g1.Id = c.Id1 INNER JOIN Gene g2 ON g2.Id = c.Id2"
+_reverse_causality_columns = "g2.Symbol, c.PSite2, g1.Symbol, c.PSite1, c.Rel, c.EvidenceId, 2 * c.rowid + 1 " \
+                             "FROM Causality c INNER JOIN Gene g1 ON g1.Id = c.Id1 INNER JOIN Gene g2 ON g2.Id = c.Id2"
+
+
+def _causality_query(forward_cond, reverse_cond):
+    """
+    Each relation is stored once from its source to its target. The relations read from
+    their targets are added in the order the opposite relations were stored before,
+    right after the relation itself.
+    :param forward_cond: Condition on the stored relations
+    :param reverse_cond: Condition on the relations read from their targets, Id2 is their source
+    :return: SQL query of causality rows
+    """
+    return "SELECT " + _causality_columns + " WHERE " + forward_cond + \
+           " UNION ALL SELECT " + _reverse_causality_columns + " WHERE " + reverse_cond + " ORDER BY Edge"
+
+
 class CausalityAgent:
-    def __init__(self, path):
+    # Gene summaries are retrieved from biogene, tests and benchmarks can point it to a local server
+    biogene_url = os.environ.get('CAUSALA_BIOGENE_URL', 'http://www.pathwaycommons.org/biogene/retrieve.do?')
+
+    # Relations read from the target of a stored relation, and back
+    opposite_rel = dict(opposite_rel)
+    stored_rel = {opp_rel: rel for rel, opp_rel in opposite_rel.items()}
+
+    def __init__(self, path, read_only=False, profile_sql=False):
         self.corr_ind = 0
         self.causality_ind = 0
 
-        self.db_initializer = DatabaseInitializer(path)
+        self.db_initializer = DatabaseInitializer(path, read_only, profile_sql)
+
+        # sqlite connections can't be shared between threads
+        self._local = threading.local()
+        self._local.cadb = self.db_initializer.cadb
+
+        self._prior_index = None
+        self._prior_index_lock = threading.Lock()
 
-        self.cadb = self.db_initializer.cadb
+        self._sif_graph = None
+        self._sif_graph_lock = threading.Lock()
+
+        self._neighborhood_engine = None
+        self._neighborhood_engine_lock = threading.Lock()
+
+        self._correlation_store = None
+        self._correlation_store_lock = threading.Lock()
+
+        self.mutex_engine = MutexEngine(os.path.join(path, 'tcga-mutex-results'))
+
+    @property
+    def cadb(self):
+        """
+        Connection to the database for the current thread
+        :return:
+        """
+        cadb = getattr(self._local, 'cadb', None)
+        if cadb is None:
+            cadb = self.db_initializer.connect()
+            self._local.cadb = cadb
+        return cadb
 
     def __del__(self):
         self.cadb.close()
@@ -19,6 +85,7 @@ class CausalityAgent:
         self.corr_ind = 0
         self.causality_ind = 0
 
+    @timed('query')
     def get_tcga_abbr(self, long_name):
         """
         Gets the study abbreviation given its long name
@@ -36,6 +103,66 @@ class CausalityAgent:
             return name[0]
 
 
+    def get_gene_refs(self):
+        """
+        Gets the HGNC and UniProt ids of the genes in the database
+        :return: dict from gene name to its db_refs
+        """
+        gene_refs = {}
+        with self.cadb:
+            cur = self.cadb.cursor()
+            for gene, hgnc_id, uniprot_id in cur.execute("SELECT Symbol, HGNC, UP FROM Gene"):
+                db_refs = {}
+                if hgnc_id:
+                    db_refs['HGNC'] = hgnc_id
+                    if uniprot_id:
+                        db_refs['UP'] = uniprot_id
+                gene_refs[gene] = db_refs
+
+        return gene_refs
+
+    def get_gene_id(self, gene):
+        """
+        Resolves a gene name to the integer id the tables store
+        :param gene:
+        :return: id of the gene, None if the database doesn't have it
+        """
+        with self.cadb:
+            cur = self.cadb.cursor()
+            row = cur.execute("SELECT Id FROM Gene WHERE Symbol = ?", (gene,)).fetchone()
+
+        return row[0] if row else None
+
+    def get_gene_ids(self, genes):
+        """
+        Resolves gene names to the integer ids the tables store
+        :param genes: A gene name or a list of them
+        :return: list of the ids of the genes the database has
+        """
+        if not isinstance(genes, list):
+            genes = [genes]
+        genes = [str(gene) for gene in genes]
+
+        with self.cadb:
+            cur = self.cadb.cursor()
+            rows = cur.execute("SELECT Id FROM Gene WHERE Symbol IN (" + ", ".join("?" * len(genes)) + ")",
+                               genes).fetchall()
+
+        return [row[0] for row in rows]
+
+    def get_gene_symbols(self, gene_ids):
+        """
+        :param gene_ids: list of gene ids
+        :return: dict from gene id to its name
+        """
+        gene_ids = list(gene_ids)
+        with self.cadb:
+            cur = self.cadb.cursor()
+            rows = cur.execute("SELECT Id, Symbol FROM Gene WHERE Id IN (" + ", ".join("?" * len(gene_ids)) + ")",
+                               gene_ids).fetchall()
+
+        return dict(rows)
+
     @staticmethod
     def row_to_causality(row):
         """
@@ -69,13 +196,58 @@ class CausalityAgent:
                       'position': None,
                       'is_modified': True}]
 
+        rel = row[4]
+        if row[6] & 1:
+            rel = CausalityAgent.opposite_rel[rel]
+
         causality = {'id1': row[0], 'mods1': mods1,
                      'id2': row[2], 'mods2': mods2,
-                     'rel': row[4],
-                     'uri_str': row[5]
+                     'rel': rel,
+                     'evidence_id': row[5]
                      }
         return causality
 
+    @staticmethod
+    def make_uri_str(uris):
+        """
+        Builds the uri parameters of a PC get request from the evidence of a relation
+        :param uris: Space separated PC uris
+        :return: 'uri= ...&uri= ...&' string
+        """
+        uri_arr = []
+        if uris:
+            uri_arr = uris.split(" ")
+
+        if len(uri_arr) == 0:
+            uri_arr = [uris]
+
+        uri_str = ""
+        for uri in uri_arr:
+            uri_str = uri_str + "uri= " + uri + "&"
+        return uri_str
+
+    @timed('query')
+    def get_uri_strs(self, evidence_ids):
+        """
+        Gets the PC uri strings of the evidence of causality objects
+        :param evidence_ids: evidence_id values of causality objects
+        :return: dict from evidence id to its uri string
+        """
+        evidence_ids = list(set(evidence_ids))
+        with self.cadb:
+            cur = self.cadb.cursor()
+            rows = cur.execute("SELECT Id, Uris FROM Evidence WHERE Id IN (" + ", ".join("?" * len(evidence_ids)) + ")",
+                               evidence_ids).fetchall()
+
+        return {evidence_id: self.make_uri_str(uris) for evidence_id, uris in rows}
+
+    def get_uri_str(self, evidence_id):
+        """
+        :param evidence_id: evidence_id of a causality object
+        :return: The PC uri string of its evidence
+        """
+        return self.get_uri_strs([evidence_id]).get(evidence_id)
+
 
     @staticmethod
     def row_to_correlation(row):
@@ -97,6 +269,7 @@ class CausalityAgent:
                 'explainable': "unassigned"}
         return corr
 
+    @timed('query')
     def find_causality(self, param):
         """
         Finds the causal relationship between gene1 and gene2
@@ -110,72 +283,95 @@ class CausalityAgent:
             targets = param.get('target').get('id')
             direction = param.get('direction')
 
-            if isinstance(sources, list):
-                source_str = "(" + ", ".join((("'" + str(source) + "'") for source in sources)) + ")"
-            else:
-                source_str = "('" + sources + "')"
+            source_ids = self.get_gene_ids(sources)
+            target_ids = self.get_gene_ids(targets)
 
-            if isinstance(targets, list):
-                target_str = "(" + ", ".join((("'" + str(target) + "'") for target in targets)) + ")"
-            else:
-                target_str = "('" + targets + "')"
-
-            query = "SELECT * FROM Causality WHERE Id1 IN " + source_str + "AND Id2 IN  " + target_str
+            source_str = ", ".join("?" * len(source_ids))
+            target_str = ", ".join("?" * len(target_ids))
+            query = _causality_query("c.Id1 IN (" + source_str + ") AND c.Id2 IN (" + target_str + ")",
+                                     "c.Id2 IN (" + source_str + ") AND c.Id1 IN (" + target_str + ")")
 
-            rows = cur.execute(query).fetchall()
+            rows = cur.execute(query, source_ids + target_ids + source_ids + target_ids).fetchall()
 
             if len(rows) > 0:
                 for row in rows:
+                    causality = self.row_to_causality(row)
                     if direction and direction.lower() == 'strict':  # return the first active row
-                        if 'is' not in row[4]:
-                            causality = self.row_to_causality(row)
+                        if 'is' not in causality['rel']:
                             return causality
                     else:  # return the first row
-                        causality = self.row_to_causality(row)
                         return causality
 
             return ''
 
 
 
+    @timed('query')
     def find_causality_targets(self, param):
         """
         Finds the causal relationship from gene list
-        :param param: param: {id:[]}
+        :param param: param: {id:[], rel:, offset:, limit:}
         :return:
         """
+        targets = list(self.iter_causality_targets(param))
+
+        if not targets:
+            return None
+
+        return targets
+
+    def iter_causality_targets(self, param):
+        """
+        Yields the causal relationships from gene list one row at a time
+        :param param: {id:[], rel:, offset:, limit:}. offset and limit are optional and page the result rows
+        :return: generator of causality objects
+        """
         with self.cadb:
             cur = self.cadb.cursor()
-            genes = param.get('id')
-
-            if isinstance(genes, list):
-                id_str =  ", ".join((("'" + str(gene) + "'") for gene in genes))
-            else:
-                id_str = "('" + genes + "')"
+            gene_ids = self.get_gene_ids(param.get('id'))
+            id_str = ", ".join("?" * len(gene_ids))
 
             rel = param.get('rel')
 
             if rel.upper() == "MODULATES":
-                query = "SELECT * FROM Causality WHERE Id1 IN " + "(" + id_str + ")";
-                rows = cur.execute(query).fetchall()
+                query = _causality_query("c.Id1 IN (" + id_str + ")", "c.Id2 IN (" + id_str + ")")
+                args = tuple(gene_ids) * 2
             elif rel.upper() == "IS-MODULATED-BY":
-                query = "SELECT * FROM Causality WHERE Id1 IN " + "(" + id_str + ")";
-                rows = cur.execute(query).fetchall()
+                query = _causality_query("c.Id1 IN (" + id_str + ")", "c.Id2 IN (" + id_str + ")")
+                args = tuple(gene_ids) * 2
             else:
-                query = "SELECT * FROM Causality WHERE Rel = ?  AND Id1 IN " + "(" + id_str + ")";
-                rows = cur.execute(query, (rel,)).fetchall()
-
+                # Opposite relations like is-phosphorylated-by are stored as the relation of their target
+                query = _causality_query("c.Rel = ? AND c.Id1 IN (" + id_str + ")",
+                                         "c.Rel = ? AND c.Id2 IN (" + id_str + ")")
+                args = (rel,) + tuple(gene_ids) + (self.stored_rel.get(rel),) + tuple(gene_ids)
 
-            if not rows:
-                return None
+            limit = param.get('limit')
+            offset = param.get('offset')
+            if limit is not None or offset:
+                # sqlite needs a LIMIT clause before OFFSET, -1 means no limit
+                query += " LIMIT ? OFFSET ?"
+                args += (-1 if limit is None else limit, offset or 0)
 
-            targets = []
-            for row in rows:
-                causality = self.row_to_causality(row)
-                targets.append(causality)
+            for row in cur.execute(query, args):
+                yield self.row_to_causality(row)
 
-            return targets
+    @staticmethod
+    def set_explanation(corr, row):
+        """
+        Copies the precomputed explanation of a correlation, from a row of the
+        Explained_Correlations or Unexplained_Correlations views
+        :param corr: Correlation object
+        :param row: View row, the explanation columns follow the gene ids
+        :return:
+        """
+        corr['explanation'] = row[14]
+        corr['mediator'] = row[15]
+        if row[16] is not None:
+            corr['mediatorPSite'] = row[16][1:len(row[16]) - 1]
+        else:
+            corr['mediatorPSite'] = None
 
+    @timed('query')
     def find_next_correlation(self, gene):
         """
         Returns the next interesting relationship about gene. Can be explained or unexplained
@@ -186,8 +382,10 @@ class CausalityAgent:
         with self.cadb:
             cur = self.cadb.cursor()
 
+            gene_id = self.get_gene_id(gene)
             causal_rows = cur.execute("SELECT * FROM Explained_Correlations "
-                                      "WHERE Id1 = ? OR Id2 = ? ORDER BY ABS(Corr) DESC", (gene, gene)).fetchall()
+                                      "WHERE GeneId1 = ? OR GeneId2 = ? ORDER BY ABS(Corr) DESC",
+                                      (gene_id, gene_id)).fetchall()
 
             row_cnt = len(causal_rows)
 
@@ -197,6 +395,7 @@ class CausalityAgent:
 
                 corr = self.get_correlation_between(row[0], row[1], row[2], row[3])
                 corr['explainable'] = "explainable"
+                self.set_explanation(corr, row)
             else:
                 corr = self.find_next_unexplained_correlation(gene)
 
@@ -211,6 +410,7 @@ class CausalityAgent:
 
             return corr
 
+    @timed('query')
     def get_correlation_between(self, gene1, p_site1, gene2, p_site2):
         """
         When We are sure that there is a correlation between these
@@ -222,10 +422,16 @@ class CausalityAgent:
         """
         with self.cadb:
             cur = self.cadb.cursor()
+            gene_id1 = self.get_gene_id(gene1)
+            gene_id2 = self.get_gene_id(gene2)
+            site1 = encode_site_str(p_site1)
+            site2 = encode_site_str(p_site2)
             # Don't change the order
-            rows = cur.execute("SELECT * FROM Correlations WHERE Id1 = ? AND PSite1 = ?  AND Id2 = ?  AND PSite2 = ? "
-                               "OR Id1 = ? AND PSite1 = ?  AND Id2 = ?  AND PSite2 = ? ",
-                               (gene1, p_site1, gene2, p_site2, gene2, p_site2, gene1, p_site1)).fetchall()
+            rows = cur.execute("SELECT g1.Symbol, c.PSite1, g2.Symbol, c.PSite2, c.Corr, c.PVal FROM Correlations c "
+                               "INNER JOIN Gene g1 ON g1.Id = c.Id1 INNER JOIN Gene g2 ON g2.Id = c.Id2 "
+                               "WHERE c.Id1 = ? AND c.Site1 = ?  AND c.Id2 = ?  AND c.Site2 = ? "
+                               "OR c.Id1 = ? AND c.Site1 = ?  AND c.Id2 = ?  AND c.Site2 = ? ORDER BY c.rowid",
+                               (gene_id1, site1, gene_id2, site2, gene_id2, site2, gene_id1, site1)).fetchall()
 
             if not rows:
                 return None
@@ -236,6 +442,7 @@ class CausalityAgent:
 
             return corr
 
+    @timed('query')
     def find_next_unexplained_correlation(self, gene):
         """
         Finds the next highest unexplained correlation
@@ -244,9 +451,10 @@ class CausalityAgent:
         """
         with self.cadb:
             cur = self.cadb.cursor()
+            gene_id = self.get_gene_id(gene)
             rows = cur.execute("SELECT * FROM Unexplained_Correlations "
-                               "WHERE Id1 = ? OR Id2 = ? ORDER BY ABS(Corr) DESC",
-                               (gene, gene)).fetchall()
+                               "WHERE GeneId1 = ? OR GeneId2 = ? ORDER BY ABS(Corr) DESC",
+                               (gene_id, gene_id)).fetchall()
 
 
             row_cnt = len(rows)
@@ -255,10 +463,124 @@ class CausalityAgent:
                 self.corr_ind = self.corr_ind + 1
                 corr = self.row_to_correlation(row)
                 corr['explainable'] = "unexplainable"
+                self.set_explanation(corr, row)
                 return corr
             else:
                 return ''
 
+    def get_correlation_store(self):
+        """
+        Gets the columnar copy of the Correlations table, read from the database on first use
+        :return: CorrelationStore
+        """
+        if self._correlation_store is None:
+            with self._correlation_store_lock:
+                if self._correlation_store is None:
+                    self._correlation_store = CorrelationStore.from_database(self.cadb)
+        return self._correlation_store
+
+    def store_rows_to_correlations(self, rows, gene_id=None):
+        """
+        Converts correlations of the correlation store into correlation objects
+        :param rows: Correlation positions in the store
+        :param gene_id: Gene put first in each correlation if given
+        :return: list of correlation objects as returned by row_to_correlation, labeled explainable or not
+        """
+        store = self.get_correlation_store()
+        rows = rows.tolist()
+        id1 = store.id1[rows].tolist()
+        id2 = store.id2[rows].tolist()
+        symbols = self.get_gene_symbols(set(id1) | set(id2)) if rows else {}
+
+        correlations = []
+        for row, gene_id1, gene_id2 in zip(rows, id1, id2):
+            p_site1 = store.p_sites[store.p_site1[row]]
+            p_site2 = store.p_sites[store.p_site2[row]]
+            if gene_id1 != gene_id and gene_id2 == gene_id:
+                gene_id1, p_site1, gene_id2, p_site2 = gene_id2, p_site2, gene_id1, p_site1
+            corr = self.row_to_correlation((symbols[gene_id1], p_site1, symbols[gene_id2], p_site2,
+                                            float(store.corr[row]), float(store.p_val[row])))
+            corr['explainable'] = "explainable" if store.explained[row] else "unexplainable"
+            correlations.append(corr)
+        return correlations
+
+    @timed('query')
+    def find_top_correlations(self, gene, limit=50, max_p=None, min_corr=None):
+        """
+        Finds the strongest correlations of a gene, e.g. the top 50 of AKT1 with p < 1e-4
+        :param gene: Gene name, first in each correlation returned
+        :param limit: Largest number of correlations, all if None
+        :param max_p: Only correlations with a smaller p-value if given
+        :param min_corr: Only correlations at least this strong, in absolute value, if given
+        :return: list of correlation objects, strongest first, None if the gene is not in the database
+        """
+        gene_id = self.get_gene_id(gene)
+        if gene_id is None:
+            return None
+
+        rows = self.get_correlation_store().gene_top(gene_id, limit, max_p, min_corr)
+        return self.store_rows_to_correlations(rows, gene_id)
+
+    @timed('query')
+    def find_strongest_correlations(self, limit=50, max_p=None, min_corr=None):
+        """
+        Finds the strongest correlations over all genes
+        :param limit: Largest number of correlations, all if None
+        :param max_p: Only correlations with a smaller p-value if given
+        :param min_corr: Only correlations at least this strong, in absolute value, if given
+        :return: list of correlation objects, strongest first
+        """
+        rows = self.get_correlation_store().top(limit, max_p, min_corr)
+        return self.store_rows_to_correlations(rows)
+
+    def get_causal_prior_index(self):
+        """
+        Gets the index of causal priors, read from the database on first use
+        :return: CausalPriorIndex
+        """
+        if self._prior_index is None:
+            with self._prior_index_lock:
+                if self._prior_index is None:
+                    self._prior_index = CausalPriorIndex.from_database(self.cadb)
+        return self._prior_index
+
+    def get_sif_graph(self):
+        """
+        Gets the Sif_Relations network, mapped from its snapshot file on first use.
+        The snapshot is written first if it is missing, or the network is read into
+        memory when the database is read-only.
+        :return: SifGraph
+        """
+        if self._sif_graph is None:
+            with self._sif_graph_lock:
+                if self._sif_graph is None:
+                    sif_graph_file = self.db_initializer.sif_graph_file
+                    if not os.path.isfile(sif_graph_file):
+                        # Read on the connection of this thread, the initializer's belongs to the main thread
+                        self._sif_graph = SifGraph.from_database(self.cadb)
+                        if not self.db_initializer.read_only:
+                            self._sif_graph.save(sif_graph_file)
+                        return self._sif_graph
+                    self._sif_graph = SifGraph.load(sif_graph_file)
+        return self._sif_graph
+
+    @timed('query')
+    def classify_correlations(self, pairs):
+        """
+        Labels correlated pairs explainable or unexplainable by the causal priors,
+        without reading or changing the Correlations table
+        :param pairs: list of (id1, pSite1, id2, pSite2), sites like S473S, S473 or None
+        :return: list of {id1:, pSite1:, id2:, pSite2:, explainable:, rel: []} in the order of pairs
+        """
+        pairs = list(pairs)
+        rels = self.get_causal_prior_index().classify(pairs)
+
+        return [{'id1': pair[0], 'pSite1': pair[1], 'id2': pair[2], 'pSite2': pair[3],
+                 'explainable': "explainable" if pair_rels else "unexplainable",
+                 'rel': list(pair_rels)}
+                for pair, pair_rels in zip(pairs, rels)]
+
+    @timed('query')
     def find_mutation_significance(self, gene, disease):
         """
         :param single gene name and a tcga study abbreviation
@@ -267,7 +589,8 @@ class CausalityAgent:
         with self.cadb:
             cur = self.cadb.cursor()
 
-            p_val = cur.execute("SELECT PVal FROM MutSig WHERE Id = ? AND Disease = ?", (gene, disease)).fetchone()
+            p_val = cur.execute("SELECT PVal FROM MutSig WHERE Id = ? AND Disease = ?",
+                                (self.get_gene_id(gene), disease)).fetchone()
 
             if not p_val:
                 return None
@@ -278,17 +601,24 @@ class CausalityAgent:
             else:
                 return 'not significant'
 
-    def find_mutex(self, gene, disease):
+    @timed('query')
+    def find_mutex(self, gene, disease, max_score=0.05):
         """Find a mutually exclusive group that includes gene
         :param single gene name and a tcga study abbreviation
+        :param max_score: Only the groups with at most this score
         :return object list
         """
 
         with self.cadb:
             cur = self.cadb.cursor()
-            groups = cur.execute("SELECT * FROM Mutex WHERE Disease = ? AND "
-                                 "(Id1 = ? OR Id2 = ? OR Id3 = ? OR Id4 = ? OR Id5 = ?) ",
-                                 (disease, gene, gene, gene, gene, gene)).fetchall()
+            gene_id = self.get_gene_id(gene)
+            groups = cur.execute("SELECT m.Disease, g1.Symbol, g2.Symbol, g3.Symbol, g4.Symbol, g5.Symbol, m.Score "
+                                 "FROM Mutex m LEFT JOIN Gene g1 ON g1.Id = m.Id1 LEFT JOIN Gene g2 ON g2.Id = m.Id2 "
+                                 "LEFT JOIN Gene g3 ON g3.Id = m.Id3 LEFT JOIN Gene g4 ON g4.Id = m.Id4 "
+                                 "LEFT JOIN Gene g5 ON g5.Id = m.Id5 WHERE m.Disease = ? AND "
+                                 "(m.Id1 = ? OR m.Id2 = ? OR m.Id3 = ? OR m.Id4 = ? OR m.Id5 = ?) AND m.Score <= ? "
+                                 "ORDER BY m.rowid",
+                                 (disease, gene_id, gene_id, gene_id, gene_id, gene_id, max_score)).fetchall()
 
         if not groups:
             return None
@@ -303,6 +633,59 @@ class CausalityAgent:
 
         return mutex_list
 
+    @timed('query')
+    def find_ranked_mutex(self, disease, gene=None, max_score=None, max_q_val=None, limit=None, offset=0):
+        """
+        Finds the mutually exclusive groups of a study, best scored first, e.g. the top 10 in COAD
+        :param disease: TCGA study abbreviation
+        :param gene: Only the groups that include this gene name if given
+        :param max_score: Only the groups with at most this score if given
+        :param max_q_val: Only the groups with at most this q-value if given
+        :param limit: Largest number of groups, all if None
+        :param offset: Number of groups skipped
+        :return: list of {group:, score:, q_val:} by score and then in file order, q_val is None for the
+        studies without q-values
+        """
+        query = "SELECT g1.Symbol, g2.Symbol, g3.Symbol, g4.Symbol, g5.Symbol, m.Score, m.QVal " \
+                "FROM Mutex m LEFT JOIN Gene g1 ON g1.Id = m.Id1 LEFT JOIN Gene g2 ON g2.Id = m.Id2 " \
+                "LEFT JOIN Gene g3 ON g3.Id = m.Id3 LEFT JOIN Gene g4 ON g4.Id = m.Id4 " \
+                "LEFT JOIN Gene g5 ON g5.Id = m.Id5 WHERE m.Disease = ?"
+        args = (disease,)
+        if max_score is not None:
+            query += " AND m.Score <= ?"
+            args += (max_score,)
+        if max_q_val is not None:
+            query += " AND m.QVal <= ?"
+            args += (max_q_val,)
+        if gene is not None:
+            gene_id = self.get_gene_id(gene)
+            query += " AND (m.Id1 = ? OR m.Id2 = ? OR m.Id3 = ? OR m.Id4 = ? OR m.Id5 = ?)"
+            args += (gene_id,) * 5
+        # The (Disease, Score) index holds the groups of a study in this order
+        query += " ORDER BY m.Score, m.rowid LIMIT ? OFFSET ?"
+        args += (-1 if limit is None else limit, offset or 0)
+
+        with self.cadb:
+            cur = self.cadb.cursor()
+            groups = cur.execute(query, args).fetchall()
+
+        return [{'group': [gene for gene in group[:5] if gene is not None], 'score': group[5], 'q_val': group[6]}
+                for group in groups]
+
+    @timed('query')
+    def score_mutex(self, genes, disease, permutations=default_permutations, seed=None):
+        """
+        Scores the mutual exclusivity of any gene set on the alteration matrix of a study
+        :param genes: Gene names
+        :param disease: TCGA study abbreviation
+        :param permutations: Number of permutations for the p-value
+        :param seed: Seed of the random generator, for repeatable p-values
+        :return: {genes:, alterations:, samples:, coverage:, overlap:, p_value:}, None if the study has no
+        alteration matrix
+        """
+        return self.mutex_engine.score(disease, genes, permutations, seed)
+
+    @timed('query')
     def find_common_upstreams(self, genes):
         """
         Find common upstreams between a list of genes
@@ -310,42 +693,90 @@ class CausalityAgent:
         :return:
         """
 
-        with self.cadb:
-            cur = self.cadb.cursor()
+        if len(genes) < 2:
+            return ''
 
-            if len(genes) < 2:
-                return ''
+        graph = self.get_sif_graph()
+        rel = 'controls-state-change-of'
 
-            gene1 = genes[0]
-            gene2 = genes[1]
+        # Each upstream of the first gene, once per its edges to the second gene
+        upstreams = graph.sources(self.get_gene_id(genes[0]), rel)
+        upstreams2, counts2 = np.unique(graph.sources(self.get_gene_id(genes[1]), rel), return_counts=True)
+        pos = np.searchsorted(upstreams2, upstreams)
+        found = pos < len(upstreams2)
+        found[found] = upstreams2[pos[found]] == upstreams[found]
+        upstreams = np.repeat(upstreams[found], counts2[pos[found]])
 
-            upstreams = cur.execute("SELECT s1.Id1 FROM Sif_Relations s1 "
-                                    "INNER JOIN Sif_Relations s2 ON (s2.Id1 = s1.Id1 AND s1.Id2 = ? AND s2.id2 = ? AND  "
-                                    "s1.Rel = 'controls-state-change-of' AND s2.Rel = s1.Rel)",
-                                    (gene1, gene2)).fetchall()
+        if not len(upstreams):
+            return None
 
-            if not upstreams:
-                return None
+        # Then the upstreams of each next gene that are upstreams of the previous ones
+        for i in range(2, len(genes)):
+            gene_upstreams = graph.sources(self.get_gene_id(genes[i]), rel)
+            upstreams = gene_upstreams[np.isin(gene_upstreams, upstreams)]
 
-            for i in range(2, len(genes)):
-                gene = genes[i]
+        #format upstreams
+        upstreams = upstreams.tolist()
+        symbols = self.get_gene_symbols(upstreams)
+        upstream_list = []
+        for gene_id in upstreams:
+            upstream_list.append(str(symbols[gene_id]))
 
-                upstream_arr = []
-                for upstream in upstreams:
-                    upstream_arr.append(upstream[0])
+        return upstream_list
 
-                query = "SELECT Id1 FROM Sif_Relations WHERE Rel = 'controls-state-change-of' AND Id2 = ? AND Id1 IN (" \
-                        + ", ".join((("'"+str(upstream)+"'") for upstream in upstream_arr)) + ")"
+    def get_neighborhood_engine(self):
+        """
+        Gets the sparse neighborhood engine over Sif_Relations and the causal priors, built on first use
+        :return: NeighborhoodEngine
+        """
+        if self._neighborhood_engine is None:
+            with self._neighborhood_engine_lock:
+                if self._neighborhood_engine is None:
+                    self._neighborhood_engine = NeighborhoodEngine.from_database(self.cadb, self.get_sif_graph())
+        return self._neighborhood_engine
+
+    @timed('query')
+    def find_common_neighborhood(self, genes, direction='upstream', steps=1, rels=None):
+        """
+        Finds the genes within steps steps upstream or downstream of all the given genes
+        :param genes: Gene names
+        :param direction: 'upstream' or 'downstream'
+        :param steps: Largest number of steps
+        :param rels: Relation names to follow, the directed relations if None
+        :return: Sorted gene names, None if there is none
+        """
+        gene_ids = [self.get_gene_id(gene) for gene in genes]
+        common = self.get_neighborhood_engine().common(gene_ids, rels, direction, steps).tolist()
+        if not common:
+            return None
 
-                upstreams = cur.execute(query, (gene,)).fetchall()
+        symbols = self.get_gene_symbols(common)
+        return sorted(symbols[gene_id] for gene_id in common)
 
-            #format upstreams
-            upstream_list = []
-            for genes in upstreams:
-                upstream_list.append(str(genes[0]))
+    @timed('query')
+    def rank_regulators(self, genes, steps=1, rels=None, limit=None):
+        """
+        Ranks the genes upstream of any of the given genes by how many of them they reach
+        :param genes: Gene names
+        :param steps: Largest number of steps
+        :param rels: Relation names to follow, the directed relations if None
+        :param limit: Largest number of regulators to return
+        :return: list of {gene:, coverage:}, the most covering first and then by name, None if there is none
+        """
+        gene_ids = [self.get_gene_id(gene) for gene in genes]
+        regulator_ids, coverages = self.get_neighborhood_engine().rank(gene_ids, rels, 'upstream', steps)
+        if not len(regulator_ids):
+            return None
 
-            return upstream_list
+        symbols = self.get_gene_symbols(regulator_ids.tolist())
+        regulators = sorted(({'gene': symbols[gene_id], 'coverage': coverage}
+                             for gene_id, coverage in zip(regulator_ids.tolist(), coverages.tolist())),
+                            key=lambda regulator: (-regulator['coverage'], regulator['gene']))
+        if limit is not None:
+            regulators = regulators[:limit]
+        return regulators
 
+    @timed('query')
     def find_cellular_location(self, gene):
         """
         Find subcellular location of the gene
@@ -356,10 +787,12 @@ class CausalityAgent:
         with self.cadb:
             cur = self.cadb.cursor()
 
-            location = cur.execute("SELECT Component FROM CellularComponents WHERE Gene = ?", (gene,)).fetchall()
+            location = cur.execute("SELECT Component FROM CellularComponents WHERE Gene = ?",
+                                   (self.get_gene_id(gene),)).fetchall()
 
         return location
 
+    @timed('query')
     def find_most_likely_cellular_location(self, genes):
         """
         Given a set of gene names, find the most likely cell location
@@ -377,7 +810,7 @@ class CausalityAgent:
             for gene in genes:
 
                 locations = cur.execute("SELECT Component FROM CellularComponents WHERE Gene = ?",
-                                        (gene,)).fetchall()
+                                        (self.get_gene_id(gene),)).fetchall()
                 for location in locations:
                     if (location in loc_names):
                         loc_names[location[0]] += 1
@@ -395,8 +828,9 @@ class CausalityAgent:
 
         return max_loc_names
 
+    @timed('query')
     def find_gene_summary(self, gene):
-        pc_url = "http://www.pathwaycommons.org/biogene/retrieve.do?"
+        pc_url = self.biogene_url
 
 
         headers = {"Content-type": "application/x-www-form-urlencoded","Accept": "text/plain"}
@@ -1,9 +1,19 @@
 import sys
 import os
+import time
 import json
+import uuid
 import logging
+import functools
+import threading
 from bioagents import Bioagent
 from .causality_agent import CausalityAgent
+from .conversion_cache import EdgeConversionCache, TermNameCache
+from .performance import PerformanceStats, phase, timed, mark_failed, mark_error
+from .profiling import RequestProfiler
+from .dispatcher import RequestDispatcher
+from .mutex_engine import default_permutations
+from .replay import RequestRecorder
 from indra.sources.trips.processor import TripsProcessor
 from kqml import KQMLModule, KQMLPerformative, KQMLList, KQMLString, KQMLToken
 from indra.statements import stmts_from_json, Agent
@@ -24,13 +34,164 @@ class CausalityModule(Bioagent):
              'DATASET-CORRELATED-ENTITY', 'FIND-COMMON-UPSTREAMS',
              'RESTART-CAUSALITY-INDICES', 'FIND-MUTEX', 'FIND-MUTATION-SIGNIFICANCE',
              'RESET-CAUSALITY-INDICES',  'FIND-CELLULAR-LOCATION-FROM-NAMES',
-             'FIND-CELLULAR-LOCATION', 'FIND-GENE-SUMMARY']
+             'FIND-CELLULAR-LOCATION', 'FIND-GENE-SUMMARY', 'GET-PERFORMANCE-STATS',
+             'CLASSIFY-CORRELATIONS', 'FIND-COMMON-NEIGHBORHOOD', 'RANK-REGULATORS',
+             'SCORE-MUTEX', 'FIND-RANKED-MUTEX']
+
+    # Number of relations returned per FIND-CAUSALITY-TARGET/SOURCE reply
+    # when the request does not give a LIMIT
+    page_size = 100
+
+    # Largest STEPS of FIND-COMMON-NEIGHBORHOOD and RANK-REGULATORS
+    max_neighborhood_steps = 4
+
+    # Number of groups per FIND-RANKED-MUTEX reply when the request does not give a LIMIT
+    mutex_page_size = 10
+
+    # Largest gene set and number of permutations of SCORE-MUTEX
+    max_mutex_genes = 10
+    max_mutex_permutations = 100000
+
+    # Aggregate the PC links of a multi-relation reply into batched
+    # add-provenance messages, each holding at most provenance_max_links
+    # links and about provenance_max_chars characters of html
+    provenance_batch = True
+    provenance_max_links = 50
+    provenance_max_chars = 16000
+
+    # Number of causal edges whose CL-JSON conversion is kept for reuse
+    edge_cache_size = 20000
+
+    # Seconds between performance summary log lines, 0 turns them off
+    stats_log_interval = float(os.environ.get('CAUSALA_STATS_LOG_INTERVAL', 0))
+
+    # Run requests on worker lanes instead of one at a time. Each lane
+    # replies in the order its requests arrived. DATASET-CORRELATED-ENTITY
+    # walks a per-agent index so its lane has a single worker.
+    concurrent_dispatch = os.environ.get('CAUSALA_CONCURRENT_DISPATCH', '0') not in ('', '0')
+    dispatch_lanes = {'network': 4, 'bulk': 2, 'sequential': 1, 'fast': 4}
+    task_lanes = {'FIND-GENE-SUMMARY': 'network',
+                  'FIND-CAUSALITY-TARGET': 'bulk',
+                  'FIND-CAUSALITY-SOURCE': 'bulk',
+                  'FIND-COMMON-UPSTREAMS': 'bulk',
+                  'CLASSIFY-CORRELATIONS': 'bulk',
+                  'FIND-COMMON-NEIGHBORHOOD': 'bulk',
+                  'RANK-REGULATORS': 'bulk',
+                  'SCORE-MUTEX': 'bulk',
+                  'DATASET-CORRELATED-ENTITY': 'sequential',
+                  'RESET-CAUSALITY-INDICES': 'sequential',
+                  'RESTART-CAUSALITY-INDICES': 'sequential'}
+    default_task_lane = 'fast'
+    # Seconds after which a TIMEOUT failure is sent instead of the reply
+    task_deadlines = {'FIND-GENE-SUMMARY': 15.0}
+    default_task_deadline = 60.0
 
     def __init__(self, **kwargs):
-        self.CA = CausalityAgent(_resource_dir)
+        self.profiler = RequestProfiler.from_environment()
+        # The SQL statements are only timed when some requests are profiled
+        self.CA = CausalityAgent(_resource_dir, profile_sql=self.profiler.enabled)
+        self.gene_refs = self.CA.get_gene_refs()
+        self.edge_cache = EdgeConversionCache(self._convert_edge, self.edge_cache_size)
+        self.stats = PerformanceStats()
+        self.recorder = RequestRecorder.from_environment()
+        self._send_lock = threading.Lock()
+        self.request_dispatcher = None
+        if self.concurrent_dispatch:
+            self.request_dispatcher = RequestDispatcher(self.dispatch_lanes, self.task_lanes,
+                                                        self.default_task_lane, self.task_deadlines,
+                                                        self.default_task_deadline)
         # Call the constructor of KQMLModule
         super(CausalityModule, self).__init__(**kwargs)
 
+    def receive_request(self, msg, content):
+        """Times the handling of each request under its task name"""
+        try:
+            task = content.head().upper()
+        except Exception:
+            task = 'UNKNOWN'
+
+        if self.recorder is not None:
+            self.recorder.record(content)
+
+        if self.request_dispatcher is not None and not self.testing and task in self.tasks:
+            self.request_dispatcher.submit(task, lambda: self._handle_request(task, content),
+                                   lambda reply_content: self.reply_with_content(msg, reply_content),
+                                   lambda: self.make_failure('TIMEOUT'),
+                                   lambda: self.make_failure('INTERNAL_FAILURE'))
+            return
+
+        with self.stats.request(task):
+            result = super(CausalityModule, self).receive_request(msg, content)
+
+        self.stats.maybe_log(self.stats_log_interval)
+        return result
+
+    def _handle_request(self, task, content):
+        """Computes the reply content of a request on a dispatcher worker"""
+        with self.stats.request(task):
+            reply_content = self._respond_to(task, content)
+
+        self.stats.maybe_log(self.stats_log_interval)
+        return reply_content
+
+    def _respond_to(self, task, content):
+        if self.profiler.enabled and self.profiler.should_profile(task):
+            with self.profiler.profile(task, content):
+                reply_content = super(CausalityModule, self)._respond_to(task, content)
+        else:
+            reply_content = super(CausalityModule, self)._respond_to(task, content)
+
+        if reply_content.head() == 'FAILURE':
+            if reply_content.gets('reason') == 'INTERNAL_FAILURE':
+                mark_error()
+            else:
+                mark_failed()
+
+        return reply_content
+
+    def send(self, msg):
+        # Replies and provenance messages may come from several workers
+        with phase('send'), self._send_lock:
+            super(CausalityModule, self).send(msg)
+
+    def respond_get_performance_stats(self, content):
+        """Response content to get-performance-stats request"""
+        reply = KQMLList('SUCCESS')
+        reply.sets('uptime', '%.1f' % (time.time() - self.stats.started))
+
+        tasks = KQMLList()
+        for task, stats in sorted(self.stats.summary().items()):
+            task_stats = _get_latency_kqml(stats)
+            task_stats.sets('task', task)
+            task_stats.sets('failures', str(stats['failures']))
+            task_stats.sets('errors', str(stats['errors']))
+            task_stats.sets('error-rate', '%.4f' % stats['error_rate'])
+
+            phases = KQMLList()
+            for phase_name, phase_stats in sorted(stats['phases'].items()):
+                phase_kqml = _get_latency_kqml(phase_stats)
+                phase_kqml.sets('phase', phase_name)
+                phases.append(phase_kqml)
+            task_stats.set('phases', phases)
+
+            tasks.append(task_stats)
+        reply.set('tasks', tasks)
+
+        edge_cache = KQMLList()
+        edge_cache.sets('size', str(len(self.edge_cache)))
+        edge_cache.sets('hits', str(self.edge_cache.hits))
+        edge_cache.sets('misses', str(self.edge_cache.misses))
+        reply.set('edge-cache', edge_cache)
+
+        term_cache = KQMLList()
+        term_cache.sets('size', str(len(_term_name_cache)))
+        term_cache.sets('hits', str(_term_name_cache.hits))
+        term_cache.sets('misses', str(_term_name_cache.misses))
+        term_cache.sets('parse-time', '%.3f' % (_term_name_cache.parse_time * 1000))
+        reply.set('term-cache', term_cache)
+
+        return reply
+
     def respond_reset_causality_indices(self, content):
         self.CA.reset_indices()
         reply = KQMLList('SUCCESS')
@@ -63,9 +224,7 @@ class CausalityModule(Bioagent):
         if not result:
             return self.make_failure('NO_PATH_FOUND')
 
-        indra_json = [make_indra_json(result)]
-        indra_stmts = stmts_from_json(indra_json)
-        indra_cl_json = self.make_cljson(indra_stmts)
+        indra_cl_json = self.get_edges_cljson([result])
 
         reply = KQMLList('SUCCESS')
         reply.set('paths', indra_cl_json)
@@ -75,6 +234,22 @@ class CausalityModule(Bioagent):
 
         return reply
 
+    def get_edges_cljson(self, causalities):
+        """
+        CL-JSON of the INDRA statements of causal edges. The cached statements are
+        shared between replies, so each reply gets copies with new statement ids.
+        :param causalities: list of causality objects
+        :return: KQMLList of statements in the order of causalities
+        """
+        return KQMLList([_with_new_stmt_id(fragment) for fragment in self.edge_cache.get_all(causalities)])
+
+    def _convert_edge(self, causality):
+        """Converts a causality object into the CL-JSON of its INDRA statement"""
+        with phase('convert'):
+            indra_stmt = stmts_from_json([make_indra_json(causality)])[0]
+        with phase('serialize'):
+            return self.make_cljson(indra_stmt)
+
     def send_provenance(self, result):
         id1 = result['id1']
         mods1 = result['mods1']
@@ -84,7 +259,7 @@ class CausalityModule(Bioagent):
 
         title = str(id1) +  ' ' + str(rel) + ' ' + str(id2)
 
-        uri_str = result['uri_str']
+        uri_str = self.CA.get_uri_str(result['evidence_id'])
         pc_url = 'http://www.pathwaycommons.org/pc2/get?' + uri_str + 'format=SBGN'
         html = '<a href= \'' + pc_url + '\' target= \'_blank\' > PC link</a>'
         msg = KQMLPerformative('tell')
@@ -96,6 +271,51 @@ class CausalityModule(Bioagent):
         msg.set('content', content)
         self.send(msg)
 
+    def send_provenance_batch(self, results):
+        """Sends the PC links of several causality results to the provenance
+        tab in as few add-provenance messages as the size caps allow.
+        A PC link that was already added in this batch is not sent again."""
+        if not self.provenance_batch:
+            for result in results:
+                self.send_provenance(result)
+            return
+
+        # Results with the same evidence have the same PC link
+        uri_strs = self.CA.get_uri_strs(result['evidence_id'] for result in results)
+
+        links = []
+        evidence_ids = set()
+        for result in results:
+            if result['evidence_id'] in evidence_ids:
+                continue
+            evidence_ids.add(result['evidence_id'])
+            pc_url = 'http://www.pathwaycommons.org/pc2/get?' + uri_strs[result['evidence_id']] + 'format=SBGN'
+
+            title = str(result['id1']) + ' ' + str(result['rel']) + ' ' + str(result['id2'])
+            links.append((title, pc_url))
+
+        for chunk in _chunk_provenance_links(links, self.provenance_max_links,
+                                             self.provenance_max_chars):
+            self._send_provenance_links(chunk)
+
+    def _send_provenance_links(self, links):
+        """Sends a list of (title, pc_url) pairs as a single add-provenance message"""
+        items = ['<li>' + title + ': <a href= \'' + pc_url + '\' target= \'_blank\' > PC link</a></li>'
+                 for title, pc_url in links]
+        html = '<ul>' + ''.join(items) + '</ul>'
+
+        title = links[0][0]
+        if len(links) > 1:
+            title += ' and ' + str(len(links) - 1) + ' more'
+
+        msg = KQMLPerformative('tell')
+        content = KQMLList('add-provenance')
+        content.sets('html', html)
+        content.sets('pc', links[0][1])
+        content.sets('title', title)
+        msg.set('content', content)
+        self.send(msg)
+
     def respond_find_causality_target(self, content):
         """Response content to find-causality-target request"""
         target_arg = content.get('SOURCE')
@@ -127,24 +347,8 @@ class CausalityModule(Bioagent):
             return self.make_failure('MISSING_MECHANISM')
 
         target = {'id': target_name, 'pSite': ' ', 'rel': rel_verb}
-        result = self.CA.find_causality_targets(target)
-
-        if not result:
-            return self.make_failure('NO_PATH_FOUND')
-
-        # Send PC links to provenance tab
-        # Multiple interactions are sent separately
-        for r in result:
-            self.send_provenance(r) # r['uri_str'])
-
-        indra_json = [make_indra_json(r) for r in result]
-        indra_stmts = stmts_from_json(indra_json)
-        indra_cl_json = self.make_cljson(indra_stmts)
-
-        reply = KQMLList('SUCCESS')
-        reply.set('paths', indra_cl_json)
 
-        return reply
+        return self._respond_causality_page(target, content)
 
     def respond_find_causality_source(self, content):
         """Response content to find-qca-path request"""
@@ -176,21 +380,38 @@ class CausalityModule(Bioagent):
 
         source = {'id': source_name, 'pSite': ' ','rel': rel_verb}
 
-        result = self.CA.find_causality_targets(source)
+        return self._respond_causality_page(source, content)
+
+    def _respond_causality_page(self, param, content):
+        """Builds the reply for one page of causality targets or sources.
+        The page is selected by the optional OFFSET and LIMIT of the request,
+        the reply carries NEXT-OFFSET when there are more relations to fetch"""
+        try:
+            offset, limit = _get_page(content, self.page_size)
+        except ValueError:
+            return self.make_failure('INVALID_PAGE')
+
+        # Fetch one extra row to find out if there is a next page
+        param['offset'] = offset
+        param['limit'] = limit + 1
+        with phase('query'):
+            result = list(self.CA.iter_causality_targets(param))
 
         if not result:
             return self.make_failure('NO_PATH_FOUND')
 
-        # Multiple interactions are sent separately
-        for r in result:
-            self.send_provenance(r) # ['uri_str'])
+        has_next = len(result) > limit
+        result = result[:limit]
+
+        # Send PC links to provenance tab
+        self.send_provenance_batch(result)
 
-        indra_json = [make_indra_json(r) for r in result]
-        indra_stmts = stmts_from_json(indra_json)
-        indra_cl_json = self.make_cljson(indra_stmts)
+        indra_cl_json = self.get_edges_cljson(result)
 
         reply = KQMLList('SUCCESS')
-        reply.sets('paths', indra_cl_json)
+        reply.set('paths', indra_cl_json)
+        if has_next:
+            reply.sets('next-offset', str(offset + limit))
 
         return reply
 
@@ -215,6 +436,49 @@ class CausalityModule(Bioagent):
         # TODO: should be float as original or converted to string?
         reply.sets('correlation', str(res['correlation']))
         reply.sets('explainable', res['explainable'])
+        if res.get('explanation'):
+            reply.sets('explanation', res['explanation'])
+        if res.get('mediator'):
+            reply.sets('mediator', res['mediator'])
+            if res['mediatorPSite']:
+                reply.sets('mediator-site', res['mediatorPSite'])
+
+        return reply
+
+    def respond_classify_correlations(self, content):
+        """Response content to classify-correlations request.
+        PAIRS is a list of (gene1 site1 gene2 site2) lists, a site can be NIL"""
+        pairs_arg = content.get('PAIRS')
+        if not pairs_arg:
+            return self.make_failure('MISSING_MECHANISM')
+
+        try:
+            pairs = [_get_correlation_pair(pair) for pair in pairs_arg]
+        except (AttributeError, ValueError):
+            return self.make_failure('INVALID_PAIRS')
+        if not pairs:
+            return self.make_failure('MISSING_MECHANISM')
+
+        result = self.CA.classify_correlations(pairs)
+
+        classifications = KQMLList()
+        explained_cnt = 0
+        for corr in result:
+            classification = KQMLList()
+            classification.sets('id1', corr['id1'])
+            classification.sets('site1', corr['pSite1'] or '')
+            classification.sets('id2', corr['id2'])
+            classification.sets('site2', corr['pSite2'] or '')
+            classification.sets('explainable', corr['explainable'])
+            classification.set('rel', KQMLList([KQMLString(rel) for rel in corr['rel']]))
+            classifications.append(classification)
+            if corr['rel']:
+                explained_cnt += 1
+
+        reply = KQMLList('SUCCESS')
+        reply.set('classifications', classifications)
+        reply.sets('explained', str(explained_cnt))
+        reply.sets('unexplained', str(len(result) - explained_cnt))
 
         return reply
 
@@ -238,11 +502,66 @@ class CausalityModule(Bioagent):
             return self.make_failure('NO_UPSTREAM_FOUND')
 
         reply = KQMLList('SUCCESS')
-        upstreams = _get_genes_cljson(result)
+        upstreams = _get_genes_cljson(result, self.gene_refs)
         reply.set('upstreams', upstreams)
 
         return reply
 
+    def respond_find_common_neighborhood(self, content):
+        """Response content to find-common-neighborhood request.
+        Finds the genes within STEPS steps upstream or downstream (DIRECTION) of all GENES,
+        following RELATIONS or the directed relations"""
+        gene_names = _get_kqml_names(content.get('GENES'))
+        if not gene_names:
+            return self.make_failure('MISSING_MECHANISM')
+
+        direction = (content.gets('DIRECTION') or 'upstream').lower()
+        if direction not in ('upstream', 'downstream'):
+            return self.make_failure('INVALID_DIRECTION')
+
+        try:
+            steps = _get_steps(content, self.max_neighborhood_steps)
+            rels = _get_relations(content)
+            result = self.CA.find_common_neighborhood(gene_names, direction, steps, rels)
+        except ValueError:
+            return self.make_failure('INVALID_ARGUMENT')
+
+        if not result:
+            return self.make_failure('NO_GENE_FOUND')
+
+        reply = KQMLList('SUCCESS')
+        reply.set('genes', _get_genes_cljson(result, self.gene_refs))
+
+        return reply
+
+    def respond_rank_regulators(self, content):
+        """Response content to rank-regulators request.
+        Ranks the genes within STEPS steps upstream of GENES by how many of GENES they reach.
+        COVERAGES holds that number for each of REGULATORS"""
+        gene_names = _get_kqml_names(content.get('GENES'))
+        if not gene_names:
+            return self.make_failure('MISSING_MECHANISM')
+
+        try:
+            steps = _get_steps(content, self.max_neighborhood_steps)
+            rels = _get_relations(content)
+            limit = content.gets('LIMIT')
+            limit = int(limit) if limit else self.page_size
+            if limit < 1:
+                raise ValueError('LIMIT needs to be positive')
+            result = self.CA.rank_regulators(gene_names, steps, rels, limit)
+        except ValueError:
+            return self.make_failure('INVALID_ARGUMENT')
+
+        if not result:
+            return self.make_failure('NO_REGULATOR_FOUND')
+
+        reply = KQMLList('SUCCESS')
+        reply.set('regulators', _get_genes_cljson([regulator['gene'] for regulator in result], self.gene_refs))
+        reply.set('coverages', KQMLList([KQMLString(str(regulator['coverage'])) for regulator in result]))
+
+        return reply
+
     def respond_find_mutation_significance(self, content):
         """Response content to find-mutation-significance request"""
         gene_arg = content.get('GENE')
@@ -332,6 +651,112 @@ class CausalityModule(Bioagent):
 
         return reply
 
+    def respond_find_ranked_mutex(self, content):
+        """Response content to find-ranked-mutex request.
+        Lists the mutually exclusive groups of DISEASE, best scored first, optionally only those
+        including GENE and those with a score of at most THRESHOLD. The page is selected by the
+        optional OFFSET and LIMIT, the reply carries NEXT-OFFSET when there are more groups"""
+        disease_arg = content.get('DISEASE')
+        if not disease_arg:
+            return self.make_failure('MISSING_MECHANISM')
+
+        disease_names = _get_kqml_names(disease_arg)
+        if not disease_names:
+            return self.make_failure('INVALID_DISEASE')
+
+        disease_name = _sanitize_disase_name(disease_names[0])
+        disease_abbr = self.CA.get_tcga_abbr(disease_name)
+        if disease_abbr is None:
+            return self.make_failure('INVALID_DISEASE')
+
+        gene_name = None
+        gene_arg = content.get('GENE')
+        if gene_arg:
+            gene_names = _get_kqml_names(gene_arg)
+            if not gene_names:
+                return self.make_failure('MISSING_MECHANISM')
+            gene_name = gene_names[0]
+
+        try:
+            offset, limit = _get_page(content, self.mutex_page_size)
+        except ValueError:
+            return self.make_failure('INVALID_PAGE')
+
+        try:
+            threshold = content.gets('THRESHOLD')
+            threshold = float(threshold) if threshold else None
+        except ValueError:
+            return self.make_failure('INVALID_ARGUMENT')
+
+        # Fetch one extra group to find out if there is a next page
+        result = self.CA.find_ranked_mutex(disease_abbr, gene_name, threshold, None, limit + 1, offset)
+        if not result:
+            return self.make_failure('NO_MUTEX_GENES_FOUND')
+
+        has_next = len(result) > limit
+        result = result[:limit]
+
+        mutex = KQMLList()
+        for r in result:
+            groups = KQMLList()
+            groups.sets('score', '%.4g' % r['score'])
+            if r['q_val'] is not None:
+                groups.sets('q-value', '%.4g' % r['q_val'])
+            groups.set('group', KQMLList(r['group']))
+            mutex.append(groups)
+
+        reply = KQMLList('SUCCESS')
+        reply.set('mutex', mutex)
+        if has_next:
+            reply.sets('next-offset', str(offset + limit))
+
+        return reply
+
+    def respond_score_mutex(self, content):
+        """Response content to score-mutex request.
+        Scores the mutual exclusivity of GENES in DISEASE on its alteration matrix, with a
+        p-value from PERMUTATIONS permutations of the altered samples of each gene"""
+        gene_names = _get_kqml_names(content.get('GENES'))
+        if not gene_names:
+            return self.make_failure('MISSING_MECHANISM')
+
+        disease_arg = content.get('DISEASE')
+        if not disease_arg:
+            return self.make_failure('MISSING_MECHANISM')
+
+        disease_names = _get_kqml_names(disease_arg)
+        if not disease_names:
+            return self.make_failure('INVALID_DISEASE')
+
+        disease_name = _sanitize_disase_name(disease_names[0])
+        disease_abbr = self.CA.get_tcga_abbr(disease_name)
+        if disease_abbr is None:
+            return self.make_failure('INVALID_DISEASE')
+
+        try:
+            if not 2 <= len(gene_names) <= self.max_mutex_genes:
+                raise ValueError('GENES needs 2 to %d genes' % self.max_mutex_genes)
+            permutations = content.gets('PERMUTATIONS')
+            permutations = int(permutations) if permutations else default_permutations
+            if not 1 <= permutations <= self.max_mutex_permutations:
+                raise ValueError('PERMUTATIONS needs to be between 1 and %d' % self.max_mutex_permutations)
+        except ValueError:
+            return self.make_failure('INVALID_ARGUMENT')
+
+        result = self.CA.score_mutex(gene_names, disease_abbr, permutations)
+        if result is None:
+            return self.make_failure('NO_ALTERATION_DATA')
+
+        reply = KQMLList('SUCCESS')
+        reply.set('group', KQMLList(result['genes']))
+        reply.set('alterations', KQMLList([KQMLString(str(count)) for count in result['alterations']]))
+        reply.sets('samples', str(result['samples']))
+        reply.sets('coverage', str(result['coverage']))
+        reply.sets('overlap', str(result['overlap']))
+        reply.sets('p-value', '%.4g' % result['p_value'])
+
+        return reply
+
 
 
     def respond_find_cellular_location_from_names(self, content):
@@ -436,6 +861,16 @@ class CausalityModule(Bioagent):
 
         return reply
 
+def _get_latency_kqml(stats):
+    """Given latency statistics in milliseconds returns them as a kqml list"""
+    latency = KQMLList()
+    latency.sets('count', str(stats['count']))
+    for key in ['mean', 'p50', 'p95', 'p99', 'max']:
+        latency.sets(key, '%.3f' % stats[key])
+    return latency
+
+
+@timed('parse')
 def _get_kqml_names(kqmlList):
     """Given a kqml list returns the names of sublists in the list"""
     if not kqmlList:
@@ -453,14 +888,86 @@ def _get_kqml_names(kqmlList):
     return res
 
 
+def _get_page(content, default_limit):
+    """Given a request returns its (offset, limit) paging arguments"""
+    offset = content.gets('OFFSET')
+    limit = content.gets('LIMIT')
+
+    offset = int(offset) if offset else 0
+    limit = int(limit) if limit else default_limit
+
+    if offset < 0 or limit < 1:
+        raise ValueError('Invalid page offset %d or limit %d' % (offset, limit))
+
+    return offset, limit
+
+
+def _get_steps(content, max_steps):
+    """Given a neighborhood request returns its number of steps, 1 by default"""
+    steps = content.gets('STEPS')
+    steps = int(steps) if steps else 1
+    if not 1 <= steps <= max_steps:
+        raise ValueError('STEPS needs to be between 1 and %d' % max_steps)
+    return steps
+
+
+def _get_relations(content):
+    """Given a neighborhood request returns its list of relation names, None when it has none"""
+    rels_arg = content.get('RELATIONS')
+    if not rels_arg:
+        return None
+    if not isinstance(rels_arg, KQMLList):
+        return [rels_arg.string_value()]
+    return [rel.string_value() for rel in rels_arg.data]
+
+
+def _get_correlation_pair(pair):
+    """Given a (gene1 site1 gene2 site2) kqml list returns it as a tuple, NIL sites become None"""
+    if not isinstance(pair, KQMLList) or len(pair) != 4:
+        raise ValueError('A pair needs two genes and their sites')
+
+    gene1, site1, gene2, site2 = [item.string_value() for item in pair.data]
+    return (gene1, None if site1.upper() == 'NIL' else site1,
+            gene2, None if site2.upper() == 'NIL' else site2)
+
+
+def _chunk_provenance_links(links, max_links, max_chars):
+    """Splits (title, pc_url) pairs into chunks under the given size caps.
+    A single link longer than max_chars still gets a chunk of its own."""
+    chunk = []
+    chunk_chars = 0
+    for title, pc_url in links:
+        link_chars = len(title) + len(pc_url)
+        if chunk and (len(chunk) >= max_links or chunk_chars + link_chars > max_chars):
+            yield chunk
+            chunk = []
+            chunk_chars = 0
+        chunk.append((title, pc_url))
+        chunk_chars += link_chars
+
+    if chunk:
+        yield chunk
+
+
 def _sanitize_disase_name(name):
     """Given a disease name returns the sanitized version of it"""
     sanitized_name = name.replace("-", " ").lower()
     return sanitized_name
 
 
+# Agent names of the EKBs parsed recently, the same entities are mentioned
+# again and again in a dialogue
+_term_name_cache = TermNameCache(maxsize=1024)
+
+
+@timed('parse')
 def _get_term_names(term_str):
     """Given an ekb-xml returns the names of genes in a list"""
+    return _term_name_cache.get(term_str, _parse_term_names)
+
+
+def _parse_term_names(term_str):
+    """Parses an ekb-xml and returns the names of genes in a list"""
 
     tp = TripsProcessor(term_str)
     terms = tp.tree.findall('TERM')
@@ -490,7 +997,7 @@ def make_indra_json(causality):
     """Convert causality response to indra format
         Causality format is (id1, res1, pos1, id2,res2, pos2, rel)"""
 
-    causality['rel'] = causality['rel'].upper()
+    rel = causality['rel'].upper()
 
     indra_relation_map = {
         "PHOSPHORYLATES": "Phosphorylation",
@@ -502,10 +1009,10 @@ def make_indra_json(causality):
         "EXPRESSION-IS-DOWNREGULATED-BY": "DecreaseAmount"
     }
 
-    rel_type = indra_relation_map[causality['rel']]
+    rel_type = indra_relation_map[rel]
 
-    s, t = ('2', '1') if 'IS' in causality['rel'] else ('1', '2')
-    subj, obj = ('enz', 'sub') if 'PHOSPHO' in causality['rel'] else \
+    s, t = ('2', '1') if 'IS' in rel else ('1', '2')
+    subj, obj = ('enz', 'sub') if 'PHOSPHO' in rel else \
                 ('subj', 'obj')
 
     # if "PHOSPHO" in causality['rel']:  # phosphorylation
@@ -518,19 +1025,47 @@ def make_indra_json(causality):
 
     return indra_json
 
+def _with_new_stmt_id(stmt_cljson):
+    """Copies the top level of a statement's CL-JSON and gives it a new statement id"""
+    data = list(stmt_cljson.data)
+    # Keywords and their values alternate
+    for i in range(0, len(data) - 1, 2):
+        if isinstance(data[i], KQMLToken) and data[i].to_string().lower() == ':id':
+            data[i + 1] = KQMLString(str(uuid.uuid4()))
+            break
+    return KQMLList(data)
+
+@timed('serialize')
 def _get_default_list_cljson(names):
-    agents = list(map(lambda n: Agent(n), names))
+    agents = list(map(lambda n: _get_default_agent(n), names))
     return Bioagent.make_cljson(agents)
 
-def _get_genes_cljson(gene_names):
-    agents = list(map(lambda n: _get_agent_from_gene_name(n), gene_names))
+def _get_default_agent(name):
+    # A new agent each time, callers may change its name or db_refs
+    return Agent(name)
+
+@timed('serialize')
+def _get_genes_cljson(gene_names, gene_refs=None):
+    agents = list(map(lambda n: _get_agent_from_gene_name(n, gene_refs), gene_names))
     return Bioagent.make_cljson(agents)
 
-def _get_agent_from_gene_name(gene_name):
+def _get_agent_from_gene_name(gene_name, gene_refs=None):
+    """Given a gene name returns an agent with its HGNC and UniProt ids.
+    The ids are looked up in gene_refs, genes that are not in the database
+    are resolved through hgnc_client"""
+    if gene_refs is not None and gene_name in gene_refs:
+        db_refs = dict(gene_refs[gene_name])
+    else:
+        db_refs = dict(_get_db_refs(gene_name))
+
+    agent = Agent(gene_name, db_refs=db_refs)
+    return agent
+
+@functools.lru_cache(maxsize=4096)
+def _get_db_refs(gene_name):
     db_refs = {}
     hgnc_id = hgnc_client.get_hgnc_id(gene_name)
 
-
     if hgnc_id:
         db_refs['HGNC'] = hgnc_id
 
@@ -538,8 +1073,7 @@ def _get_agent_from_gene_name(gene_name):
         if uniprot_id:
             db_refs['UP'] = uniprot_id
 
-    agent = Agent(gene_name, db_refs=db_refs)
-    return agent
+    return db_refs
 
 
 
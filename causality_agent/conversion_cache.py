@@ -0,0 +1,122 @@
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class EdgeConversionCache:
+    """ Keeps the CL-JSON fragment of each causal edge that has been served.
+    Fragments are shared between replies and must not be modified."""
+
+    def __init__(self, convert, maxsize=20000):
+        """
+        :param convert: Function that converts a causality object into its CL-JSON fragment
+        :param maxsize: Maximum number of edges to keep, least recently used ones are dropped first
+        """
+        self.convert = convert
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+        self._fragments = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._fragments)
+
+    @staticmethod
+    def get_edge_key(causality):
+        """
+        Gets the identity of the causality row an object was made from
+        :param causality:
+        :return: hashable key
+        """
+        sites1 = tuple((mod['residue'], mod['position']) for mod in causality['mods1'])
+        sites2 = tuple((mod['residue'], mod['position']) for mod in causality['mods2'])
+        return causality['id1'], sites1, causality['id2'], sites2, causality['rel'].upper()
+
+    def get(self, causality):
+        """
+        Gets the CL-JSON fragment of a causality object, converting it on the first request
+        :param causality:
+        :return:
+        """
+        key = self.get_edge_key(causality)
+
+        with self._lock:
+            fragment = self._fragments.get(key)
+            if fragment is not None:
+                self._fragments.move_to_end(key)
+                self.hits += 1
+                return fragment
+
+        fragment = self.convert(causality)
+
+        with self._lock:
+            self.misses += 1
+            self._fragments[key] = fragment
+            if len(self._fragments) > self.maxsize:
+                self._fragments.popitem(last=False)
+
+        return fragment
+
+    def get_all(self, causalities):
+        """
+        Gets the CL-JSON fragments of a list of causality objects in the same order
+        :param causalities:
+        :return: list of fragments
+        """
+        return [self.get(causality) for causality in causalities]
+
+    def clear(self):
+        with self._lock:
+            self._fragments.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+class TermNameCache:
+    """ Keeps the agent names extracted from recently parsed EKB strings,
+    keyed by the SHA-1 of the EKB string"""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        # Seconds spent parsing the EKBs that were not in the cache
+        self.parse_time = 0.0
+
+        self._names = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._names)
+
+    def get(self, term_str, parse):
+        """
+        Gets the agent names of an EKB string, parsing it only if it is not in the cache
+        :param term_str: EKB-XML string
+        :param parse: Function that returns the agent names of an EKB string or None
+        :return: list of agent names or None
+        """
+        key = hashlib.sha1(term_str.encode('utf-8')).digest()
+
+        with self._lock:
+            if key in self._names:
+                self._names.move_to_end(key)
+                self.hits += 1
+                names = self._names[key]
+                return list(names) if names is not None else None
+
+        start = time.perf_counter()
+        names = parse(term_str)
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            self.misses += 1
+            self.parse_time += elapsed
+            self._names[key] = tuple(names) if names is not None else None
+            if len(self._names) > self.maxsize:
+                self._names.popitem(last=False)
+
+        return names
@@ -0,0 +1,380 @@
+"""Computes the Correlations table from a raw abundance matrix.
+
+The input is a tab-delimited matrix with one row per sample and one column
+per (gene, site) feature, named like PNNL-ovarian-correlations.txt entries
+(e.g. AKT1-S473s). Pairwise Pearson or Spearman correlations are computed
+tile by tile with NumPy matrix products, so memory stays bounded for tens of
+thousands of features. For Pearson correlations, a feature with missing values
+is correlated with each other one over the samples where both are observed.
+Spearman correlations need a matrix without missing values. Pairs that pass the
+p-value or Benjamini-Hochberg FDR threshold are written into Correlations
+(or a PNNL-format text file).
+
+    python -m causality_agent.correlation_pipeline abundances.tsv --method spearman --fdr 0.05
+
+Requires numpy and scipy.
+"""
+import os
+import time
+import logging
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import special, stats
+
+from .readers import read_lines
+
+
+logger = logging.getLogger('CausalA')
+
+_resource_dir = os.path.dirname(os.path.realpath(__file__)) + '/resources/'
+
+_missing_values = {'', 'NA', 'NAN', 'NULL', 'N/A'}
+
+
+def read_abundance_matrix(matrix_file, features_in_rows=False):
+    """
+    Reads a tab-delimited abundance matrix
+    :param matrix_file: Lines of the matrix, the first row and first column hold the names
+    :param features_in_rows: True if rows are features and columns are samples
+    :return: (feature names, float64 array of samples x features with NaN for missing values)
+    """
+    header = next(matrix_file).rstrip('\r\n').split('\t')
+    names = []
+    rows = []
+    for line in matrix_file:
+        vals = line.rstrip('\r\n').split('\t')
+        if len(vals) < 2:
+            continue
+        names.append(vals[0])
+        rows.append([float('nan') if v.strip().upper() in _missing_values else float(v) for v in vals[1:]])
+
+    matrix = np.array(rows, dtype=np.float64)
+    if features_in_rows:
+        return names, matrix.T.copy()
+    return header[1:], matrix
+
+
+def split_feature_name(name):
+    """
+    :param name: Feature name like AKT1-S473s
+    :return: (gene, site) as stored in Correlations, ' ' when there is no site
+    """
+    id_str = name.upper().split('-')
+    return id_str[0], id_str[1] if len(id_str) > 1 else ' '
+
+
+def standardize(matrix, method='pearson'):
+    """
+    Scales the columns so that the dot product of two columns is their correlation
+    :param matrix: samples x features
+    :param method: 'pearson' or 'spearman'
+    :return: float64 array of samples x features
+    """
+    if method == 'spearman':
+        matrix = stats.rankdata(matrix, axis=0)
+    elif method != 'pearson':
+        raise ValueError('Unknown correlation method %s' % method)
+
+    centered = matrix - matrix.mean(axis=0)
+    norms = np.sqrt((centered * centered).sum(axis=0))
+    return centered / norms
+
+
+def correlation_p_values(r, n):
+    """
+    Two-sided p-values of correlation coefficients from the t distribution
+    :param r: Array of correlations
+    :param n: Number of samples
+    :return:
+    """
+    df = n - 2
+    r = np.clip(r, -1.0, 1.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.abs(r) * np.sqrt(df / np.maximum(1.0 - r * r, 1e-300))
+    return 2.0 * special.stdtr(df, -t)
+
+
+class _Standardized:
+    """ Features without missing values, scaled so that the dot product of two is their correlation"""
+
+    def __init__(self, values, method):
+        self.z = np.ascontiguousarray(standardize(values, method))
+        self.n = values.shape[0]
+
+    def correlate(self, start1, end1, start2, end2):
+        """
+        :return: (correlations, sample counts) of a block of features with another
+        """
+        return self.z[:, start1:end1].T @ self.z[:, start2:end2], self.n
+
+
+class _PairwiseComplete:
+    """ Features with missing values, each pair is Pearson correlated over the samples where both are observed"""
+
+    def __init__(self, values, min_samples):
+        observed = np.isfinite(values)
+
+        # Centering by the observed mean keeps the sums below small
+        counts = observed.sum(axis=0)
+        means = np.where(observed, values, 0.0).sum(axis=0) / counts
+        self.x = np.ascontiguousarray(np.where(observed, values - means, 0.0))
+        self.xx = self.x * self.x
+        self.m = observed.astype(np.float64)
+        self.min_samples = min_samples
+
+    def correlate(self, start1, end1, start2, end2):
+        """
+        :return: (correlations, sample counts) of a block of features with another, NaN for the
+        pairs with fewer than min_samples common samples or no variance over them
+        """
+        x1, m1, xx1 = self.x[:, start1:end1], self.m[:, start1:end1], self.xx[:, start1:end1]
+        x2, m2, xx2 = self.x[:, start2:end2], self.m[:, start2:end2], self.xx[:, start2:end2]
+
+        n = m1.T @ m2
+        sum1 = x1.T @ m2
+        sum2 = m1.T @ x2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cov = x1.T @ x2 - sum1 * sum2 / n
+            var1 = xx1.T @ m2 - sum1 * sum1 / n
+            var2 = m1.T @ xx2 - sum2 * sum2 / n
+            r = cov / np.sqrt(var1 * var2)
+        r[(n < self.min_samples) | ~(var1 > 0) | ~(var2 > 0)] = np.nan
+        return r, n
+
+
+def _compute_tile(data, start1, end1, start2, end2, p_cutoff, min_abs_corr):
+    """
+    Correlates a block of features with another and keeps the pairs under the cutoffs
+    :return: (rows, cols, correlations, p-values, number of pairs tested)
+    """
+    r, n = data.correlate(start1, end1, start2, end2)
+
+    tested = np.isfinite(r)
+    if start1 == start2:
+        # Each pair once, without the diagonal
+        tested &= np.triu(np.ones(r.shape, dtype=bool), k=1)
+
+    with np.errstate(invalid='ignore'):
+        mask = tested & (np.abs(r) >= min_abs_corr)
+    rows, cols = np.nonzero(mask)
+    corr = r[rows, cols]
+    p_vals = correlation_p_values(corr, n[rows, cols] if np.ndim(n) else n)
+
+    keep = p_vals <= p_cutoff
+    return ((rows[keep] + start1).astype(np.int32), (cols[keep] + start2).astype(np.int32),
+            corr[keep], p_vals[keep], int(tested.sum()))
+
+
+def _run_tiles(data, tiles, p_cutoff, min_abs_corr, workers):
+    """Computes the tiles on a thread pool and yields their results in tile order"""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Keep a few tiles ahead of the consumer so finished tiles don't pile up
+        pending = deque()
+        tile_iter = iter(tiles)
+
+        def submit_next():
+            tile = next(tile_iter, None)
+            if tile is not None:
+                pending.append(executor.submit(_compute_tile, data, *tile, p_cutoff, min_abs_corr))
+
+        for _ in range(2 * workers):
+            submit_next()
+
+        while pending:
+            result = pending.popleft().result()
+            submit_next()
+            yield result
+
+
+# Benjamini-Hochberg p-value buckets, log-spaced from fdr * 1e-310 to fdr. The pairs of the
+# few buckets around the cutoff are the only ones held in memory.
+_bh_bucket_cnt = 1 << 16
+_bh_decades = 310
+
+
+def compute_correlations(matrix, method='pearson', p_threshold=None, fdr=None, min_abs_corr=0.0,
+                         block_size=2048, workers=None, min_samples=3):
+    """
+    Computes pairwise correlations tile by tile and yields the significant pairs.
+    With Pearson correlations, features with missing values are correlated over the
+    samples they share with each other feature. Spearman correlations need features
+    without missing values. The arguments are checked before the first pair is
+    computed. Without fdr, pairs are yielded tile by tile as soon as they
+    pass p_threshold. With fdr, the Benjamini-Hochberg cutoff over all tested pairs
+    is found in two passes over the tiles, so memory doesn't grow with the number
+    of significant pairs: the first counts the p-values in fine buckets, the second
+    yields the pairs of the buckets that surely pass and finds the exact cutoff among
+    those of the few buckets around it, which are yielded last in p-value order.
+    :param matrix: samples x features, NaN for a missing value
+    :param method: 'pearson' or 'spearman'
+    :param p_threshold: Largest p-value to keep
+    :param fdr: Benjamini-Hochberg false discovery rate
+    :param min_abs_corr: Smallest absolute correlation to keep
+    :param block_size: Number of features per tile
+    :param workers: Number of threads computing tiles, the number of cores by default
+    :param min_samples: Smallest number of samples a pair is correlated over, at least 3
+    :return: generator of (feature index 1, feature index 2, correlation, p-value)
+    """
+    if method not in ('pearson', 'spearman'):
+        raise ValueError('Unknown correlation method %s' % method)
+    min_samples = max(min_samples, 3)
+    if matrix.shape[0] < min_samples:
+        raise ValueError('At least %d samples are needed, got %d' % (min_samples, matrix.shape[0]))
+
+    observed = np.isfinite(matrix)
+    usable = observed.sum(axis=0) >= min_samples
+    usable[usable] = np.nanstd(matrix[:, usable], axis=0) > 0
+    if not usable.all():
+        logger.info('Skipping %d features with fewer than %d values or no variance' %
+                    ((~usable).sum(), min_samples))
+    features = np.nonzero(usable)[0]
+
+    values = matrix[:, features]
+    if observed[:, features].all():
+        data = _Standardized(values, method)
+    elif method == 'spearman':
+        # Ranks over the samples a pair shares would differ for each pair, so the tiles can't be matrix products
+        raise ValueError('Spearman correlations need features without missing values, %d features have some'
+                         % (~observed[:, features].all(axis=0)).sum())
+    else:
+        data = _PairwiseComplete(values, min_samples)
+    feature_cnt = len(features)
+
+    p_cutoff = 1.0
+    if p_threshold is not None:
+        p_cutoff = p_threshold
+    if fdr is not None:
+        p_cutoff = min(p_cutoff, fdr)
+
+    starts = list(range(0, feature_cnt, block_size))
+    tiles = [(s1, min(s1 + block_size, feature_cnt), s2, min(s2 + block_size, feature_cnt))
+             for i, s1 in enumerate(starts) for s2 in starts[i:]]
+
+    workers = workers or os.cpu_count() or 1
+    return _significant_pairs(data, features, tiles, p_cutoff, fdr, min_abs_corr, workers)
+
+
+def _significant_pairs(data, features, tiles, p_cutoff, fdr, min_abs_corr, workers):
+    """
+    :return: generator of the pairs passing the thresholds, as compute_correlations describes
+    """
+    if fdr is None:
+        for rows, cols, corr, p_vals, _ in _run_tiles(data, tiles, p_cutoff, min_abs_corr, workers):
+            for i, j, r, p in zip(features[rows], features[cols], corr, p_vals):
+                yield int(i), int(j), float(r), float(p)
+        return
+
+    # First pass, the number of tested pairs and of the candidates in each bucket
+    edges = fdr * np.logspace(-_bh_decades, 0, _bh_bucket_cnt)
+    counts = np.zeros(_bh_bucket_cnt, dtype=np.int64)
+    tested = 0
+    for _, _, _, p_vals, tile_tested in _run_tiles(data, tiles, p_cutoff, min_abs_corr, workers):
+        counts += np.bincount(np.searchsorted(edges, p_vals), minlength=_bh_bucket_cnt)
+        tested += tile_tested
+    if not tested:
+        return
+
+    # A pair of rank k passes when its p-value is at most k * fdr / tested. A bucket may hold
+    # the cutoff if its lower edge is under that bound for its largest rank, and all its
+    # pairs pass if its upper edge is.
+    ranks = np.cumsum(counts)
+    bounds = ranks * fdr / tested
+    lower_edges = np.concatenate([[0.0], edges[:-1]])
+    possible = np.nonzero((counts > 0) & (lower_edges < bounds))[0]
+    if len(possible) == 0:
+        return
+    last_bucket = possible[-1]
+    sure = np.nonzero((counts[:last_bucket + 1] > 0) & (edges[:last_bucket + 1] <= bounds[:last_bucket + 1]))[0]
+    sure_bucket = sure[-1] if len(sure) else -1
+
+    # Second pass, yields the pairs up to sure_bucket and keeps those up to last_bucket
+    undecided = []
+    for rows, cols, corr, p_vals, _ in _run_tiles(data, tiles, p_cutoff, min_abs_corr, workers):
+        buckets = np.searchsorted(edges, p_vals)
+        passed = buckets <= sure_bucket
+        for i, j, r, p in zip(features[rows[passed]], features[cols[passed]], corr[passed], p_vals[passed]):
+            yield int(i), int(j), float(r), float(p)
+
+        kept = ~passed & (buckets <= last_bucket)
+        if kept.any():
+            undecided.append((rows[kept], cols[kept], corr[kept], p_vals[kept]))
+
+    if not undecided:
+        return
+
+    rows, cols, corr, p_vals = (np.concatenate(arrs) for arrs in zip(*undecided))
+    order = np.argsort(p_vals, kind='stable')
+    first_rank = ranks[sure_bucket] if sure_bucket >= 0 else 0
+    passed = np.nonzero(p_vals[order] <= (first_rank + np.arange(1, len(order) + 1)) * fdr / tested)[0]
+    if len(passed) == 0:
+        return
+
+    for k in order[:passed[-1] + 1]:
+        yield int(features[rows[k]]), int(features[cols[k]]), float(corr[k]), float(p_vals[k])
+
+
+def to_correlation_rows(names, pairs):
+    """
+    :param names: Feature names
+    :param pairs: (feature index 1, feature index 2, correlation, p-value)
+    :return: generator of Correlations rows (id1, p_site1, id2, p_site2, corr, p_val)
+    """
+    split_names = [split_feature_name(name) for name in names]
+    for i, j, r, p in pairs:
+        id1, p_site1 = split_names[i]
+        id2, p_site2 = split_names[j]
+        yield id1, p_site1, id2, p_site2, r, p
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compute the Correlations table from a raw abundance matrix')
+    parser.add_argument('matrix', help='tab-delimited samples x features matrix, may be gzip, bzip2 or xz compressed')
+    parser.add_argument('--features-in-rows', action='store_true', help='the matrix has one row per feature')
+    parser.add_argument('--method', choices=['pearson', 'spearman'], default='pearson')
+    parser.add_argument('--p-value', type=float, default=None, help='largest p-value to keep')
+    parser.add_argument('--fdr', type=float, default=None, help='Benjamini-Hochberg false discovery rate')
+    parser.add_argument('--min-corr', type=float, default=0.0, help='smallest absolute correlation to keep')
+    parser.add_argument('--min-samples', type=int, default=3,
+                        help='smallest number of samples two features are both observed in')
+    parser.add_argument('--block-size', type=int, default=2048, help='features per tile')
+    parser.add_argument('--workers', type=int, default=None, help='threads computing tiles')
+    parser.add_argument('--output', help='write PNNL-format lines to this file instead of the database')
+    parser.add_argument('--resources', default=_resource_dir, help='folder with the database')
+    args = parser.parse_args(argv)
+
+    if args.p_value is None and args.fdr is None:
+        parser.error('give --p-value and/or --fdr')
+
+    logging.basicConfig(format='%(levelname)s: %(name)s - %(message)s', level=logging.INFO)
+
+    start = time.time()
+    names, matrix = read_abundance_matrix(read_lines(args.matrix), args.features_in_rows)
+    logger.info('Read %d samples x %d features in %.1f s' % (matrix.shape[0], matrix.shape[1], time.time() - start))
+
+    try:
+        pairs = compute_correlations(matrix, args.method, args.p_value, args.fdr, args.min_corr,
+                                     args.block_size, args.workers, args.min_samples)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            for i, j, r, p in pairs:
+                output_file.write('%s\t%s\t%r\t%r\n' % (names[i], names[j], r, p))
+    else:
+        from .database_initializer import DatabaseInitializer
+        db_initializer = DatabaseInitializer(args.resources)
+        db_initializer.populate_correlation_table_from_pairs(to_correlation_rows(names, pairs))
+        # The explained and unexplained correlations depend on the new table
+        db_initializer.populate_explained_correlations()
+        db_initializer.populate_network_explanations()
+        db_initializer.populate_gene_refs()
+
+    logger.info('Computed correlations in %.1f s' % (time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
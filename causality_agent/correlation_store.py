@@ -0,0 +1,148 @@
+"""Columnar in-memory copy of the Correlations table for threshold and top-K queries.
+
+Each column is one numpy array indexed by the position of the correlation in
+Correlations. The site strings are kept once in a table and referenced by
+index. The correlations of a gene, as either end of the pair, are listed by a
+CSR index sorted by descending absolute correlation, so the strongest ones of
+a gene passing a threshold are a prefix of its slice after a boolean mask. The
+strongest correlations overall are selected with np.argpartition.
+
+Requires numpy.
+"""
+import numpy as np
+
+
+# Rows read from Correlations at a time
+_fetch_size = 100000
+
+
+class CorrelationStore:
+    """ Correlations as numpy columns with a per-gene index sorted by strength"""
+
+    def __init__(self, columns, p_sites):
+        """
+        :param columns: dict of the arrays id1, site1, id2, site2, p_site1, p_site2, corr, p_val and explained
+        :param p_sites: Site strings, indexed by the p_site1 and p_site2 columns
+        """
+        self.id1 = columns['id1']
+        self.site1 = columns['site1']
+        self.id2 = columns['id2']
+        self.site2 = columns['site2']
+        self.p_site1 = columns['p_site1']
+        self.p_site2 = columns['p_site2']
+        self.corr = columns['corr']
+        self.p_val = columns['p_val']
+        self.explained = columns['explained']
+        self.p_sites = list(p_sites)
+
+        self.strength = np.abs(self.corr)
+
+        # Correlations of gene i are gene_rows[gene_offsets[i]:gene_offsets[i + 1]], strongest first
+        node_cnt = int(max(self.id1.max(initial=-1), self.id2.max(initial=-1))) + 1
+        genes = np.concatenate([self.id1, self.id2]).astype(np.int64)
+        rows = np.tile(np.arange(len(self), dtype=np.int32), 2)
+        # Self correlations are listed once
+        keep = np.concatenate([np.ones(len(self), dtype=bool), self.id1 != self.id2])
+        genes = genes[keep]
+        rows = rows[keep]
+        order = np.lexsort((rows, -self.strength[rows], genes))
+        self.gene_rows = rows[order]
+        self.gene_offsets = np.zeros(node_cnt + 1, dtype=np.int64)
+        np.cumsum(np.bincount(genes, minlength=node_cnt), out=self.gene_offsets[1:])
+
+    @classmethod
+    def from_database(cls, cadb):
+        """
+        Reads the Correlations table in rowid order
+        :param cadb: Connection to the database
+        :return:
+        """
+        p_sites = []
+        p_site_ids = {}
+        int_chunks = []
+        float_chunks = []
+        with cadb:
+            cur = cadb.cursor()
+            cur.execute("SELECT Id1, Site1, Id2, Site2, PSite1, PSite2, Corr, PVal, Explained "
+                        "FROM Correlations ORDER BY rowid")
+            while True:
+                rows = cur.fetchmany(_fetch_size)
+                if not rows:
+                    break
+
+                ints = np.empty((len(rows), 7), dtype=np.int64)
+                floats = np.empty((len(rows), 2), dtype=np.float64)
+                for i, (id1, site1, id2, site2, p_site1, p_site2, corr, p_val, explained) in enumerate(rows):
+                    p_site_id1 = p_site_ids.get(p_site1)
+                    if p_site_id1 is None:
+                        p_site_id1 = p_site_ids[p_site1] = len(p_sites)
+                        p_sites.append(p_site1)
+                    p_site_id2 = p_site_ids.get(p_site2)
+                    if p_site_id2 is None:
+                        p_site_id2 = p_site_ids[p_site2] = len(p_sites)
+                        p_sites.append(p_site2)
+                    ints[i] = (id1, site1, id2, site2, p_site_id1, p_site_id2, explained)
+                    floats[i] = (corr, p_val)
+                int_chunks.append(ints)
+                float_chunks.append(floats)
+
+        ints = np.concatenate(int_chunks) if int_chunks else np.empty((0, 7), dtype=np.int64)
+        floats = np.concatenate(float_chunks) if float_chunks else np.empty((0, 2), dtype=np.float64)
+        columns = {'id1': ints[:, 0].astype(np.int32), 'site1': ints[:, 1].copy(),
+                   'id2': ints[:, 2].astype(np.int32), 'site2': ints[:, 3].copy(),
+                   'p_site1': ints[:, 4].astype(np.int32), 'p_site2': ints[:, 5].astype(np.int32),
+                   'corr': floats[:, 0].copy(), 'p_val': floats[:, 1].copy(),
+                   'explained': ints[:, 6].astype(bool)}
+        return cls(columns, p_sites)
+
+    def __len__(self):
+        return len(self.corr)
+
+    def _passes(self, rows, max_p, min_corr):
+        mask = np.ones(len(rows), dtype=bool)
+        if max_p is not None:
+            mask &= self.p_val[rows] < max_p
+        if min_corr is not None:
+            mask &= self.strength[rows] >= min_corr
+        return mask
+
+    @staticmethod
+    def _check_k(k):
+        if k is not None and k < 1:
+            raise ValueError('The number of correlations needs to be positive, got %d' % k)
+
+    def gene_top(self, gene_id, k=None, max_p=None, min_corr=None):
+        """
+        :param gene_id: Gene id, as either end of the correlations
+        :param k: Largest number of correlations, at least 1, all if None
+        :param max_p: Only correlations with a smaller p-value if given
+        :param min_corr: Only correlations at least this strong, in absolute value, if given
+        :return: int array of correlation positions, strongest first
+        """
+        self._check_k(k)
+        if gene_id is None or not 0 <= gene_id < len(self.gene_offsets) - 1:
+            return np.empty(0, dtype=np.int32)
+
+        rows = self.gene_rows[self.gene_offsets[gene_id]:self.gene_offsets[gene_id + 1]]
+        if max_p is not None or min_corr is not None:
+            rows = rows[self._passes(rows, max_p, min_corr)]
+        return rows[:k]
+
+    def top(self, k=None, max_p=None, min_corr=None):
+        """
+        :param k: Largest number of correlations, at least 1, all if None
+        :param max_p: Only correlations with a smaller p-value if given
+        :param min_corr: Only correlations at least this strong, in absolute value, if given
+        :return: int array of correlation positions, strongest first
+        """
+        self._check_k(k)
+        rows = np.arange(len(self), dtype=np.int32)
+        if max_p is not None or min_corr is not None:
+            rows = rows[self._passes(rows, max_p, min_corr)]
+        if k is not None and k < len(rows):
+            # The k-th strongest and all ties with it, so the order below is the same as a full sort
+            strength = self.strength[rows]
+            kth = -np.partition(-strength, k - 1)[k - 1]
+            rows = rows[strength >= kth]
+        order = np.lexsort((rows, -self.strength[rows]))
+        return rows[order][:k]
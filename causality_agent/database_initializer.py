@@ -1,6 +1,11 @@
 import os
 import sqlite3
 from bioagents import BioagentException
+from .profiling import TimedConnection
+from .sites import encode_site_str
+from .readers import read_lines
+from .sif_graph import SifGraph, snapshot_file_name
+from indra.databases import hgnc_client
 import csv
 
 
@@ -12,27 +17,128 @@ loc_list = ['GO_ENDOPLASMIC_RETICULUM', 'GO_EXTRACELLULAR_MATRIX', 'GO_MITOCHOND
             'GO_NUCLEAR_OUTER_MEMBRANE', 'GO_CYTOPLASMIC_REGION', 'GO_ENDOLYSOSOME', 'GO_CYTOSKELETON',
             'GO_LATERAL_PLASMA_MEMBRANE', 'GO_CELL_CORTEX', 'GO_CELL_BODY', 'GO_ENDOSOME']
 
+# Causal relations are stored once, from source to target. Read from the target,
+# a relation is the opposite one.
+opposite_rel = {
+    'phosphorylates': 'is-phosphorylated-by',
+    'dephosphorylates': 'is-dephosphorylated-by',
+    'upregulates-expression': 'expression-is-upregulated-by',
+    'downregulates-expression': 'expression-is-downregulated-by',
+    'activates': 'is-activated-by',
+    'inhibits': 'is-inhibited-by',
+}
+
+
+def _opposite_rel_sql(column):
+    """
+    :param column: Relation column
+    :return: SQL expression of the opposite relation
+    """
+    return "CASE " + column + " " + " ".join("WHEN '%s' THEN '%s'" % item for item in opposite_rel.items()) + " END"
+
+
 class DatabaseInitializer:
     """ Fills the pnnl database from the given data files"""
 
-    def __init__(self, path):
+    # Stored in the database file, which is rebuilt when it was made for an older schema
+    schema_version = 6
+
+    def __init__(self, path, read_only=False, profile_sql=False):
+        """
+        :param path: Folder of the data files and the database
+        :param read_only: Opens the database read-only and never rebuilds it
+        :param profile_sql: Opens connections that record their statements for the request profiler
+        """
         db_file = os.path.join(path, 'causality-dataset.db')
+        self.db_file = db_file
+        self.sif_graph_file = os.path.join(path, snapshot_file_name)
+        self.read_only = read_only
+        self.profile_sql = profile_sql
 
+        # Gene symbol to id, read from the Gene table when the first gene is interned
+        self._gene_ids = None
+        # Evidence uri list to id, read from the Evidence table in the same way
+        self._evidence_ids = None
 
         if os.path.isfile(db_file):
-            self.cadb = sqlite3.connect(db_file)
+            self.cadb = self.connect()
+            if not read_only and self.get_schema_version() < self.schema_version:
+                self.populate_tables(path)
         else:
             # create table if it doesn't exist
             fp = open(db_file, 'w')
             fp.close()
-            self.cadb = sqlite3.connect(db_file)
+            self.cadb = self.connect()
             self.populate_tables(path)
 
+    def connect(self):
+        """
+        Opens a new connection to the database, e.g. for a worker thread
+        :return:
+        """
+        factory = TimedConnection if self.profile_sql else sqlite3.Connection
+        if self.read_only:
+            return sqlite3.connect('file:' + self.db_file + '?mode=ro', uri=True, factory=factory)
+        return sqlite3.connect(self.db_file, factory=factory)
+
 
     def __del__(self):
         return
         self.cadb.close()
 
+    def get_schema_version(self):
+        """
+        :return: Schema version the database was built with, 0 if it predates versioning
+        """
+        return self.cadb.execute("PRAGMA user_version").fetchone()[0]
+
+    def create_dictionary_tables(self):
+        """
+        Creates the dictionaries of gene symbols and evidence uris the other tables refer to by integer id
+        :return:
+        """
+        with self.cadb:
+            cur = self.cadb.cursor()
+            cur.execute("CREATE TABLE IF NOT EXISTS Gene(Id INTEGER PRIMARY KEY, Symbol TEXT UNIQUE, HGNC TEXT, UP TEXT)")
+            cur.execute("CREATE TABLE IF NOT EXISTS Evidence(Id INTEGER PRIMARY KEY, Uris TEXT UNIQUE)")
+        self._gene_ids = None
+        self._evidence_ids = None
+
+    def get_gene_id(self, symbol):
+        """
+        Interns a gene symbol, adding it to the Gene table the first time it is seen.
+        It runs in the transaction of the table being filled, on a cursor of its own.
+        :param symbol: Gene symbol as stored in the data files
+        :return: Integer id of the gene, None for None
+        """
+        if symbol is None:
+            return None
+
+        if self._gene_ids is None:
+            self._gene_ids = dict(self.cadb.execute("SELECT Symbol, Id FROM Gene").fetchall())
+
+        gene_id = self._gene_ids.get(symbol)
+        if gene_id is None:
+            gene_id = self.cadb.execute("INSERT INTO Gene(Symbol) VALUES(?)", (symbol,)).lastrowid
+            self._gene_ids[symbol] = gene_id
+        return gene_id
+
+    def get_evidence_id(self, uris):
+        """
+        Interns the evidence of a causal relation. Forward and opposite rows and the rows
+        of each site of a relation share one Evidence row.
+        :param uris: Space separated PC uris as in the data files
+        :return: Integer id of the evidence
+        """
+        if self._evidence_ids is None:
+            self._evidence_ids = dict(self.cadb.execute("SELECT Uris, Id FROM Evidence").fetchall())
+
+        evidence_id = self._evidence_ids.get(uris)
+        if evidence_id is None:
+            evidence_id = self.cadb.execute("INSERT INTO Evidence(Uris) VALUES(?)", (uris,)).lastrowid
+            self._evidence_ids[uris] = evidence_id
+        return evidence_id
+
 
 
 
@@ -40,19 +146,30 @@ class DatabaseInitializer:
     def populate_tables(self, path):
         """
         Fills all the tables in the database
-        :param path: Path to the folder that keeps all the data files
+        :param path: Path to the folder that keeps all the data files, plain or compressed with gzip, bzip2 or xz
         :return:
         """
+        with self.cadb:
+            cur = self.cadb.cursor()
+            cur.execute("DROP TABLE IF EXISTS GeneRefs")
+            cur.execute("DROP TABLE IF EXISTS Gene")
+            cur.execute("DROP TABLE IF EXISTS Evidence")
+        self.create_dictionary_tables()
+
         self.populate_correlation_table(path)
         self.populate_causality_pnnl_ovarian_table(path)
         self.populate_causality_table(path)
         self.populate_mutsig_table(path)
-        self.populate_unexplained_table()
-        self.populate_explained_table()
+        self.populate_explained_correlations()
+        self.populate_network_explanations()
         self.populate_sif_relations_table(path)
         self.populate_mutex_table(path)
         self.populate_tcga_names_table(path)
         self.populate_cellular_components_table(path)
+        self.populate_gene_refs()
+        self.populate_sif_graph()
+
+        self.cadb.execute("PRAGMA user_version = %d" % self.schema_version)
 
     def populate_causality_table(self, path):
         """
@@ -60,26 +177,18 @@ class DatabaseInitializer:
         :param path: Path to the folder that keeps causative-data-centric.sif
         :return:
         """
-        opposite_rel = {
-            'phosphorylates': 'is-phosphorylated-by',
-            'dephosphorylates': 'is-dephosphorylated-by',
-            'upregulates-expression': 'expression-is-upregulated-by',
-            'downregulates-expression': 'expression-is-downregulated-by',
-            'activates': 'is-activated-by',
-            'inhibits': 'is-inhibited-by',
-        }
-
         try:
             causality_path = os.path.join(path, 'causal-priors.txt')
         except Exception as e:
             raise BioagentException.PathNotFoundException()
 
-        causality_file = open(causality_path, 'r')
+        causality_file = read_lines(causality_path)
 
         with self.cadb:
             cur = self.cadb.cursor()
             cur.execute("DROP TABLE IF EXISTS Causality")
-            cur.execute("CREATE TABLE Causality(Id1 TEXT, PSite1 TEXT, Id2 TEXT, PSite2 TEXT, Rel TEXT, UriStr TEXT)")
+            cur.execute("CREATE TABLE Causality(Id1 INTEGER, PSite1 TEXT, Id2 INTEGER, PSite2 TEXT, Rel TEXT, EvidenceId INTEGER, "
+                        "Site1 INTEGER, Site2 INTEGER)")
 
             for line in causality_file:
                 vals = line.split('\t')
@@ -107,33 +216,30 @@ class DatabaseInitializer:
                 rel = vals[1]
                 id2 =  vals[2].upper()
 
-                uri_arr = []
-                if vals[3]:
-                    uri_arr = vals[3].split(" ")
+                gene_id1 = self.get_gene_id(id1)
+                gene_id2 = self.get_gene_id(id2)
 
-                if len(uri_arr) == 0:
-                    uri_arr = [vals[3]]
+                # The uri string is rebuilt from the evidence when provenance is sent
+                evidence_id = self.get_evidence_id(vals[3])
 
-                uri_str = ""
-                for uri in uri_arr:
-                    uri_str = uri_str + "uri= " + uri + "&"
+                if rel not in opposite_rel:
+                    raise KeyError(rel)
 
+                # The opposite relations are derived from these rows when they are read from the target
                 if len(vals) > 4:
                     p_site_str = vals[4].upper().split(';')
 
                     for p_site2 in p_site_str:
-                        opp_rel = opposite_rel[rel]
-                        cur.execute("INSERT INTO Causality VALUES(?, ?, ?, ?, ?, ?)", (id1, p_site1, id2, p_site2, rel, uri_str))
-                        # opposite relation
-                        cur.execute("INSERT INTO Causality VALUES(?, ?, ?, ?, ?, ?)", (id2, p_site2, id1, p_site1, opp_rel, uri_str))
+                        site2 = encode_site_str(p_site2)
+                        cur.execute("INSERT INTO Causality VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
+                                    (gene_id1, p_site1, gene_id2, p_site2, rel, evidence_id, 0, site2))
                 else:
                     p_site2 = ' '
-                    opp_rel = opposite_rel[rel]
-                    cur.execute("INSERT INTO Causality VALUES(?, ?, ?, ?, ?, ?)",
-                                (id1, p_site1, id2, p_site2, rel, uri_str))
-                    # opposite relation
-                    cur.execute("INSERT INTO Causality VALUES(?, ?, ?, ?, ?, ?)",
-                                (id2, p_site2, id1, p_site1, opp_rel, uri_str))
+                    cur.execute("INSERT INTO Causality VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
+                                (gene_id1, p_site1, gene_id2, p_site2, rel, evidence_id, 0, 0))
+
+            cur.execute("CREATE INDEX Causality_Key ON Causality(Id1, Site1, Id2, Site2)")
+            cur.execute("CREATE INDEX Causality_Target ON Causality(Id2, Site2, Id1, Site1)")
 
         causality_file.close()
 
@@ -143,26 +249,18 @@ class DatabaseInitializer:
         :param path: Path to the folder that keeps causative-data-centric.sif
         :return:
         """
-        opposite_rel = {
-            'phosphorylates': 'is-phosphorylated-by',
-            'dephosphorylates': 'is-dephosphorylated-by',
-            'upregulates-expression': 'expression-is-upregulated-by',
-            'downregulates-expression': 'expression-is-downregulated-by',
-            'activates': 'is-activated-by',
-            'inhibits': 'is-inhibited-by',
-        }
-
         try:
             causality_path = os.path.join(path, 'causative-data-centric.sif')
         except Exception as e:
             raise BioagentException.PathNotFoundException()
 
-        causality_file = open(causality_path, 'r')
+        causality_file = read_lines(causality_path)
 
         with self.cadb:
             cur = self.cadb.cursor()
             cur.execute("DROP TABLE IF EXISTS CausalityPNNLOvarian")
-            cur.execute("CREATE TABLE CausalityPNNLOvarian(Id1 TEXT, PSite1 TEXT, Id2 TEXT, PSite2 TEXT, Rel TEXT, UriStr TEXT)")
+            cur.execute("CREATE TABLE CausalityPNNLOvarian(Id1 INTEGER, PSite1 TEXT, Id2 INTEGER, PSite2 TEXT, Rel TEXT, EvidenceId INTEGER, "
+                        "Site1 INTEGER, Site2 INTEGER)")
 
             for line in causality_file:
                 vals = line.split('\t')
@@ -183,23 +281,21 @@ class DatabaseInitializer:
 
                 rel = vals[1]
 
-                uri_arr = []
-                if vals[3]:
-                    uri_arr = vals[3].split(" ")
+                # The uri string is rebuilt from the evidence when provenance is sent
+                evidence_id = self.get_evidence_id(vals[3])
 
-                if len(uri_arr) == 0:
-                    uri_arr = [vals[3]]
+                if rel not in opposite_rel:
+                    raise KeyError(rel)
 
-                uri_str = ""
-                for uri in uri_arr:
-                    uri_str = uri_str + "uri= " + uri + "&"
+                gene_id1 = self.get_gene_id(id1)
+                gene_id2 = self.get_gene_id(id2)
+                site1 = encode_site_str(p_site1)
+                site2 = encode_site_str(p_site2)
+                cur.execute("INSERT INTO CausalityPNNLOvarian VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
+                            (gene_id1, p_site1, gene_id2, p_site2, rel, evidence_id, site1, site2))
 
-                opp_rel = opposite_rel[rel]
-                cur.execute("INSERT INTO CausalityPNNLOvarian VALUES(?, ?, ?, ?, ?, ?)",
-                            (id1, p_site1, id2, p_site2, rel, uri_str))
-                # opposite relation
-                cur.execute("INSERT INTO CausalityPNNLOvarian VALUES(?, ?, ?, ?, ?, ?)",
-                            (id2, p_site2, id1, p_site1, opp_rel, uri_str))
+            cur.execute("CREATE INDEX CausalityPNNLOvarian_Key ON CausalityPNNLOvarian(Id1, Site1, Id2, Site2)")
+            cur.execute("CREATE INDEX CausalityPNNLOvarian_Target ON CausalityPNNLOvarian(Id2, Site2, Id1, Site1)")
 
         causality_file.close()
 
@@ -214,39 +310,62 @@ class DatabaseInitializer:
             pnnl_path = os.path.join(path, 'PNNL-ovarian-correlations.txt')
         except Exception as e:
             raise BioagentException.PathNotFoundException()
-        pnnl_file = open(pnnl_path, 'r')
+        pnnl_file = read_lines(pnnl_path)
 
-        with self.cadb:
-            cur = self.cadb.cursor()
-            cur.execute("DROP TABLE IF EXISTS Correlations")
-            cur.execute("CREATE TABLE Correlations(Id1 TEXT, PSite1 TEXT, Id2 TEXT, PSite2 TEXT, Corr REAL, PVal REAL)")
+        self.populate_correlation_table_from_pairs(self.read_correlations(pnnl_file))
 
-            for line in pnnl_file:
-                if line.find('/') > -1:  # incorrectly formatted strings
-                    continue
-                vals = line.split('\t')
-                id_str1 = vals[0].upper().split('-')
-                id1 = id_str1[0]
-                if len(id_str1) > 1:
-                    p_site1 = id_str1[1]
-                else:
-                    p_site1 = ' '
+        pnnl_file.close()
 
-                id_str2 = vals[1].upper().split('-')
-                id2 = id_str2[0]
+    @staticmethod
+    def read_correlations(pnnl_file):
+        """
+        Reads the correlations in PNNL-ovarian-correlations.txt format
+        :param pnnl_file: Lines of gene-site, gene-site, correlation and p-value
+        :return: generator of (id1, p_site1, id2, p_site2, corr, p_val)
+        """
+        for line in pnnl_file:
+            if line.find('/') > -1:  # incorrectly formatted strings
+                continue
+            vals = line.split('\t')
+            id_str1 = vals[0].upper().split('-')
+            id1 = id_str1[0]
+            if len(id_str1) > 1:
+                p_site1 = id_str1[1]
+            else:
+                p_site1 = ' '
 
-                if len(id_str2) > 1:
-                    p_site2 = id_str2[1]
-                else:
-                    p_site2 = ' '
+            id_str2 = vals[1].upper().split('-')
+            id2 = id_str2[0]
 
-                corr = float(vals[2].rstrip('\n'))
+            if len(id_str2) > 1:
+                p_site2 = id_str2[1]
+            else:
+                p_site2 = ' '
 
-                p_val = float(vals[3].rstrip('\n'))
+            corr = float(vals[2].rstrip('\n'))
 
-                cur.execute("INSERT INTO Correlations VALUES(?, ?, ?, ?, ?, ?)", (id1, p_site1, id2, p_site2, corr, p_val))
+            p_val = float(vals[3].rstrip('\n'))
 
-        pnnl_file.close()
+            yield id1, p_site1, id2, p_site2, corr, p_val
+
+    def populate_correlation_table_from_pairs(self, pairs):
+        """
+        Fills the correlation table from correlated pairs, e.g. computed by correlation_pipeline
+        :param pairs: iterable of (id1, p_site1, id2, p_site2, corr, p_val)
+        :return:
+        """
+        with self.cadb:
+            cur = self.cadb.cursor()
+            cur.execute("DROP TABLE IF EXISTS Correlations")
+            cur.execute("CREATE TABLE Correlations(Id1 INTEGER, PSite1 TEXT, Id2 INTEGER, PSite2 TEXT, Corr REAL, PVal REAL, "
+                        "Explained INTEGER DEFAULT 0, CausalEdge INTEGER, Site1 INTEGER, Site2 INTEGER, "
+                        "Explanation TEXT, MediatorId INTEGER, MediatorPSite TEXT)")
+
+            cur.executemany("INSERT INTO Correlations(Id1, PSite1, Id2, PSite2, Corr, PVal, Site1, Site2) "
+                            "VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
+                            ((self.get_gene_id(id1), p_site1, self.get_gene_id(id2), p_site2, corr, p_val,
+                              encode_site_str(p_site1), encode_site_str(p_site2))
+                             for id1, p_site1, id2, p_site2, corr, p_val in pairs))
 
     def populate_mutsig_table(self, path):
         """
@@ -264,7 +383,7 @@ class DatabaseInitializer:
         with self.cadb:
             cur = self.cadb.cursor()
             cur.execute("DROP TABLE IF EXISTS MutSig")
-            cur.execute("CREATE TABLE MutSig(Id TEXT, Disease TEXT, PVal REAL, QVal Real)")
+            cur.execute("CREATE TABLE MutSig(Id INTEGER, Disease TEXT, PVal REAL, QVal Real)")
 
             for folder in folders:
                 try:
@@ -276,21 +395,24 @@ class DatabaseInitializer:
                 except Exception as e:
                     raise BioagentException.PathNotFoundException()
 
-                mutsig_file = open(file_path, 'r')
+                mutsig_file = read_lines(file_path)
                 next(mutsig_file) # skip the header line
 
                 for line in mutsig_file:
                     vals = line.split('\t')
-                    gene_id = vals[1]
+                    gene_id = self.get_gene_id(vals[1])
                     p_val = vals[17]
                     q_val = vals[18].rstrip('\n')
                     cur.execute("INSERT INTO MutSig VALUES(?, ?, ?, ?)", (gene_id, folder,  p_val, q_val))
 
                 mutsig_file.close()
 
+            cur.execute("CREATE INDEX MutSig_Id ON MutSig(Id, Disease)")
+
     def populate_mutex_table(self, path):
         """
-        Finds mutually exclusive gene groups
+        Reads all the mutually exclusive gene groups with their scores and q-values,
+        indexed by study and score so that a score threshold is chosen at query time
         :param path: Path to the folder that keeps ranked-groups.txt
         :return:
         """
@@ -305,7 +427,8 @@ class DatabaseInitializer:
         with self.cadb:
             cur = self.cadb.cursor()
             cur.execute("DROP TABLE IF EXISTS Mutex")
-            cur.execute("CREATE TABLE Mutex(Disease TEXT, Id1 TEXT, Id2 TEXT, Id3 TEXT, Id4, Id5, Score REAL)")
+            cur.execute("CREATE TABLE Mutex(Disease TEXT, Id1 INTEGER, Id2 INTEGER, Id3 INTEGER, Id4 INTEGER, Id5 INTEGER, "
+                        "Score REAL, QVal REAL)")
             for folder in folders:
                 try:
                     if folder in tcga_study_names:
@@ -316,57 +439,141 @@ class DatabaseInitializer:
                 except Exception as e:
                     raise BioagentException.PathNotFoundException()
 
-                mutex_file = open(file_path, 'r')
-                next(mutex_file)  # skip the header line
+                mutex_file = read_lines(file_path)
+                # Some studies have no q-val column, the members follow the score
+                header = next(mutex_file).rstrip('\n').split('\t')
+                has_q_val = 'q-val' in header
+                first_member = 2 if has_q_val else 1
                 for line in mutex_file:
                     vals = line.split('\t')
                     vals[len(vals) - 1] = vals[len(vals) - 1].rstrip('\n')
                     score = float(vals[0])
-                    if score > 0.05:
-                        continue
+                    q_val = float(vals[1]) if has_q_val else None
 
                     genes = []
-                    for i in range(2, len(vals)):
-                        genes.append(vals[i])
-                        # print(genes[i-2])
+                    for i in range(first_member, len(vals)):
+                        genes.append(self.get_gene_id(vals[i]))
 
                     # fill the rest with none
-                    for i in range(len(vals), 7):
+                    for i in range(len(genes), 5):
                         genes.append(None)
 
+                    cur.execute("INSERT INTO Mutex VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
+                                (folder, genes[0], genes[1], genes[2], genes[3], genes[4], score, q_val))
+
+                mutex_file.close()
 
-                    cur.execute("INSERT INTO Mutex VALUES(?, ?, ?, ?, ?,?, ?)",
-                                (folder, genes[0], genes[1], genes[2], genes[3], genes[4], score))
+            cur.execute("CREATE INDEX Mutex_Score ON Mutex(Disease, Score)")
 
-        mutex_file.close()
-    def populate_explained_table(self):
+    def populate_explained_correlations(self):
         """
-        Find the correlations with a causal explanation
+        Tags each correlation with the causal relation explaining it, in one pass over
+        Correlations using the source and target indexes of CausalityPNNLOvarian.
+        CausalEdge is twice the rowid of the relation, plus one when the correlation
+        reads it from its target, so the first relation in the file explains it.
+        Explained_Correlations and Unexplained_Correlations are views on the tagged
+        table, with the columns of Correlations followed by those of the explaining relation.
         :return:
         """
         with self.cadb:
             cur = self.cadb.cursor()
-            cur.execute("DROP TABLE IF EXISTS Explained_Correlations")
-            cur.execute("CREATE TABLE Explained_Correlations AS SELECT * FROM Correlations "
-                        "LEFT JOIN CausalityPNNLOvarian ON CausalityPNNLOvarian.Id1 = Correlations.Id1 AND CausalityPNNLOvarian.Id2 = Correlations.Id2  "
-                        "AND CausalityPNNLOvarian.PSite1 = Correlations.PSite1 AND CausalityPNNLOvarian.PSite2 = Correlations.PSite2 "
-                        "WHERE Rel IS NOT NULL",
-                        ).fetchall()
-
-    def populate_unexplained_table(self):
+            cur.execute("UPDATE Correlations SET CausalEdge = (SELECT MIN(Edge) FROM ("
+                        "SELECT 2 * p.rowid AS Edge FROM CausalityPNNLOvarian p "
+                        "WHERE p.Id1 = Correlations.Id1 AND p.Site1 = Correlations.Site1 "
+                        "AND p.Id2 = Correlations.Id2 AND p.Site2 = Correlations.Site2 "
+                        "UNION ALL SELECT 2 * p.rowid + 1 FROM CausalityPNNLOvarian p "
+                        "WHERE p.Id2 = Correlations.Id1 AND p.Site2 = Correlations.Site1 "
+                        "AND p.Id1 = Correlations.Id2 AND p.Site1 = Correlations.Site2))")
+            cur.execute("UPDATE Correlations SET Explained = CausalEdge IS NOT NULL")
+            cur.execute("UPDATE Correlations SET Explanation = CASE Explained WHEN 1 THEN 'direct' END, "
+                        "MediatorId = NULL, MediatorPSite = NULL")
+
+            cur.execute("CREATE INDEX IF NOT EXISTS Correlations_Key ON Correlations(Id1, Site1, Id2, Site2)")
+            cur.execute("CREATE INDEX IF NOT EXISTS Correlations_Id2 ON Correlations(Id2)")
+
+            # Databases built before the views kept copies of the joined rows in tables
+            old = cur.execute("SELECT type, name FROM sqlite_master "
+                              "WHERE name IN ('Explained_Correlations', 'Unexplained_Correlations')").fetchall()
+            for kind, name in old:
+                cur.execute("DROP " + kind.upper() + " " + name)
+
+            # Gene names come first as in Correlations, the gene ids are last for lookups
+            cur.execute("CREATE VIEW Explained_Correlations AS "
+                        "SELECT g1.Symbol AS Id1, c.PSite1 AS PSite1, g2.Symbol AS Id2, c.PSite2 AS PSite2, "
+                        "c.Corr AS Corr, c.PVal AS PVal, "
+                        "g1.Symbol AS CausalId1, "
+                        "CASE c.CausalEdge & 1 WHEN 0 THEN p.PSite1 ELSE p.PSite2 END AS CausalPSite1, "
+                        "g2.Symbol AS CausalId2, "
+                        "CASE c.CausalEdge & 1 WHEN 0 THEN p.PSite2 ELSE p.PSite1 END AS CausalPSite2, "
+                        "CASE c.CausalEdge & 1 WHEN 0 THEN p.Rel ELSE " + _opposite_rel_sql('p.Rel') + " END AS Rel, "
+                        "p.EvidenceId AS EvidenceId, "
+                        "c.Id1 AS GeneId1, c.Id2 AS GeneId2, "
+                        "c.Explanation AS Explanation, m.Symbol AS Mediator, c.MediatorPSite AS MediatorPSite "
+                        "FROM Correlations c INNER JOIN CausalityPNNLOvarian p ON p.rowid = c.CausalEdge >> 1 "
+                        "INNER JOIN Gene g1 ON g1.Id = c.Id1 INNER JOIN Gene g2 ON g2.Id = c.Id2 "
+                        "LEFT JOIN Gene m ON m.Id = c.MediatorId "
+                        "WHERE c.Explained = 1")
+            cur.execute("CREATE VIEW Unexplained_Correlations AS "
+                        "SELECT g1.Symbol AS Id1, c.PSite1 AS PSite1, g2.Symbol AS Id2, c.PSite2 AS PSite2, "
+                        "c.Corr AS Corr, c.PVal AS PVal, "
+                        "NULL, NULL, NULL, NULL, NULL, NULL, "
+                        "c.Id1 AS GeneId1, c.Id2 AS GeneId2, "
+                        "c.Explanation AS Explanation, m.Symbol AS Mediator, c.MediatorPSite AS MediatorPSite "
+                        "FROM Correlations c INNER JOIN Gene g1 ON g1.Id = c.Id1 INNER JOIN Gene g2 ON g2.Id = c.Id2 "
+                        "LEFT JOIN Gene m ON m.Id = c.MediatorId "
+                        "WHERE c.Explained = 0")
+
+    def populate_network_explanations(self):
         """
-        Find the correlations without a causal explanation
+        Tags the correlations that no causal relation explains directly with a two-step
+        causal path or a common upstream in CausalityPNNLOvarian, and the gene and site
+        in the middle. The nodes of the network are the gene sites, and all correlations
+        are looked up together with sparse matrix products, see network_explanations.
         :return:
         """
+        from .explainability import network_explanations
+
         with self.cadb:
             cur = self.cadb.cursor()
-            cur.execute("DROP TABLE IF EXISTS Unexplained_Correlations")
-            cur.execute("CREATE TABLE Unexplained_Correlations AS SELECT * FROM Correlations "
-                        "LEFT JOIN CausalityPNNLOvarian ON CausalityPNNLOvarian.Id1 = Correlations.Id1 AND CausalityPNNLOvarian.Id2 = Correlations.Id2  "
-                        "AND CausalityPNNLOvarian.PSite1 = Correlations.PSite1 AND CausalityPNNLOvarian.PSite2 = Correlations.PSite2 "
-                        "WHERE Rel IS NULL",
-                        ).fetchall()
 
+            # Nodes are numbered in the order they appear in the causal priors
+            nodes = {}
+            node_sites = []
+            sources = []
+            targets = []
+            for id1, site1, p_site1, id2, site2, p_site2 in cur.execute(
+                    "SELECT Id1, Site1, PSite1, Id2, Site2, PSite2 FROM CausalityPNNLOvarian ORDER BY rowid"):
+                for gene_id, site, p_site, ends in ((id1, site1, p_site1, sources), (id2, site2, p_site2, targets)):
+                    node = nodes.get((gene_id, site))
+                    if node is None:
+                        node = nodes[(gene_id, site)] = len(node_sites)
+                        node_sites.append((gene_id, p_site))
+                    ends.append(node)
+
+            row_ids = []
+            nodes1 = []
+            nodes2 = []
+            for row_id, id1, site1, id2, site2 in cur.execute(
+                    "SELECT rowid, Id1, Site1, Id2, Site2 FROM Correlations WHERE Explained = 0"):
+                node1 = nodes.get((id1, site1))
+                node2 = nodes.get((id2, site2))
+                if node1 is not None and node2 is not None:
+                    row_ids.append(row_id)
+                    nodes1.append(node1)
+                    nodes2.append(node2)
+
+            cur.execute("UPDATE Correlations SET Explanation = NULL, MediatorId = NULL, MediatorPSite = NULL "
+                        "WHERE Explained = 0")
+            if not row_ids:
+                return
+
+            explanations, mediators = network_explanations(sources, targets, len(node_sites), nodes1, nodes2)
+            cur.executemany("UPDATE Correlations SET Explanation = ?, MediatorId = ?, MediatorPSite = ? "
+                            "WHERE rowid = ?",
+                            ((explanation,) + node_sites[mediator] + (row_id,)
+                             for row_id, explanation, mediator in zip(row_ids, explanations.tolist(),
+                                                                      mediators.tolist())
+                             if explanation is not None))
 
     def populate_sif_relations_table(self, path):
         """
@@ -380,23 +587,34 @@ class DatabaseInitializer:
         except Exception as e:
             raise BioagentException.PathNotFoundException()
 
-        pc_file = open(pc_path, 'r')
+        pc_file = read_lines(pc_path)
 
         with self.cadb:
             cur = self.cadb.cursor()
             cur.execute("DROP TABLE IF EXISTS Sif_Relations")
-            cur.execute("CREATE TABLE Sif_Relations(Id1 TEXT,  Id2 TEXT, Rel TEXT)")
+            cur.execute("CREATE TABLE Sif_Relations(Id1 INTEGER,  Id2 INTEGER, Rel TEXT)")
             for line in pc_file:
                 vals = line.split('\t')
                 id1 = vals[0].upper()
                 id2 = (vals[2].rstrip('\n')).upper()
                 rel = vals[1]
-                cur.execute("INSERT INTO Sif_Relations VALUES(?, ?, ?)", (id1, id2, rel))
+                cur.execute("INSERT INTO Sif_Relations VALUES(?, ?, ?)",
+                            (self.get_gene_id(id1), self.get_gene_id(id2), rel))
+
+            cur.execute("CREATE INDEX Sif_Relations_Id2 ON Sif_Relations(Id2, Rel)")
 
         pc_file.close()
 
 
 
+    def populate_sif_graph(self):
+        """
+        Writes the Sif_Relations network into a CSR snapshot file next to the database,
+        which agent processes map into memory instead of joining Sif_Relations
+        :return:
+        """
+        SifGraph.from_database(self.cadb).save(self.sif_graph_file)
+
     def populate_tcga_names_table(self, path):
         """
         Fills the mutation significance table for all genes and TCGA studies
@@ -409,7 +627,7 @@ class DatabaseInitializer:
         except Exception as e:
             raise BioagentException.PathNotFoundException()
 
-        with open(tcga_path, 'rU') as tcga_file:
+        with read_lines(tcga_path) as tcga_file:
             tcga_file = csv.reader(tcga_file, delimiter='\t')
 
             with self.cadb:
@@ -435,12 +653,12 @@ class DatabaseInitializer:
         except Exception as e:
             raise BioagentException.PathNotFoundException()
 
-        location_file = open(location_path, 'r')
+        location_file = read_lines(location_path)
 
         with self.cadb:
             cur = self.cadb.cursor()
             cur.execute("DROP TABLE IF EXISTS CellularComponents")
-            cur.execute("CREATE TABLE CellularComponents(Gene TEXT, Component TEXT)")
+            cur.execute("CREATE TABLE CellularComponents(Gene INTEGER, Component TEXT)")
 
             for line in location_file:
                 vals = line.split('\t')
@@ -450,10 +668,29 @@ class DatabaseInitializer:
                     gene = vals[i]
                     if loc in loc_list:
                         cur.execute("INSERT INTO CellularComponents VALUES(?, ?)",
-                                    (gene, loc))
+                                    (self.get_gene_id(gene), loc))
+
+            cur.execute("CREATE INDEX CellularComponents_Gene ON CellularComponents(Gene)")
 
         location_file.close()
 
+    def populate_gene_refs(self):
+        """
+        Fills the HGNC and UniProt ids of the genes in the Gene table that don't have them yet
+        so that replies don't need to resolve them per request
+        :return:
+        """
+        with self.cadb:
+            cur = self.cadb.cursor()
+            genes = cur.execute("SELECT Id, Symbol FROM Gene WHERE HGNC IS NULL").fetchall()
+
+            for gene_id, gene in genes:
+                hgnc_id = hgnc_client.get_hgnc_id(gene)
+                if not hgnc_id:
+                    continue
+                uniprot_id = hgnc_client.get_uniprot_id(hgnc_id)
+                cur.execute("UPDATE Gene SET HGNC = ?, UP = ? WHERE Id = ?", (hgnc_id, uniprot_id, gene_id))
+
     # def get_unique_cellular_components(self):
     #     with self.cadb:
     #         cur = self.cadb.cursor()
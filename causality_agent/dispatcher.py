@@ -0,0 +1,156 @@
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger('CausalA')
+
+
+class _Slot:
+    """ Place of a request in the delivery order of its lane"""
+
+    def __init__(self, deliver, on_error):
+        self.deliver = deliver
+        self.on_error = on_error
+        self.reply = None
+        # Set once the request is finished or past its deadline, whichever comes first
+        self.claimed = False
+        self.done = False
+        self.timer = None
+
+
+class Lane:
+    """ Worker pool whose replies are delivered in the order the requests arrived"""
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='causala-' + name)
+
+        self._slots = deque()
+        self._lock = threading.Lock()
+        # True while a thread delivers the finished replies, which are sent
+        # outside the lock but by one thread at a time to keep their order
+        self._delivering = False
+
+    def submit(self, handle, deliver, deadline=None, on_timeout=None, on_error=None):
+        """
+        Runs handle on a worker and passes its result to deliver once all
+        earlier requests of the lane are delivered
+        :param handle: Function that computes the reply
+        :param deliver: Function that sends the reply
+        :param deadline: Seconds after which on_timeout() is delivered instead
+        :param on_timeout: Function that makes the reply of a request past its deadline
+        :param on_error: Function that makes the reply of a request whose handle raised
+        :return:
+        """
+        slot = _Slot(deliver, on_error)
+        with self._lock:
+            self._slots.append(slot)
+
+        if deadline:
+            slot.timer = threading.Timer(deadline, self._complete, (slot, on_timeout, True))
+            slot.timer.daemon = True
+            slot.timer.start()
+
+        self.executor.submit(self._run, slot, handle)
+
+    def _run(self, slot, handle):
+        try:
+            reply = handle()
+        except Exception as e:
+            logger.error('Request failed in lane %s' % self.name)
+            logger.exception(e)
+            self._complete(slot, slot.on_error)
+            return
+        self._complete(slot, lambda: reply)
+
+    def _complete(self, slot, make_reply, timed_out=False):
+        with self._lock:
+            if slot.claimed:
+                # The deadline already passed, the late reply is dropped
+                return
+            slot.claimed = True
+        if timed_out:
+            logger.warning('Request in lane %s passed its deadline' % self.name)
+        elif slot.timer is not None:
+            slot.timer.cancel()
+
+        reply = None
+        if make_reply is not None:
+            try:
+                reply = make_reply()
+            except Exception as e:
+                logger.error('Could not make reply in lane %s' % self.name)
+                logger.exception(e)
+
+        with self._lock:
+            slot.reply = reply
+            slot.done = True
+            if self._delivering:
+                # The delivering thread sends this reply when its turn comes
+                return
+            self._delivering = True
+
+        self._deliver_finished()
+
+    def _deliver_finished(self):
+        """Delivers every finished reply that is not waiting for an earlier one"""
+        while True:
+            with self._lock:
+                finished = []
+                while self._slots and self._slots[0].done:
+                    finished.append(self._slots.popleft())
+                if not finished:
+                    self._delivering = False
+                    return
+
+            for slot in finished:
+                if slot.reply is None:
+                    logger.error('Request in lane %s has no reply to send' % self.name)
+                    continue
+                try:
+                    slot.deliver(slot.reply)
+                except Exception as e:
+                    logger.error('Could not deliver reply in lane %s' % self.name)
+                    logger.exception(e)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+class RequestDispatcher:
+    """ Runs requests on separate lanes so that slow tasks don't hold back fast ones"""
+
+    def __init__(self, lanes, task_lanes, default_lane, deadlines=None, default_deadline=None):
+        """
+        :param lanes: dict from lane name to its number of workers
+        :param task_lanes: dict from task name to the lane it runs on
+        :param default_lane: Lane of the tasks missing from task_lanes
+        :param deadlines: dict from task name to its deadline in seconds
+        :param default_deadline: Deadline of the tasks missing from deadlines
+        """
+        self.lanes = {name: Lane(name, workers) for name, workers in lanes.items()}
+        self.task_lanes = task_lanes
+        self.default_lane = default_lane
+        self.deadlines = deadlines or {}
+        self.default_deadline = default_deadline
+
+    def get_lane(self, task):
+        return self.lanes[self.task_lanes.get(task, self.default_lane)]
+
+    def submit(self, task, handle, deliver, on_timeout=None, on_error=None):
+        """
+        :param task: Task name that selects the lane and the deadline
+        :param handle: Function that computes the reply
+        :param deliver: Function that sends the reply
+        :param on_timeout: Function that makes the reply of a request past its deadline
+        :param on_error: Function that makes the reply of a request whose handle raised
+        :return:
+        """
+        deadline = self.deadlines.get(task, self.default_deadline)
+        self.get_lane(task).submit(handle, deliver, deadline, on_timeout, on_error)
+
+    def shutdown(self, wait=True):
+        for lane in self.lanes.values():
+            lane.shutdown(wait)
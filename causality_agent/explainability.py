@@ -0,0 +1,159 @@
+import threading
+
+import numpy as np
+from scipy import sparse
+
+from .sites import encode_site_str
+from .database_initializer import opposite_rel
+
+
+# Correlations not explained by a direct causal relation, by the network around them
+two_step = 'two-step'
+common_upstream = 'common-upstream'
+
+# Correlated pairs compared at a time
+_pair_chunk_size = 100000
+
+
+class CausalPriorIndex:
+    """ Hash index from (id1, site1, id2, site2) to the causal relations explaining their correlation"""
+
+    def __init__(self, priors, activity_priors=()):
+        """
+        :param priors: iterable of (id1, site1, id2, site2, rel) with integer site codes
+        :param activity_priors: iterable of (id1, id2, site2, rel) from the activity of id1, they
+        explain the correlations of any site of id1
+        """
+        self.rels = {}
+        for id1, site1, id2, site2, rel in priors:
+            self._add(self.rels, (id1, site1, id2, site2), rel)
+
+        # The activity relations by (id1, id2, site2), and read from their targets by (id1, site1, id2)
+        self.source_rels = {}
+        self.target_rels = {}
+        for id1, id2, site2, rel in activity_priors:
+            self._add(self.source_rels, (id1, id2, site2), rel)
+            self._add(self.target_rels, (id2, site2, id1), opposite_rel[rel])
+
+        # Callers send the same few thousand site strings over and over
+        self._sites = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _add(index, key, rel):
+        rels = index.get(key)
+        if rels is None:
+            index[key] = (rel,)
+        elif rel not in rels:
+            index[key] = rels + (rel,)
+
+    @classmethod
+    def from_database(cls, cadb):
+        """
+        Reads the causal priors of the correlations in CausalityPNNLOvarian and the general
+        causal priors in Causality, whose sources are gene activities without a site
+        :param cadb: Connection to the database
+        :return:
+        """
+        with cadb:
+            cur = cadb.cursor()
+            rows = cur.execute("SELECT g1.Symbol, p.Site1, g2.Symbol, p.Site2, p.Rel FROM CausalityPNNLOvarian p "
+                               "INNER JOIN Gene g1 ON g1.Id = p.Id1 INNER JOIN Gene g2 ON g2.Id = p.Id2 "
+                               "ORDER BY p.rowid").fetchall()
+            activity_rows = cur.execute("SELECT g1.Symbol, g2.Symbol, c.Site2, c.Rel FROM Causality c "
+                                        "INNER JOIN Gene g1 ON g1.Id = c.Id1 INNER JOIN Gene g2 ON g2.Id = c.Id2 "
+                                        "ORDER BY c.rowid").fetchall()
+            return cls(cls._both_directions(rows), activity_rows)
+
+    @staticmethod
+    def _both_directions(rows):
+        """Yields each stored relation followed by its opposite from the target"""
+        for id1, site1, id2, site2, rel in rows:
+            yield id1, site1, id2, site2, rel
+            yield id2, site2, id1, site1, opposite_rel[rel]
+
+    def __len__(self):
+        return len(self.rels) + len(self.source_rels) + len(self.target_rels)
+
+    def _encode_site(self, site):
+        code = self._sites.get(site)
+        if code is None:
+            code = encode_site_str(site)
+            with self._lock:
+                if len(self._sites) < 100000:
+                    self._sites[site] = code
+        return code
+
+    def _lookup(self, id1, site1, id2, site2):
+        rels = self.rels.get((id1, site1, id2, site2), ())
+        for activity_rels in (self.source_rels.get((id1, id2, site2)), self.target_rels.get((id1, site1, id2))):
+            if activity_rels:
+                rels = rels + tuple(rel for rel in activity_rels if rel not in rels)
+        return rels
+
+    def get_rels(self, id1, site1, id2, site2):
+        """
+        :return: tuple of the relations from (id1, site1) to (id2, site2), empty if there is none
+        """
+        return self._lookup(id1.upper(), self._encode_site(site1), id2.upper(), self._encode_site(site2))
+
+    def classify(self, pairs):
+        """
+        :param pairs: iterable of (id1, site1, id2, site2)
+        :return: list of relation tuples, one per pair, empty for an unexplained pair
+        """
+        lookup = self._lookup
+        encode = self._encode_site
+        return [lookup(id1.upper(), encode(site1), id2.upper(), encode(site2)) for id1, site1, id2, site2 in pairs]
+
+def network_explanations(sources, targets, node_cnt, nodes1, nodes2, chunk_size=_pair_chunk_size):
+    """
+    Finds, for all correlated pairs at once, a causal path of two steps between the
+    two nodes or a node upstream of both. With A the adjacency matrix of the causal
+    relations, (u, v) has a two-step path through w when row u of A and column v of A
+    share w, i.e. (A A)[u, v] > 0, and a common upstream w when columns u and v of A
+    share w, i.e. (A.T A)[u, v] > 0. Only those entries of the products are computed,
+    as elementwise products of the gathered sparse rows of A and A.T, a chunk of pairs
+    at a time. A two-step path in either direction is preferred over a common upstream,
+    and the mediator with the smallest node index is kept.
+    :param sources: Source node of each causal relation
+    :param targets: Target node of each causal relation
+    :param node_cnt: Number of nodes, larger than the largest node index
+    :param nodes1: First node of each correlated pair
+    :param nodes2: Second node of each correlated pair
+    :param chunk_size: Number of pairs compared at a time
+    :return: (explanations, mediators), object array of two_step, common_upstream or None
+    and int array of mediator nodes, -1 for an unexplained pair
+    """
+    sources = np.asarray(sources, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    nodes1 = np.asarray(nodes1, dtype=np.int64)
+    nodes2 = np.asarray(nodes2, dtype=np.int64)
+
+    adjacency = sparse.csr_matrix((np.ones(len(sources), dtype=np.int32), (sources, targets)),
+                                  shape=(node_cnt, node_cnt))
+    adjacency.sum_duplicates()
+    adjacency_t = adjacency.T.tocsr()
+
+    explanations = np.full(len(nodes1), None, dtype=object)
+    mediators = np.full(len(nodes1), -1, dtype=np.int64)
+
+    for start in range(0, len(nodes1), chunk_size):
+        end = min(start + chunk_size, len(nodes1))
+        chunk1 = nodes1[start:end]
+        chunk2 = nodes2[start:end]
+
+        # Paths of two steps from the first node to the second one and back
+        paths = adjacency[chunk1].multiply(adjacency_t[chunk2]) + adjacency[chunk2].multiply(adjacency_t[chunk1])
+        upstreams = adjacency_t[chunk1].multiply(adjacency_t[chunk2])
+
+        for explanation, shared in ((two_step, paths), (common_upstream, upstreams)):
+            shared = sparse.csr_matrix(shared)
+            shared.eliminate_zeros()
+            shared.sort_indices()
+
+            found = (np.diff(shared.indptr) > 0) & (mediators[start:end] < 0)
+            explanations[start:end][found] = explanation
+            mediators[start:end][found] = shared.indices[shared.indptr[:-1][found]]
+
+    return explanations, mediators
@@ -0,0 +1,195 @@
+"""Plain HTTP/JSON front end over CausalityAgent for consumers that don't use KQML.
+
+Each endpoint takes a JSON object in a POST body and answers with
+{"result": ...} using the same result shapes as the CausalityAgent methods.
+The queries are stateless, so any number of clients and servers can share
+a database:
+
+    POST /causality           {"source": "MAPK1", "target": "JUND", "direction": "strict"}
+    POST /causality_targets   {"gene": "MAPK1", "rel": "phosphorylates", "offset": 0, "limit": 100}
+    POST /correlations        {"gene": "AKT1", "limit": 50, "max_p": 0.0001, "min_corr": 0.5}
+    POST /mutex               {"gene": "TP53", "disease": "BRCA"}
+    POST /mutsig              {"gene": "TP53", "disease": "OV"}
+    POST /common_upstreams    {"genes": ["AKT1", "BRAF"]}
+    POST /cellular_location   {"genes": ["AKT1", "MAPK1"]}
+
+    python -m causality_agent.http_server --port 8080 --workers 8
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from .batch import queries, missing_arguments
+from .causality_agent import CausalityAgent
+
+
+logger = logging.getLogger('CausalA')
+
+_resource_dir = os.path.dirname(os.path.realpath(__file__)) + '/resources/'
+
+# Path to the name of its query in batch.queries
+routes = {
+    '/causality': 'causality',
+    '/causality_targets': 'causality_targets',
+    '/correlations': 'correlations',
+    '/mutex': 'mutex',
+    '/mutsig': 'mutsig',
+    '/common_upstreams': 'common_upstreams',
+    '/cellular_location': 'cellular_location',
+}
+
+_reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+            413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super(HttpError, self).__init__(message)
+        self.status = status
+
+
+class CausalityHttpServer:
+    """ asyncio HTTP/1.1 server with keep-alive that runs the agent queries on a thread pool"""
+
+    max_body = 16 * 1024 * 1024
+    keep_alive_timeout = 30.0
+
+    def __init__(self, ca, workers=8):
+        """
+        :param ca: CausalityAgent, its sqlite connections are opened per worker thread
+        :param workers: Number of threads running queries
+        """
+        self.ca = ca
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='causala-http')
+
+    async def serve(self, host='127.0.0.1', port=8080):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        logger.info('Serving CausalityAgent on %s' %
+                    ', '.join('%s:%d' % sock.getsockname()[:2] for sock in server.sockets))
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), self.keep_alive_timeout)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+
+                start = time.perf_counter()
+                keep_alive = True
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                    headers = await self._read_headers(reader)
+                    keep_alive = self._is_keep_alive(version, headers)
+
+                    length = int(headers.get('content-length', 0))
+                    if length > self.max_body:
+                        # The body is not read, so the connection can't carry another request
+                        keep_alive = False
+                        raise HttpError(413, 'Request body is too large')
+                    body = await reader.readexactly(length) if length else b''
+
+                    status, payload, query_time = await self.handle_request(method, target.split('?')[0], body)
+                except HttpError as e:
+                    status, payload, query_time = e.status, {'error': str(e)}, 0.0
+                except ValueError as e:
+                    status, payload, query_time = 400, {'error': 'Malformed request: %s' % e}, 0.0
+                    keep_alive = False
+
+                self._write_response(writer, status, payload, keep_alive, start, query_time)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_request(self, method, path, body):
+        """
+        :return: (status, JSON payload, seconds spent in the query)
+        """
+        name = routes.get(path)
+        if name is None:
+            raise HttpError(404, 'Unknown path %s' % path)
+        if method != 'POST':
+            raise HttpError(405, 'Use POST with a JSON body')
+
+        try:
+            params = json.loads(body.decode('utf-8')) if body else {}
+        except ValueError as e:
+            raise HttpError(400, 'Invalid JSON: %s' % e)
+        if not isinstance(params, dict):
+            raise HttpError(400, 'The body must be a JSON object')
+        missing = missing_arguments(name, params)
+        if missing:
+            raise HttpError(400, 'Missing argument %s' % ', '.join(missing))
+
+        loop = asyncio.get_running_loop()
+        query_start = time.perf_counter()
+        try:
+            result = await loop.run_in_executor(self.executor, queries[name], self.ca, params)
+        except Exception as e:
+            logger.exception(e)
+            raise HttpError(500, '%s: %s' % (type(e).__name__, e))
+
+        return 200, {'result': result}, time.perf_counter() - query_start
+
+    @staticmethod
+    async def _read_headers(reader):
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                return headers
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+    @staticmethod
+    def _is_keep_alive(version, headers):
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+    @staticmethod
+    def _write_response(writer, status, payload, keep_alive, start, query_time):
+        body = json.dumps(payload, default=str).encode('utf-8')
+        total_time = time.perf_counter() - start
+        head = ['HTTP/1.1 %d %s' % (status, _reasons.get(status, '')),
+                'Content-Type: application/json',
+                'Content-Length: %d' % len(body),
+                'Connection: %s' % ('keep-alive' if keep_alive else 'close'),
+                'Server-Timing: query;dur=%.3f, total;dur=%.3f' % (query_time * 1000, total_time * 1000),
+                'X-Response-Time: %.3fms' % (total_time * 1000)]
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve CausalityAgent queries over HTTP/JSON')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=8, help='threads running database queries')
+    parser.add_argument('--resources', default=_resource_dir, help='folder with the database')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(levelname)s: %(name)s - %(message)s', level=logging.INFO)
+
+    ca = CausalityAgent(args.resources)
+    server = CausalityHttpServer(ca, args.workers)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
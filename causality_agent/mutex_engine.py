@@ -0,0 +1,200 @@
+"""Mutual exclusivity scores of any gene set on the alteration matrix of a study.
+
+A study folder in tcga-mutex-results can keep the alteration matrix Mutex was
+run on, DataMatrix.txt, plain or compressed. Its header line names the samples
+and each other line has a gene symbol followed by one value per sample, 0 for
+an unaltered sample and any other value for an altered one. Genes that are not
+in the matrix have no alterations. The row of each gene is kept as a bitset over
+the samples, packed into uint64 words.
+
+The coverage of a gene set is the number of samples with an alteration of any
+of its genes, and the overlap is the number of alterations beyond the first one
+in a sample. A mutually exclusive set covers more samples than expected for its
+alteration counts. Its p-value is the fraction of permutations, each moving the
+alterations of every gene to random samples while keeping their number, whose
+coverage is at least the observed one. The permutations are made in blocks, a
+few numpy calls over a (permutations x samples) matrix per gene, and the blocks
+run on a thread pool.
+
+Requires numpy.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .readers import read_lines, find_resource
+
+
+matrix_file_name = 'DataMatrix.txt'
+
+# Permutations per p-value when a request doesn't give them
+default_permutations = 10000
+
+# Permutations made at a time by one worker
+_block_size = 1000
+
+_byte_counts = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def _popcount(words):
+    """
+    :param words: uint64 array of bitsets, one per row
+    :return: int64 array of the number of set bits of each row
+    """
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    return _byte_counts[words.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+def _pack(altered):
+    """
+    :param altered: bool array, samples on the last axis
+    :return: uint64 array of bitsets over the samples
+    """
+    packed = np.packbits(altered, axis=-1, bitorder='little')
+    padding = -packed.shape[-1] % 8
+    if padding:
+        packed = np.concatenate([packed, np.zeros(packed.shape[:-1] + (padding,), dtype=np.uint8)], axis=-1)
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+
+def permuted_coverages(sample_cnt, counts, permutations, seed=None):
+    """
+    Coverages of gene sets whose alterations are placed at random samples
+    :param sample_cnt: Number of samples
+    :param counts: Number of altered samples of each gene
+    :param permutations: Number of permutations
+    :param seed: Seed of the random generator
+    :return: int64 array of the coverage of each permutation
+    """
+    rng = np.random.default_rng(seed)
+    covered = np.zeros((permutations, (sample_cnt + 63) // 64), dtype=np.uint64)
+    for count in counts:
+        if count == 0:
+            continue
+        altered = np.zeros((permutations, sample_cnt), dtype=bool)
+        if count >= sample_cnt:
+            altered[:] = True
+        else:
+            # The samples with the count smallest random keys are altered
+            samples = np.argpartition(rng.random((permutations, sample_cnt)), count - 1, axis=1)[:, :count]
+            np.put_along_axis(altered, samples, True, axis=1)
+        covered |= _pack(altered)
+    return _popcount(covered)
+
+
+class AlterationMatrix:
+    """ Altered samples of each gene of a study as packed bitsets"""
+
+    def __init__(self, genes, samples, bits):
+        """
+        :param genes: Gene symbols, one per row of bits
+        :param samples: Sample names
+        :param bits: uint64 array of genes x sample words
+        """
+        self.samples = list(samples)
+        self.bits = bits
+        self.gene_rows = {gene: row for row, gene in enumerate(genes)}
+        self.counts = _popcount(bits) if len(bits) else np.empty(0, dtype=np.int64)
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        :param path: Path of the matrix file, or of its uncompressed version
+        :return:
+        """
+        matrix_file = read_lines(path)
+        samples = next(matrix_file).rstrip('\n').split('\t')[1:]
+
+        genes = []
+        rows = []
+        for line in matrix_file:
+            vals = line.rstrip('\n').split('\t')
+            if len(vals) < 2:
+                continue
+            genes.append(vals[0].upper())
+            rows.append(_pack(np.array(vals[1:]) != '0'))
+
+        matrix_file.close()
+
+        bits = np.stack(rows) if rows else np.empty((0, (len(samples) + 63) // 64), dtype=np.uint64)
+        return cls(genes, samples, bits)
+
+    def get_counts(self, genes):
+        """
+        :param genes: Gene symbols
+        :return: list of the number of altered samples of each gene, 0 for the genes not in the matrix
+        """
+        rows = [self.gene_rows.get(gene.upper()) for gene in genes]
+        return [0 if row is None else int(self.counts[row]) for row in rows]
+
+    def get_coverage(self, genes):
+        """
+        :param genes: Gene symbols
+        :return: Number of samples with an alteration of any of the genes
+        """
+        rows = [row for row in (self.gene_rows.get(gene.upper()) for gene in genes) if row is not None]
+        if not rows:
+            return 0
+        return int(_popcount(np.bitwise_or.reduce(self.bits[rows], axis=0)))
+
+
+class MutexEngine:
+    """ Scores the mutual exclusivity of gene sets on the alteration matrices of the studies"""
+
+    def __init__(self, path, workers=None):
+        """
+        :param path: Path to the tcga-mutex-results folder
+        :param workers: Number of threads making permutations, the number of cores by default
+        """
+        self.path = path
+        self.executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1,
+                                           thread_name_prefix='causala-mutex')
+
+        # Study abbreviation to its AlterationMatrix, None if the study has no matrix
+        self._matrices = {}
+        self._lock = threading.Lock()
+
+    def get_matrix(self, study):
+        """
+        Gets the alteration matrix of a study, read from its file on first use
+        :param study: TCGA study abbreviation
+        :return: AlterationMatrix, None if the study doesn't have one
+        """
+        if study not in self._matrices:
+            with self._lock:
+                if study not in self._matrices:
+                    path = find_resource(os.path.join(self.path, study, matrix_file_name))
+                    self._matrices[study] = AlterationMatrix.from_file(path) if os.path.isfile(path) else None
+        return self._matrices[study]
+
+    def score(self, study, genes, permutations=default_permutations, seed=None):
+        """
+        :param study: TCGA study abbreviation
+        :param genes: Gene symbols
+        :param permutations: Number of permutations for the p-value
+        :param seed: Seed of the random generator, for repeatable p-values
+        :return: {genes:, alterations:, samples:, coverage:, overlap:, p_value:}, None if the study has no matrix
+        """
+        matrix = self.get_matrix(study)
+        if matrix is None:
+            return None
+
+        genes = list(dict.fromkeys(gene.upper() for gene in genes))
+        counts = matrix.get_counts(genes)
+        sample_cnt = len(matrix.samples)
+        coverage = matrix.get_coverage(genes)
+
+        blocks = [_block_size] * (permutations // _block_size)
+        if permutations % _block_size:
+            blocks.append(permutations % _block_size)
+        seeds = np.random.SeedSequence(seed).spawn(len(blocks))
+        coverages = self.executor.map(lambda block: permuted_coverages(sample_cnt, counts, *block),
+                                      zip(blocks, seeds))
+        at_least = sum(int((block_coverages >= coverage).sum()) for block_coverages in coverages)
+
+        return {'genes': list(genes), 'alterations': counts, 'samples': sample_cnt,
+                'coverage': coverage, 'overlap': sum(counts) - coverage,
+                'p_value': (at_least + 1) / (permutations + 1)}
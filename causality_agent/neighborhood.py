@@ -0,0 +1,176 @@
+"""Multi-gene neighborhood queries as sparse matrix products.
+
+NeighborhoodEngine keeps one adjacency matrix per relation type over the Gene
+ids: the Sif_Relations types from the SIF graph snapshot and the causal prior
+relations of the Causality table. Entry [i, j] is set when gene i relates to
+gene j. A query of n genes is an n x node_cnt indicator matrix, and each step
+of a k-hop expansion is one product with the adjacency matrix, or with its
+transpose to go upstream, so all query genes are expanded together. The
+coverage of a gene is the number of query genes whose neighborhood holds it.
+
+Requires numpy and scipy.
+"""
+import threading
+
+import numpy as np
+from scipy import sparse
+
+
+# SIF relations without a direction, they are followed both ways
+undirected_rels = frozenset(['in-complex-with', 'interacts-with', 'neighbor-of', 'reacts-with'])
+
+_directions = ('upstream', 'downstream')
+
+
+class NeighborhoodEngine:
+    """ Upstream and downstream neighborhoods of gene sets over per-relation adjacency matrices"""
+
+    def __init__(self, matrices):
+        """
+        :param matrices: dict from relation name to a square csr_matrix over the gene ids
+        """
+        self.matrices = matrices
+        self.node_cnt = next(iter(matrices.values())).shape[0] if matrices else 0
+
+        # Relations followed when a query doesn't name any
+        self.default_rels = tuple(sorted(rel for rel in matrices if rel not in undirected_rels))
+
+        # Sum of the matrices of a relation set, and its transpose
+        self._adjacency = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_edges(cls, sources, targets, rels, node_cnt):
+        """
+        :param sources: Source gene id of each edge
+        :param targets: Target gene id of each edge
+        :param rels: Relation name of each edge
+        :param node_cnt: Number of nodes, larger than the largest gene id
+        :return:
+        """
+        sources = np.asarray(sources, dtype=np.int64)
+        targets = np.asarray(targets, dtype=np.int64)
+        rels = np.asarray(rels, dtype=object)
+
+        matrices = {}
+        for rel in set(rels.tolist()):
+            mask = rels == rel
+            rows = sources[mask]
+            cols = targets[mask]
+            if rel in undirected_rels:
+                rows, cols = np.concatenate([rows, cols]), np.concatenate([cols, rows])
+            matrices[rel] = _binary(sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)),
+                                                      shape=(node_cnt, node_cnt)))
+        return cls(matrices)
+
+    @classmethod
+    def from_database(cls, cadb, sif_graph):
+        """
+        :param cadb: Connection to the database with the Causality and Gene tables
+        :param sif_graph: SifGraph of Sif_Relations
+        :return:
+        """
+        with cadb:
+            cur = cadb.cursor()
+            node_cnt = (cur.execute("SELECT MAX(Id) FROM Gene").fetchone()[0] or 0) + 1
+            causal_edges = cur.execute("SELECT Id1, Id2, Rel FROM Causality").fetchall()
+
+        node_cnt = max(node_cnt, sif_graph.node_cnt)
+
+        sif_sources = np.repeat(np.arange(sif_graph.node_cnt, dtype=np.int64), np.diff(sif_graph.out_offsets))
+        sif_rels = np.asarray(sif_graph.rels, dtype=object)[np.asarray(sif_graph.out_rels)] \
+            if sif_graph.edge_cnt else np.empty(0, dtype=object)
+
+        causal_edges = np.asarray(causal_edges, dtype=object).reshape(-1, 3)
+        return cls.from_edges(np.concatenate([sif_sources, causal_edges[:, 0].astype(np.int64)]),
+                              np.concatenate([np.asarray(sif_graph.out_targets, dtype=np.int64),
+                                              causal_edges[:, 1].astype(np.int64)]),
+                              np.concatenate([sif_rels, causal_edges[:, 2]]),
+                              node_cnt)
+
+    def get_adjacency(self, rels=None, direction='downstream'):
+        """
+        :param rels: Relation names, default_rels if None
+        :param direction: 'downstream' to follow the relations, 'upstream' to go against them
+        :return: csr_matrix with [i, j] set when a step goes from i to j
+        """
+        if direction not in _directions:
+            raise ValueError('Unknown direction %s' % direction)
+
+        rels = self.default_rels if rels is None else tuple(sorted(set(rels)))
+        unknown = [rel for rel in rels if rel not in self.matrices]
+        if unknown:
+            raise ValueError('Unknown relations %s' % ', '.join(unknown))
+
+        key = (rels, direction)
+        adjacency = self._adjacency.get(key)
+        if adjacency is None:
+            adjacency = sparse.csr_matrix((self.node_cnt, self.node_cnt), dtype=np.int32)
+            for rel in rels:
+                adjacency = adjacency + self.matrices[rel]
+            if direction == 'upstream':
+                adjacency = adjacency.T.tocsr()
+            adjacency = _binary(adjacency)
+            with self._lock:
+                self._adjacency[key] = adjacency
+        return adjacency
+
+    def reach(self, nodes, rels=None, direction='downstream', steps=1):
+        """
+        Expands all the query genes together, one sparse product per step
+        :param nodes: Query gene ids, None for a gene that is not in the database
+        :param rels: Relation names, default_rels if None
+        :param direction: 'downstream' or 'upstream'
+        :param steps: Largest number of steps
+        :return: len(nodes) x node_cnt csr_matrix, [i, j] is 1 when j is 1 to steps steps away from nodes[i]
+        """
+        adjacency = self.get_adjacency(rels, direction)
+
+        rows = [i for i, node in enumerate(nodes) if node is not None and 0 <= node < self.node_cnt]
+        frontier = sparse.csr_matrix((np.ones(len(rows), dtype=np.int32),
+                                      (rows, [nodes[i] for i in rows])),
+                                     shape=(len(nodes), self.node_cnt))
+        reached = sparse.csr_matrix(frontier.shape, dtype=np.int32)
+
+        for _ in range(steps):
+            frontier = _binary(frontier @ adjacency)
+            # Only the genes reached for the first time are expanded in the next step
+            frontier = frontier - frontier.multiply(reached)
+            frontier.eliminate_zeros()
+            if not frontier.nnz:
+                break
+            reached = reached + frontier
+
+        return reached
+
+    def coverage(self, nodes, rels=None, direction='downstream', steps=1):
+        """
+        :return: int array over the gene ids, the number of query genes whose neighborhood holds each gene
+        """
+        return np.asarray(self.reach(nodes, rels, direction, steps).sum(axis=0)).ravel()
+
+    def common(self, nodes, rels=None, direction='downstream', steps=1):
+        """
+        :return: Gene ids in the neighborhood of every query gene
+        """
+        nodes = list(set(nodes))
+        if not nodes:
+            return np.empty(0, dtype=np.int64)
+        return np.nonzero(self.coverage(nodes, rels, direction, steps) == len(nodes))[0]
+
+    def rank(self, nodes, rels=None, direction='upstream', steps=1):
+        """
+        :return: (gene ids, coverages) of the genes in the neighborhood of any query gene, most covering first
+        """
+        coverage = self.coverage(list(set(nodes)), rels, direction, steps)
+        ids = np.nonzero(coverage)[0]
+        order = np.argsort(-coverage[ids], kind='stable')
+        return ids[order], coverage[ids[order]]
+
+
+def _binary(matrix):
+    """Sets the stored entries of a sparse matrix to 1"""
+    matrix = matrix.tocsr()
+    matrix.sum_duplicates()
+    matrix.data = np.ones(len(matrix.data), dtype=np.int32)
+    return matrix
@@ -0,0 +1,216 @@
+import time
+import bisect
+import logging
+import threading
+import functools
+from contextlib import contextmanager
+
+
+logger = logging.getLogger('CausalA')
+
+# Upper bounds of the latency histogram buckets in milliseconds
+bucket_bounds = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000]
+
+phase_names = ['parse', 'query', 'convert', 'serialize', 'send']
+
+# The request being timed in the current thread
+_current = threading.local()
+
+
+class LatencyHistogram:
+    """ Counts latencies in fixed logarithmic buckets"""
+
+    def __init__(self):
+        self.counts = [0] * (len(bucket_bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, elapsed):
+        """
+        :param elapsed: Latency in seconds
+        :return:
+        """
+        ms = elapsed * 1000
+        self.counts[bisect.bisect_left(bucket_bounds, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, q):
+        """
+        Gets the upper bound of the bucket the q-th percentile falls into
+        :param q: Percentile between 0 and 100
+        :return: Latency in milliseconds
+        """
+        if not self.count:
+            return 0.0
+
+        rank = q / 100.0 * self.count
+        cumulative = 0
+        for i, cnt in enumerate(self.counts):
+            cumulative += cnt
+            if cumulative >= rank and cnt:
+                return min(bucket_bounds[i], self.max) if i < len(bucket_bounds) else self.max
+
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count, 'mean': self.mean(), 'p50': self.percentile(50),
+                'p95': self.percentile(95), 'p99': self.percentile(99), 'max': self.max}
+
+
+class TaskStats:
+    """ Latency, failure and error counts of a single task"""
+
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.phases = {}
+        self.failures = 0
+        self.errors = 0
+
+    def to_dict(self):
+        stats = self.latency.to_dict()
+        stats['failures'] = self.failures
+        stats['errors'] = self.errors
+        stats['error_rate'] = self.errors / self.latency.count if self.latency.count else 0.0
+        stats['phases'] = {name: hist.to_dict() for name, hist in self.phases.items()}
+        return stats
+
+
+class PerformanceStats:
+    """ Collects per-task and per-phase latencies of the requests handled in this process"""
+
+    def __init__(self):
+        self.tasks = {}
+        self.started = time.time()
+        self.last_logged = time.time()
+
+        self._lock = threading.Lock()
+
+    def _get_task_stats(self, task):
+        task_stats = self.tasks.get(task)
+        if task_stats is None:
+            task_stats = self.tasks.setdefault(task, TaskStats())
+        return task_stats
+
+    @contextmanager
+    def request(self, task):
+        """
+        Times a request. Phases timed in the same thread are recorded under its task.
+        :param task: Task name
+        :return:
+        """
+        outer = getattr(_current, 'request', None)
+        state = {'stats': self, 'task': task, 'phases': {}, 'active': set(),
+                 'failed': False, 'error': False}
+        _current.request = state
+
+        start = time.perf_counter()
+        try:
+            yield state
+        except Exception:
+            state['error'] = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            _current.request = outer
+
+            with self._lock:
+                task_stats = self._get_task_stats(task)
+                task_stats.latency.record(elapsed)
+                if state['failed'] or state['error']:
+                    task_stats.failures += 1
+                if state['error']:
+                    task_stats.errors += 1
+                for name, phase_time in state['phases'].items():
+                    task_stats.phases.setdefault(name, LatencyHistogram()).record(phase_time)
+
+    def summary(self):
+        """
+        :return: dict from task name to its latency statistics
+        """
+        with self._lock:
+            return {task: task_stats.to_dict() for task, task_stats in self.tasks.items()}
+
+    def reset(self):
+        with self._lock:
+            self.tasks = {}
+            self.started = time.time()
+
+    def log_line(self):
+        """
+        :return: One line summary of the request counts and latencies per task
+        """
+        parts = []
+        for task, stats in sorted(self.summary().items()):
+            parts.append('%s n=%d err=%d p50=%.1fms p95=%.1fms max=%.1fms' %
+                         (task, stats['count'], stats['errors'], stats['p50'], stats['p95'], stats['max']))
+        return 'Performance: ' + ('; '.join(parts) if parts else 'no requests')
+
+    def maybe_log(self, interval):
+        """
+        Logs the summary line if at least interval seconds passed since the last one
+        :param interval: Seconds between log lines, 0 disables logging
+        :return:
+        """
+        if not interval:
+            return
+        now = time.time()
+        if now - self.last_logged >= interval:
+            self.last_logged = now
+            logger.info(self.log_line())
+
+
+def mark_failed():
+    """Marks the request being timed in this thread as failed"""
+    state = getattr(_current, 'request', None)
+    if state is not None:
+        state['failed'] = True
+
+
+def mark_error():
+    """Marks the request being timed in this thread as an internal error"""
+    state = getattr(_current, 'request', None)
+    if state is not None:
+        state['failed'] = True
+        state['error'] = True
+
+
+@contextmanager
+def phase(name):
+    """
+    Adds the time spent in the block to the given phase of the request being
+    timed in this thread. Does nothing outside of a request or inside a block
+    that already times the same phase.
+    :param name: One of phase_names
+    :return:
+    """
+    state = getattr(_current, 'request', None)
+    if state is None or name in state['active']:
+        yield
+        return
+
+    state['active'].add(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        state['active'].discard(name)
+        phases = state['phases']
+        phases[name] = phases.get(name, 0.0) + time.perf_counter() - start
+
+
+def timed(name):
+    """Decorator that records the calls of a function under the given phase"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
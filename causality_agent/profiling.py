@@ -0,0 +1,190 @@
+import os
+import io
+import time
+import random
+import pstats
+import sqlite3
+import hashlib
+import logging
+import tempfile
+import threading
+import cProfile
+from contextlib import contextmanager
+
+
+logger = logging.getLogger('CausalA')
+
+# The SQL statements of the request being profiled in the current thread
+_current = threading.local()
+
+
+class TimedCursor(sqlite3.Cursor):
+    """ Cursor that records its statements and their timings while a request is profiled"""
+
+    def execute(self, sql, parameters=()):
+        statements = getattr(_current, 'statements', None)
+        if statements is None:
+            return super(TimedCursor, self).execute(sql, parameters)
+
+        start = time.perf_counter()
+        try:
+            return super(TimedCursor, self).execute(sql, parameters)
+        finally:
+            statements.append([sql, parameters, time.perf_counter() - start])
+
+    def executemany(self, sql, seq_of_parameters):
+        statements = getattr(_current, 'statements', None)
+        if statements is None:
+            return super(TimedCursor, self).executemany(sql, seq_of_parameters)
+
+        start = time.perf_counter()
+        try:
+            return super(TimedCursor, self).executemany(sql, seq_of_parameters)
+        finally:
+            statements.append([sql, 'executemany', time.perf_counter() - start])
+
+    def __next__(self):
+        return self._timed_fetch(super(TimedCursor, self).__next__)
+
+    def fetchone(self):
+        return self._timed_fetch(super(TimedCursor, self).fetchone)
+
+    def fetchmany(self, size=None):
+        return self._timed_fetch(lambda: super(TimedCursor, self).fetchmany(self.arraysize if size is None else size))
+
+    def fetchall(self):
+        return self._timed_fetch(super(TimedCursor, self).fetchall)
+
+    def _timed_fetch(self, fetch):
+        # Fetch time is added to the statement that produced the rows
+        statements = getattr(_current, 'statements', None)
+        if not statements:
+            return fetch()
+
+        start = time.perf_counter()
+        try:
+            return fetch()
+        finally:
+            statements[-1][2] += time.perf_counter() - start
+
+
+class TimedConnection(sqlite3.Connection):
+    """ Connection whose cursors record statements for the request profiler. Its
+    wrappers cost a Python call per statement and row, so it is only used when
+    the profiler is enabled"""
+
+    def cursor(self, factory=TimedCursor):
+        return super(TimedConnection, self).cursor(factory)
+
+
+class RequestProfiler:
+    """ Profiles selected requests with cProfile and dumps each profile with
+    the SQL statements it ran into a rotating directory"""
+
+    def __init__(self, tasks=None, rate=0.0, directory=None, keep=100):
+        """
+        :param tasks: Task names to profile on every request, '*' for all tasks
+        :param rate: Fraction of the other requests to profile
+        :param directory: Where the profiles are written
+        :param keep: Number of profiles to keep in directory
+        """
+        self.tasks = set(task.upper() for task in tasks or [])
+        self.rate = rate
+        self.directory = directory or os.path.join(tempfile.gettempdir(), 'causala-profiles')
+        self.keep = keep
+
+        # cProfile can't run in two threads at a time
+        self._lock = threading.Lock()
+        self._count = 0
+
+    @classmethod
+    def from_environment(cls):
+        """
+        Reads the profiler settings from CAUSALA_PROFILE_TASKS (comma separated),
+        CAUSALA_PROFILE_RATE, CAUSALA_PROFILE_DIR and CAUSALA_PROFILE_KEEP
+        :return:
+        """
+        tasks = [task.strip() for task in os.environ.get('CAUSALA_PROFILE_TASKS', '').split(',') if task.strip()]
+        rate = float(os.environ.get('CAUSALA_PROFILE_RATE', 0))
+        directory = os.environ.get('CAUSALA_PROFILE_DIR')
+        keep = int(os.environ.get('CAUSALA_PROFILE_KEEP', 100))
+        return cls(tasks, rate, directory, keep)
+
+    @property
+    def enabled(self):
+        return bool(self.tasks) or self.rate > 0
+
+    def should_profile(self, task):
+        if task.upper() in self.tasks or '*' in self.tasks:
+            return True
+        return self.rate > 0 and random.random() < self.rate
+
+    @contextmanager
+    def profile(self, task, content):
+        """
+        Profiles the block unless another request is being profiled
+        :param task: Task name
+        :param content: Request content, written next to the profile
+        :return:
+        """
+        if not self._lock.acquire(blocking=False):
+            yield
+            return
+
+        profiler = cProfile.Profile()
+        _current.statements = []
+        start = time.perf_counter()
+        try:
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+        finally:
+            elapsed = time.perf_counter() - start
+            statements = _current.statements
+            _current.statements = None
+            try:
+                self._dump(task, content, profiler, statements, elapsed)
+            except Exception as e:
+                logger.error('Could not write the profile of %s' % task)
+                logger.exception(e)
+            finally:
+                self._lock.release()
+
+    def _dump(self, task, content, profiler, statements, elapsed):
+        os.makedirs(self.directory, exist_ok=True)
+
+        content_str = str(content)
+        self._count += 1
+        name = '%s-%06d-%s-%s' % (time.strftime('%Y%m%d-%H%M%S'), self._count, task,
+                                  hashlib.sha1(content_str.encode('utf-8')).hexdigest()[:8])
+        base_path = os.path.join(self.directory, name)
+
+        profiler.dump_stats(base_path + '.prof')
+
+        stats_str = io.StringIO()
+        pstats.Stats(profiler, stream=stats_str).sort_stats('cumulative').print_stats(30)
+
+        with open(base_path + '.txt', 'w') as report:
+            report.write('task: %s\n' % task)
+            report.write('elapsed: %.3f ms\n' % (elapsed * 1000))
+            report.write('content: %s\n\n' % content_str)
+            report.write('SQL statements: %d\n' % len(statements))
+            for sql, parameters, sql_time in statements:
+                report.write('%10.3f ms  %s  %s\n' % (sql_time * 1000, ' '.join(sql.split()), parameters))
+            report.write('\n')
+            report.write(stats_str.getvalue())
+
+        logger.info('Profiled %s in %.1f ms: %s.prof' % (task, elapsed * 1000, base_path))
+        self._rotate()
+
+    def _rotate(self):
+        """Removes the oldest profiles beyond the number to keep"""
+        names = sorted(set(os.path.splitext(f)[0] for f in os.listdir(self.directory)
+                           if f.endswith('.prof') or f.endswith('.txt')))
+        for name in names[:max(0, len(names) - self.keep)]:
+            for ext in ('.prof', '.txt'):
+                path = os.path.join(self.directory, name + ext)
+                if os.path.exists(path):
+                    os.remove(path)
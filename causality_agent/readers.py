@@ -0,0 +1,58 @@
+"""Readers for the resource files, plain or compressed.
+
+PC.sif, causal-priors.txt and PNNL-ovarian-correlations.txt are large and are
+usually kept compressed. read_lines opens a file such as PC.sif, or PC.sif.gz,
+PC.sif.bz2 or PC.sif.xz when only a compressed copy is there, so the database
+can be built without decompressing the files to disk first. Files are read in
+large chunks and split into lines by the io module.
+"""
+import os
+import io
+import bz2
+import gzip
+import lzma
+
+
+_openers = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+# Bytes read from a file at a time
+chunk_size = 1 << 20
+
+
+def find_resource(path):
+    """
+    :param path: Path of a resource file
+    :return: path if it exists, otherwise its first compressed copy that exists
+    """
+    if os.path.exists(path):
+        return path
+
+    for ext in _openers:
+        if os.path.exists(path + ext):
+            return path + ext
+
+    return path
+
+
+def open_resource(path):
+    """
+    Opens a resource file for binary reading, decompressing it by its extension
+    :param path: Path of the file or of its uncompressed version
+    :return: Buffered binary file object
+    """
+    path = find_resource(path)
+    opener = _openers.get(os.path.splitext(path)[1].lower())
+    if opener is None:
+        return open(path, 'rb', buffering=chunk_size)
+    return io.BufferedReader(opener(path, 'rb'), buffer_size=chunk_size)
+
+
+def read_lines(path, encoding='utf-8'):
+    """
+    Opens a resource file for reading its lines. Iterating over it gives the same lines
+    as open(path, 'r'), with '\\r\\n' and '\\r' line ends read as '\\n'
+    :param path: Path of the file or of its uncompressed version
+    :param encoding: Text encoding of the file
+    :return: Text file object
+    """
+    return io.TextIOWrapper(open_resource(path), encoding=encoding)
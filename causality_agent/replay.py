@@ -0,0 +1,227 @@
+"""Records the requests CausalityModule receives and replays them against an
+in-process module to measure throughput and latency percentiles.
+
+Record by starting the agent with CAUSALA_RECORD_FILE=requests.jsonl, then:
+
+    python -m causality_agent.replay requests.jsonl --concurrency 4 --rate 50
+"""
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class RequestRecorder:
+    """ Appends the content of each request to a JSONL file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_environment(cls):
+        """
+        :return: A recorder writing to CAUSALA_RECORD_FILE, None if it is not set
+        """
+        path = os.environ.get('CAUSALA_RECORD_FILE')
+        return cls(path) if path else None
+
+    def record(self, content):
+        line = json.dumps({'time': time.time(), 'content': content.to_string()})
+        with self._lock:
+            with open(self.path, 'a') as record_file:
+                record_file.write(line + '\n')
+
+
+def load_recording(path):
+    """
+    :param path: JSONL file written by RequestRecorder
+    :return: list of request content strings in the recorded order
+    """
+    contents = []
+    with open(path, 'r') as record_file:
+        for line in record_file:
+            line = line.strip()
+            if line:
+                contents.append(json.loads(line)['content'])
+    return contents
+
+
+class _StubGeneSummaryHandler(BaseHTTPRequestHandler):
+    """ Answers biogene queries with a fixed summary"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        gene = parse_qs(urlparse(self.path).query).get('query', [''])[0]
+        time.sleep(self.server.delay)
+        body = json.dumps({'geneInfo': [{'geneSummary': gene + ' summary from the stub server'}]}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+
+class StubGeneSummaryServer:
+    """ Local HTTP server standing in for pathwaycommons.org biogene"""
+
+    def __init__(self, delay=0.0):
+        """
+        :param delay: Seconds to wait before each answer, to mimic the remote server
+        """
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _StubGeneSummaryHandler)
+        self.server.delay = delay
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/biogene/retrieve.do?' % self.server.server_address[1]
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _NullOutput:
+    """ Discards the messages the module sends in testing mode"""
+
+    def write(self, data):
+        return len(data)
+
+    def flush(self):
+        return
+
+
+def percentile(sorted_values, q):
+    """
+    Nearest-rank percentile
+    :param sorted_values: Values in increasing order
+    :param q: Percentile between 0 and 100
+    :return:
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(math.ceil(q / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def replay(module, contents, concurrency=1, rate=None):
+    """
+    Sends the requests to the module and times each reply
+    :param module: CausalityModule in testing mode
+    :param contents: Request content strings
+    :param concurrency: Number of requests in flight at a time
+    :param rate: Requests started per second, None to send as fast as possible
+    :return: (list of (task, latency in seconds, succeeded), total seconds)
+    """
+    from kqml import KQMLList, KQMLPerformative
+
+    requests = []
+    for content_str in contents:
+        content = KQMLList.from_string(content_str)
+        msg = KQMLPerformative('request')
+        msg.set('content', content)
+        requests.append((content.head().upper(), msg, content))
+
+    start = time.perf_counter()
+
+    def send(i):
+        task, msg, content = requests[i]
+        scheduled = start + i / rate if rate else time.perf_counter()
+        wait = scheduled - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+
+        # Latency counts from the scheduled start, so queueing behind slow requests shows up
+        result = module.receive_request(msg, content)
+        latency = time.perf_counter() - scheduled
+
+        reply_content = result[1] if isinstance(result, tuple) else None
+        succeeded = reply_content is not None and reply_content.head() == 'SUCCESS'
+        return task, latency, succeeded
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, range(len(requests))))
+
+    return results, time.perf_counter() - start
+
+
+def summarize(results, elapsed):
+    """
+    :param results: list of (task, latency in seconds, succeeded)
+    :param elapsed: Total seconds of the replay
+    :return: dict with the overall throughput and per-task latency percentiles in milliseconds
+    """
+    tasks = {}
+    for task, latency, succeeded in results:
+        task_results = tasks.setdefault(task, {'latencies': [], 'failures': 0})
+        task_results['latencies'].append(latency * 1000)
+        if not succeeded:
+            task_results['failures'] += 1
+
+    summary = {'requests': len(results), 'seconds': elapsed,
+               'requests_per_second': len(results) / elapsed if elapsed else 0.0,
+               'tasks': {}}
+    for task, task_results in tasks.items():
+        latencies = sorted(task_results['latencies'])
+        summary['tasks'][task] = {'count': len(latencies), 'failures': task_results['failures'],
+                                  'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95),
+                                  'p99': percentile(latencies, 99), 'max': latencies[-1]}
+    return summary
+
+
+def print_summary(summary, out=sys.stdout):
+    out.write('%d requests in %.2f s, %.1f requests/s\n' %
+              (summary['requests'], summary['seconds'], summary['requests_per_second']))
+    out.write('%-36s %7s %7s %10s %10s %10s %10s\n' % ('task', 'count', 'failed', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for task, stats in sorted(summary['tasks'].items()):
+        out.write('%-36s %7d %7d %10.2f %10.2f %10.2f %10.2f\n' %
+                  (task, stats['count'], stats['failures'], stats['p50'], stats['p95'], stats['p99'], stats['max']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay recorded requests against an in-process CausalityModule')
+    parser.add_argument('recording', help='JSONL file written with CAUSALA_RECORD_FILE')
+    parser.add_argument('--concurrency', type=int, default=1, help='requests in flight at a time')
+    parser.add_argument('--rate', type=float, default=None, help='requests started per second')
+    parser.add_argument('--repeat', type=int, default=1, help='times to replay the recording')
+    parser.add_argument('--gene-summary-delay', type=float, default=0.0,
+                        help='seconds the stub gene summary server waits before answering')
+    parser.add_argument('--output', help='also write the summary as JSON to this file')
+    args = parser.parse_args(argv)
+
+    contents = load_recording(args.recording) * args.repeat
+
+    with StubGeneSummaryServer(args.gene_summary_delay) as stub:
+        from .causality_agent import CausalityAgent
+        CausalityAgent.biogene_url = stub.url
+
+        from .causality_module import CausalityModule
+        module = CausalityModule(testing=True)
+        module.out = _NullOutput()
+
+        results, elapsed = replay(module, contents, args.concurrency, args.rate)
+
+    summary = summarize(results, elapsed)
+    print_summary(summary)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(summary, output_file, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""Compressed sparse row (CSR) snapshot of the Sif_Relations network.
+
+The snapshot keeps the network in a single file that agent processes map with
+np.memmap, so processes on one host share one copy through the page cache and
+load it without parsing anything:
+
+    prefix     b'CASIFCSR', format version and header length as little-endian uint32
+    header     JSON with the relation names and the arrays' dtypes, offsets and lengths
+    arrays     64-byte aligned, from the end of the header
+        out_offsets  int64[node_cnt + 1]  edges of node i are at out_offsets[i]:out_offsets[i + 1]
+        out_targets  int32[edge_cnt]
+        out_rels     uint8[edge_cnt]      index into the relation names
+        in_offsets, in_sources, in_rels   the same edges grouped by target
+
+Nodes are the ids of the Gene table. The edges of a node keep the order of Sif_Relations.
+
+    python -m causality_agent.sif_graph [resources]
+
+Requires numpy.
+"""
+import os
+import json
+import struct
+import argparse
+
+import numpy as np
+
+
+_resource_dir = os.path.dirname(os.path.realpath(__file__)) + '/resources/'
+
+snapshot_file_name = 'sif-graph.csr'
+
+_magic = b'CASIFCSR'
+_format_version = 1
+_prefix = struct.Struct('<8sII')
+_alignment = 64
+
+_array_dtypes = [('out_offsets', '<i8'), ('out_targets', '<i4'), ('out_rels', 'u1'),
+                 ('in_offsets', '<i8'), ('in_sources', '<i4'), ('in_rels', 'u1')]
+
+# Rows read from Sif_Relations at a time
+_fetch_size = 100000
+
+
+def _align(offset):
+    return (offset + _alignment - 1) // _alignment * _alignment
+
+
+def _group_edges(keys, values, rels, node_cnt):
+    """
+    Groups the edges by key, keeping their order within a key
+    :return: (offsets, values, rels) in CSR layout
+    """
+    order = np.argsort(keys, kind='stable')
+    offsets = np.zeros(node_cnt + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=node_cnt), out=offsets[1:])
+    return offsets, values[order].astype(np.int32), rels[order]
+
+
+class SifGraph:
+    """ Sif_Relations network as CSR arrays, in memory or mapped from a snapshot file"""
+
+    def __init__(self, arrays, rels):
+        """
+        :param arrays: dict from the array names in the module docstring to numpy arrays
+        :param rels: Relation names, indexed by relation code
+        """
+        self.out_offsets = arrays['out_offsets']
+        self.out_targets = arrays['out_targets']
+        self.out_rels = arrays['out_rels']
+        self.in_offsets = arrays['in_offsets']
+        self.in_sources = arrays['in_sources']
+        self.in_rels = arrays['in_rels']
+
+        self.rels = list(rels)
+        self.rel_codes = {rel: code for code, rel in enumerate(self.rels)}
+
+        self.node_cnt = len(self.out_offsets) - 1
+        self.edge_cnt = len(self.out_targets)
+
+    @classmethod
+    def from_edges(cls, sources, targets, rel_codes, rels, node_cnt):
+        """
+        :param sources: Source node of each edge
+        :param targets: Target node of each edge
+        :param rel_codes: Relation code of each edge
+        :param rels: Relation names, indexed by relation code
+        :param node_cnt: Number of nodes, larger than the largest node id
+        :return:
+        """
+        sources = np.asarray(sources, dtype=np.int64)
+        targets = np.asarray(targets, dtype=np.int64)
+        rel_codes = np.asarray(rel_codes, dtype=np.uint8)
+
+        arrays = {}
+        arrays['out_offsets'], arrays['out_targets'], arrays['out_rels'] = \
+            _group_edges(sources, targets, rel_codes, node_cnt)
+        arrays['in_offsets'], arrays['in_sources'], arrays['in_rels'] = \
+            _group_edges(targets, sources, rel_codes, node_cnt)
+        return cls(arrays, rels)
+
+    @classmethod
+    def from_database(cls, cadb):
+        """
+        Reads the network from the Sif_Relations table
+        :param cadb: Connection to the database
+        :return:
+        """
+        rels = []
+        rel_codes = {}
+        chunks = []
+        with cadb:
+            cur = cadb.cursor()
+            node_cnt = (cur.execute("SELECT MAX(Id) FROM Gene").fetchone()[0] or 0) + 1
+
+            cur.execute("SELECT Id1, Id2, Rel FROM Sif_Relations ORDER BY rowid")
+            while True:
+                rows = cur.fetchmany(_fetch_size)
+                if not rows:
+                    break
+
+                chunk = np.empty((len(rows), 3), dtype=np.int64)
+                for i, (id1, id2, rel) in enumerate(rows):
+                    code = rel_codes.get(rel)
+                    if code is None:
+                        code = rel_codes[rel] = len(rels)
+                        rels.append(rel)
+                    chunk[i] = (id1, id2, code)
+                chunks.append(chunk)
+
+        if len(rels) > 256:
+            raise ValueError('Sif_Relations has %d relation types, at most 256 fit in the snapshot' % len(rels))
+
+        edges = np.concatenate(chunks) if chunks else np.empty((0, 3), dtype=np.int64)
+        return cls.from_edges(edges[:, 0], edges[:, 1], edges[:, 2], rels, node_cnt)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Maps a snapshot file written by save
+        :param path: Path of the snapshot file
+        :return:
+        """
+        with open(path, 'rb') as snapshot_file:
+            magic, version, header_len = _prefix.unpack(snapshot_file.read(_prefix.size))
+            if magic != _magic or version != _format_version:
+                raise ValueError('%s is not a version %d SIF graph snapshot' % (path, _format_version))
+            header = json.loads(snapshot_file.read(header_len).decode('utf-8'))
+
+        data_offset = _align(_prefix.size + header_len)
+        arrays = {}
+        for name, dtype, offset, length in header['arrays']:
+            if length == 0:
+                # mmap can't map an empty range
+                arrays[name] = np.empty(0, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=data_offset + offset, shape=(length,))
+        return cls(arrays, header['rels'])
+
+    def save(self, path):
+        """
+        Writes the snapshot file. The file is replaced in one step, so processes that
+        have mapped the old file keep reading it.
+        :param path: Path of the snapshot file
+        :return:
+        """
+        arrays = [(name, np.ascontiguousarray(getattr(self, name), dtype=dtype)) for name, dtype in _array_dtypes]
+
+        layout = []
+        offset = 0
+        for name, array in arrays:
+            layout.append([name, array.dtype.str, offset, len(array)])
+            offset = _align(offset + array.nbytes)
+
+        header = json.dumps({'rels': self.rels, 'arrays': layout}).encode('utf-8')
+        data_offset = _align(_prefix.size + len(header))
+
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as snapshot_file:
+            snapshot_file.write(_prefix.pack(_magic, _format_version, len(header)))
+            snapshot_file.write(header)
+            for (name, array), (_, _, offset, _) in zip(arrays, layout):
+                snapshot_file.seek(data_offset + offset)
+                snapshot_file.write(array.data)
+        os.replace(tmp_path, path)
+
+    def _edges(self, offsets, nodes, rels, node, rel):
+        if node is None or not 0 <= node < self.node_cnt:
+            return nodes[:0]
+
+        start = offsets[node]
+        end = offsets[node + 1]
+        if rel is None:
+            return nodes[start:end]
+
+        code = self.rel_codes.get(rel)
+        if code is None:
+            return nodes[:0]
+        return nodes[start:end][rels[start:end] == code]
+
+    def targets(self, node, rel=None):
+        """
+        :param node: Gene id
+        :param rel: Relation name, all relations if None
+        :return: int32 array of the targets of the node's edges, in the order of Sif_Relations
+        """
+        return self._edges(self.out_offsets, self.out_targets, self.out_rels, node, rel)
+
+    def sources(self, node, rel=None):
+        """
+        :param node: Gene id
+        :param rel: Relation name, all relations if None
+        :return: int32 array of the sources of the node's edges, in the order of Sif_Relations
+        """
+        return self._edges(self.in_offsets, self.in_sources, self.in_rels, node, rel)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write the CSR snapshot of the Sif_Relations network')
+    parser.add_argument('resources', nargs='?', default=_resource_dir, help='folder with the database')
+    args = parser.parse_args(argv)
+
+    from .database_initializer import DatabaseInitializer
+    db_initializer = DatabaseInitializer(args.resources)
+    db_initializer.populate_sif_graph()
+
+
+if __name__ == '__main__':
+    main()
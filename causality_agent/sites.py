@@ -0,0 +1,74 @@
+"""Integer codes of phosphosites so that site matches are integer comparisons.
+
+The data files write sites in several ways: S296s in the SIF files, S863 in
+causal-priors.txt and S473S in Correlations, some with more than one site
+such as T401tS405s. encode_sites turns any of them into one integer:
+
+    0                     no site
+    position << 2 | r     one site, r is 0 for an unknown residue, 1 S, 2 T, 3 Y
+    up to 3 sites         the single site codes in position order, 21 bits each
+    more than 3 sites     a negative hash of the sorted sites
+"""
+import re
+import hashlib
+
+
+_site_re = re.compile('([STY]?)([0-9]+)')
+
+_residues = ['', 'S', 'T', 'Y']
+_residue_codes = {residue: code for code, residue in enumerate(_residues)}
+
+_site_bits = 21
+_site_mask = (1 << _site_bits) - 1
+_max_packed_sites = 3
+
+
+def parse_sites(site_str):
+    """
+    :param site_str: Site string like S473S, s473, T401tS405s, ' ' or None
+    :return: list of (residue, position) sorted by position, residue is '' when unknown
+    """
+    if not site_str:
+        return []
+    return sorted(((residue, int(position)) for residue, position in _site_re.findall(site_str.upper())),
+                  key=lambda site: (site[1], site[0]))
+
+
+def encode_sites(sites):
+    """
+    :param sites: list of (residue, position) as returned by parse_sites
+    :return: Integer code of the sites, 0 for no site
+    """
+    if len(sites) > _max_packed_sites:
+        digest = hashlib.blake2b(repr(sites).encode('utf-8'), digest_size=8).digest()
+        return -(int.from_bytes(digest, 'big') >> 2) - 1
+
+    code = 0
+    for residue, position in sites:
+        code = (code << _site_bits) | ((position << 2) & _site_mask) | _residue_codes[residue]
+    return code
+
+
+def encode_site_str(site_str):
+    """
+    :param site_str: Site string like S473S, s473, T401tS405s, ' ' or None
+    :return: Integer code of the sites, 0 for no site
+    """
+    return encode_sites(parse_sites(site_str))
+
+
+def decode_sites(code):
+    """
+    :param code: Integer code from encode_sites
+    :return: list of (residue, position), None for the hashed codes of more than 3 sites
+    """
+    if code < 0:
+        return None
+
+    sites = []
+    while code:
+        site = code & _site_mask
+        sites.append((_residues[site & 3], site >> 2))
+        code >>= _site_bits
+    sites.reverse()
+    return sites
@@ -1,12 +1,39 @@
+import os
 import json
+import asyncio
+import http.client
+import sqlite3
+import tempfile
+import gzip
+import bz2
+import lzma
+import threading
 from kqml import KQMLList, KQMLString, KQMLPerformative
 from indra.statements import stmts_from_json
-from causality_agent.causality_module import _resource_dir
+from indra.databases import hgnc_client
+from causality_agent.causality_module import _resource_dir, _with_new_stmt_id, _get_default_agent, \
+    _chunk_provenance_links
 from causality_agent import causality_agent
+from causality_agent.database_initializer import DatabaseInitializer, opposite_rel
+from causality_agent.explainability import network_explanations, CausalPriorIndex
+from causality_agent.readers import open_resource, read_lines
+from causality_agent.sites import parse_sites, encode_sites, encode_site_str, decode_sites
+from causality_agent.correlation_pipeline import compute_correlations
+from causality_agent.mutex_engine import MutexEngine, matrix_file_name
+from causality_agent.conversion_cache import EdgeConversionCache, TermNameCache
 from causality_agent.causality_module import CausalityModule
+from causality_agent.dispatcher import Lane, RequestDispatcher
+from causality_agent.profiling import RequestProfiler, TimedConnection
+from causality_agent.replay import RequestRecorder, load_recording, replay, summarize, percentile
+from causality_agent.http_server import CausalityHttpServer
+from causality_agent.batch import queries, run_batch
+from causality_agent.sif_graph import SifGraph, snapshot_file_name
+from concurrent.futures import ThreadPoolExecutor
 from bioagents.tests.integration import _IntegrationTest
 from bioagents.tests.util import ekb_kstring_from_text, ekb_from_text, get_request, agent_clj_from_text
 import time
+import numpy as np
+from scipy import stats
 
 ca = causality_agent.CausalityAgent(_resource_dir)
 
@@ -49,6 +76,7 @@ class TestCausalPath(_IntegrationTest):
         path = paths[0]
         assert _reads_from_kqml_list(path, ['enz', 'name']) == 'MAPK1'
         assert _reads_from_kqml_list(path, ['sub', 'name']) == 'JUND'
+        self.first_stmt_id = path.gets('id')
 
 
     def create_message_2(self):
@@ -72,6 +100,15 @@ class TestCausalPath(_IntegrationTest):
         assert _reads_from_kqml_list(path, ['position']) == '133'
 
 
+    def create_message_3(self):
+        return self.create_message()
+
+    def check_response_to_message_3(self, output):
+        # The same edge again, from the conversion cache but as a new statement
+        self.check_response_to_message(output)
+        path = output.get('paths')[0]
+        assert path.gets('id') != self.first_stmt_id
+
     def create_message_failure(self):
         source = agent_clj_from_text('MAPK1')
         target = agent_clj_from_text('RAS')
@@ -133,11 +170,28 @@ class TestCausalityTarget(_IntegrationTest):
     def check_response_to_message(self, output):
         assert output.head() == 'SUCCESS', output
         paths = output.get('paths')
-        assert len(paths) == 904
+        assert len(paths) == CausalityModule.page_size
         path = paths[0]
         assert _reads_from_kqml_list(path, ['sub', 'name']) == 'RPTOR'
         assert _reads_from_kqml_list(path, ['residue']) == 'S'
         assert _reads_from_kqml_list(path, ['position']) == '863'
+        assert output.gets('next-offset') == str(CausalityModule.page_size)
+
+    def create_message_last_page(self):
+        source = agent_clj_from_text('MAPK1')
+        content = KQMLList('FIND-CAUSALITY-TARGET')
+        content.set('source', source)
+        content.sets('type', 'phosphorylation')
+        content.sets('offset', '900')
+        content.sets('limit', '100')
+        msg = get_request(content)
+        return msg, content
+
+    def check_response_to_message_last_page(self, output):
+        assert output.head() == 'SUCCESS', output
+        paths = output.get('paths')
+        assert len(paths) == 4
+        assert output.gets('next-offset') is None
 
     def create_message_failure(self):
         source = agent_clj_from_text('MAPK1')
@@ -166,6 +220,190 @@ class TestCausalityTarget(_IntegrationTest):
     #     assert reason == "MISSING_MECHANISM"
 
 
+def _double_row_causality(path):
+    """Causality rows as they were stored before each relation was stored once,
+    the relation followed by its opposite"""
+    rows = []
+    with open(os.path.join(path, 'causal-priors.txt'), 'r') as causality_file:
+        for line in causality_file:
+            vals = line.split('\t')
+            id1 = vals[0].upper()
+            rel = vals[1]
+            id2 = vals[2].upper()
+            p_sites2 = vals[4].upper().split(';') if len(vals) > 4 else [' ']
+            for p_site2 in p_sites2:
+                rows.append((id1, ' ', id2, p_site2, rel, vals[3]))
+                rows.append((id2, p_site2, id1, ' ', opposite_rel[rel], vals[3]))
+    return rows
+
+
+def _double_row_pnnl_causality(path):
+    """CausalityPNNLOvarian rows as they were stored before each relation was stored once"""
+    rows = []
+    with open(os.path.join(path, 'causative-data-centric.sif'), 'r') as causality_file:
+        for line in causality_file:
+            vals = line.split('\t')
+            (id1, p_site1), (id2, p_site2) = [(gene_site.upper().split('-') + [' '])[:2] for gene_site in (vals[0], vals[2])]
+            rows.append((id1, p_site1, id2, p_site2, vals[1], vals[3]))
+            rows.append((id2, p_site2, id1, p_site1, opposite_rel[vals[1]], vals[3]))
+    return rows
+
+
+def test_correlation_views_match_joined_tables():
+    # The tables joined each correlation with every relation, the views keep its first one
+    explaining = {}
+    for row in _double_row_pnnl_causality(_resource_dir):
+        explaining.setdefault(row[:4], row)
+    with open(os.path.join(_resource_dir, 'PNNL-ovarian-correlations.txt'), 'r') as pnnl_file:
+        correlations = list(DatabaseInitializer.read_correlations(pnnl_file))
+
+    explained = sorted(corr + explaining[corr[:4]][:5] + (ca.make_uri_str(explaining[corr[:4]][5]),)
+                       for corr in correlations if corr[:4] in explaining)
+    unexplained = sorted(corr + (None,) * 6 for corr in correlations if corr[:4] not in explaining)
+    assert explained and unexplained
+
+    with ca.cadb:
+        cur = ca.cadb.cursor()
+        rows = cur.execute("SELECT Id1, PSite1, Id2, PSite2, Corr, PVal, CausalId1, CausalPSite1, CausalId2, "
+                           "CausalPSite2, Rel, EvidenceId FROM Explained_Correlations").fetchall()
+        assert sorted(row[:11] + (ca.get_uri_str(row[11]),) for row in rows) == explained
+        rows = cur.execute("SELECT * FROM Unexplained_Correlations").fetchall()
+        assert sorted(row[:12] for row in rows) == unexplained
+
+
+def _causality_summary(causality):
+    return causality['id1'], causality['mods1'], causality['id2'], causality['mods2'], causality['rel']
+
+
+def _double_row_summary(row):
+    return _causality_summary(ca.row_to_causality(row[:5] + (None, 0)))
+
+
+def test_causality_targets_match_double_row_layout():
+    rows = _double_row_causality(_resource_dir)
+    for gene in ['MAPK1', 'BRAF', 'AKT1', 'JUND']:
+        for rel in ['phosphorylates', 'is-phosphorylated-by', 'expression-is-upregulated-by', 'modulates']:
+            expected = [row for row in rows if row[0] == gene and (rel == 'modulates' or row[4] == rel)]
+            found = ca.find_causality_targets({'id': [gene], 'rel': rel}) or []
+            assert list(map(_causality_summary, found)) == list(map(_double_row_summary, expected))
+            assert [ca.get_uri_str(c['evidence_id']) for c in found] == \
+                   [ca.make_uri_str(row[5]) for row in expected]
+
+
+def test_causality_matches_double_row_layout():
+    rows = _double_row_causality(_resource_dir)
+    genes = ['MAPK1', 'BRAF', 'AKT1', 'JUND', 'RPTOR']
+    for gene1 in genes:
+        for gene2 in genes:
+            for direction in [None, 'strict']:
+                expected = [row for row in rows if row[0] == gene1 and row[2] == gene2 and
+                            (direction is None or 'is' not in row[4])]
+                found = ca.find_causality({'source': {'id': gene1}, 'target': {'id': gene2},
+                                           'direction': direction})
+                if not expected:
+                    assert found == ''
+                else:
+                    assert _causality_summary(found) == _double_row_summary(expected[0])
+
+
+def test_populate_gene_refs():
+    cadb = ca.db_initializer.cadb
+    with cadb:
+        saved = cadb.execute("SELECT Symbol, HGNC, UP FROM Gene WHERE Symbol IN ('AKT1', 'BRAF')").fetchall()
+    try:
+        # Genes that have ids are left alone, the others are resolved
+        with cadb:
+            cadb.execute("UPDATE Gene SET HGNC = 'KEPT', UP = 'KEPT' WHERE Symbol = 'AKT1'")
+            cadb.execute("UPDATE Gene SET HGNC = NULL, UP = NULL WHERE Symbol = 'BRAF'")
+        ca.db_initializer.populate_gene_refs()
+
+        gene_refs = ca.get_gene_refs()
+        assert gene_refs['AKT1'] == {'HGNC': 'KEPT', 'UP': 'KEPT'}
+        hgnc_id = hgnc_client.get_hgnc_id('BRAF')
+        assert gene_refs['BRAF'] == {'HGNC': hgnc_id, 'UP': hgnc_client.get_uniprot_id(hgnc_id)}
+    finally:
+        with cadb:
+            cadb.executemany("UPDATE Gene SET HGNC = ?, UP = ? WHERE Symbol = ?",
+                             [(hgnc_id, uniprot_id, gene) for gene, hgnc_id, uniprot_id in saved])
+
+
+def test_gene_ids():
+    with ca.cadb:
+        genes = dict(ca.cadb.execute("SELECT Symbol, Id FROM Gene WHERE Symbol IN ('AKT1', 'BRAF', 'MAPK1')").fetchall())
+        gene_count = ca.cadb.execute("SELECT COUNT(*) FROM Gene").fetchone()[0]
+    assert len(genes) == 3
+
+    assert ca.get_gene_id('AKT1') == genes['AKT1']
+    assert ca.get_gene_id('NOT_A_GENE') is None
+    assert ca.get_gene_ids('BRAF') == [genes['BRAF']]
+    assert sorted(ca.get_gene_ids(['AKT1', 'BRAF', 'MAPK1', 'NOT_A_GENE'])) == sorted(genes.values())
+    assert ca.get_gene_symbols(genes.values()) == {gene_id: symbol for symbol, gene_id in genes.items()}
+
+    # Known symbols keep their ids rather than being added again
+    for symbol, gene_id in genes.items():
+        assert ca.db_initializer.get_gene_id(symbol) == gene_id
+    assert ca.db_initializer.get_gene_id(None) is None
+    with ca.cadb:
+        assert ca.cadb.execute("SELECT COUNT(*) FROM Gene").fetchone()[0] == gene_count
+
+
+def test_evidence_ids():
+    with open(os.path.join(_resource_dir, 'causative-data-centric.sif'), 'r') as causality_file:
+        uris = [line.split('\t')[3] for line in causality_file]
+
+    with ca.cadb:
+        cur = ca.cadb.cursor()
+        evidence_ids = [row[0] for row in cur.execute("SELECT EvidenceId FROM CausalityPNNLOvarian ORDER BY rowid")]
+        evidence_count = cur.execute("SELECT COUNT(*) FROM Evidence").fetchone()[0]
+    assert len(evidence_ids) == len(uris)
+
+    # Relations with the same uris share one Evidence row
+    evidence = dict(zip(evidence_ids, uris))
+    assert len(evidence) == len(set(uris))
+    assert ca.get_uri_strs(evidence_ids) == {evidence_id: ca.make_uri_str(uri) for evidence_id, uri in evidence.items()}
+    assert ca.get_uri_str(evidence_ids[0]) == ca.make_uri_str(uris[0])
+    assert ca.get_uri_str(-1) is None
+
+    for evidence_id, uri in evidence.items():
+        assert ca.db_initializer.get_evidence_id(uri) == evidence_id
+    with ca.cadb:
+        assert ca.cadb.execute("SELECT COUNT(*) FROM Evidence").fetchone()[0] == evidence_count
+
+
+class _ProvenanceSender:
+    """Collects the add-provenance link lists CausalityModule.send_provenance_batch sends"""
+    provenance_batch = True
+    provenance_max_links = 2
+    provenance_max_chars = 16000
+
+    def __init__(self):
+        self.CA = ca
+        self.sent = []
+
+    def _send_provenance_links(self, links):
+        self.sent.append(links)
+
+
+def test_provenance_batch():
+    results = ca.find_causality_targets({'id': ['MAPK1'], 'rel': 'modulates'})
+    evidence_ids = list(dict.fromkeys(result['evidence_id'] for result in results))
+    assert len(evidence_ids) > 2
+
+    # A link is sent once however many results share its evidence
+    sender = _ProvenanceSender()
+    CausalityModule.send_provenance_batch(sender, results + results[::-1])
+    links = [link for chunk in sender.sent for link in chunk]
+    assert [pc_url for _, pc_url in links] == \
+           ['http://www.pathwaycommons.org/pc2/get?' + ca.get_uri_str(evidence_id) + 'format=SBGN'
+            for evidence_id in evidence_ids]
+    assert all(len(chunk) <= 2 for chunk in sender.sent)
+
+    links = [('a' * 4, 'b' * 4), ('c', 'd'), ('e' * 20, 'f'), ('g', 'h'), ('i', 'j'), ('k', 'l')]
+    assert list(_chunk_provenance_links(links, 3, 10)) == [links[:2], links[2:3], links[3:6]]
+    assert list(_chunk_provenance_links(links, 2, 100)) == [links[:2], links[2:4], links[4:]]
+    assert list(_chunk_provenance_links([], 2, 100)) == []
+
+
 class TestCausalitySource(_IntegrationTest):
     def __init__(self, *args):
         super(TestCausalitySource, self).__init__(CausalityModule)
@@ -186,6 +424,7 @@ class TestCausalitySource(_IntegrationTest):
         assert _reads_from_kqml_list(path, ['enz', 'name']) == 'NRAS'
         assert _reads_from_kqml_list(path, ['residue']) == 'S'
         assert _reads_from_kqml_list(path, ['position']) == '601'
+        assert output.gets('next-offset') is None
 
     def create_message_failure(self):
         target = agent_clj_from_text('BRAF')
@@ -317,6 +556,264 @@ class TestNextCorrelation(_IntegrationTest):
 
 
 
+def _edge(id1, id2, rel='phosphorylates', position='100'):
+    return {'id1': id1, 'mods1': [], 'id2': id2, 'mods2': [{'residue': 'S', 'position': position}], 'rel': rel}
+
+
+def test_edge_conversion_cache():
+    converted = []
+    cache = EdgeConversionCache(lambda edge: converted.append(edge['id2']) or edge['id2'], maxsize=2)
+
+    assert cache.get_all([_edge('A', 'B'), _edge('A', 'C'), _edge('A', 'B')]) == ['B', 'C', 'B']
+    assert converted == ['B', 'C'] and (cache.hits, cache.misses) == (1, 2)
+    # The same row read again is the same edge
+    assert cache.get(_edge('A', 'B', 'PHOSPHORYLATES')) == 'B'
+    assert converted == ['B', 'C'] and (cache.hits, cache.misses) == (2, 2)
+
+    # B was used after C, so C is dropped for D
+    cache.get(_edge('A', 'D'))
+    assert len(cache) == 2 and converted == ['B', 'C', 'D']
+    cache.get(_edge('A', 'B'))
+    cache.get(_edge('A', 'C'))
+    assert converted == ['B', 'C', 'D', 'C']
+    # Another site is another edge
+    cache.get(_edge('A', 'C', position='200'))
+    assert converted == ['B', 'C', 'D', 'C', 'C'] and len(cache) == 2
+
+    cache.clear()
+    assert len(cache) == 0 and (cache.hits, cache.misses) == (0, 0)
+
+
+def test_term_name_cache():
+    parsed = []
+
+    def parse(term_str):
+        parsed.append(term_str)
+        return term_str.split() if term_str else None
+
+    cache = TermNameCache(maxsize=2)
+    assert cache.get('AKT1 BRAF', parse) == ['AKT1', 'BRAF']
+    # Callers get their own list, changing it doesn't change the cache
+    names = cache.get('AKT1 BRAF', parse)
+    names.append('TP53')
+    assert cache.get('AKT1 BRAF', parse) == ['AKT1', 'BRAF']
+    assert parsed == ['AKT1 BRAF'] and (cache.hits, cache.misses) == (2, 1)
+
+    # An EKB without agents is cached too, and keys are the whole string
+    assert cache.get('', parse) is None and cache.get('', parse) is None
+    assert cache.get('AKT1 BRAF ', parse) == ['AKT1', 'BRAF']
+    assert parsed == ['AKT1 BRAF', '', 'AKT1 BRAF '] and len(cache) == 2
+    assert cache.parse_time > 0
+
+
+def test_cached_statements_get_new_ids():
+    stmt_cljson = KQMLList.from_string('(:type "Phosphorylation" :enz (:name "MAPK1") :id "first" :position "100")')
+    copies = [_with_new_stmt_id(stmt_cljson) for _ in range(2)]
+    assert stmt_cljson.gets('id') == 'first'
+    assert len({stmt_cljson.gets('id')} | {copy.gets('id') for copy in copies}) == 3
+    assert all(copy.gets('position') == '100' and copy.get('enz') is stmt_cljson.get('enz') for copy in copies)
+
+    agent = _get_default_agent('AKT1')
+    agent.db_refs['HGNC'] = '391'
+    assert _get_default_agent('AKT1') is not agent and 'HGNC' not in _get_default_agent('AKT1').db_refs
+
+
+def test_top_correlations():
+    top = ca.find_top_correlations('AKT1', 5, max_p=0.05)
+    assert 0 < len(top) <= 5
+    assert all(corr['id1'] == 'AKT1' and corr['pVal'] < 0.05 for corr in top)
+    strengths = [abs(corr['correlation']) for corr in top]
+    assert strengths == sorted(strengths, reverse=True)
+
+    strongest = ca.find_strongest_correlations(3)
+    assert len(strongest) == 3
+    assert abs(strongest[0]['correlation']) >= strengths[0]
+    assert ca.find_top_correlations('NOT-A-GENE') is None
+
+    store = ca.get_correlation_store()
+    for k in [0, -1]:
+        for query in [lambda: store.gene_top(ca.get_gene_id('AKT1'), k), lambda: store.top(k)]:
+            try:
+                query()
+                assert False
+            except ValueError:
+                pass
+
+
+def test_compressed_resources():
+    content = b'CHEK1-S296s\tphosphorylates\tTP53BP1-S1678s\turi1\r\nAKT1\tphosphorylates\tBRAF-S365s\turi2\n'
+    lines = ['CHEK1-S296s\tphosphorylates\tTP53BP1-S1678s\turi1\n', 'AKT1\tphosphorylates\tBRAF-S365s\turi2\n']
+    with tempfile.TemporaryDirectory() as path:
+        for ext, opener in [('.gz', gzip.open), ('.bz2', bz2.open), ('.xz', lzma.open)]:
+            # Only the compressed copy is there, it is found from the plain name
+            ext_path = os.path.join(path, ext[1:])
+            os.mkdir(ext_path)
+            file_name = os.path.join(ext_path, 'PC.sif')
+            with opener(file_name + ext, 'wb') as fp:
+                fp.write(content)
+
+            with open_resource(file_name) as fp:
+                assert fp.read() == content
+            with read_lines(file_name + ext) as fp:
+                assert list(fp) == lines
+
+        # A plain file is read before its compressed copy
+        file_name = os.path.join(path, 'gz', 'PC.sif')
+        with open(file_name, 'wb') as fp:
+            fp.write(content[:content.index(b'\r')])
+        with read_lines(file_name) as fp:
+            assert list(fp) == [lines[0][:-1]]
+
+
+def test_site_codes():
+    # The spellings of the data files give the same code
+    assert encode_site_str('S296s') == encode_site_str('S296') == encode_site_str('s296S')
+    assert encode_site_str('T401tS405s') == encode_site_str('S405sT401t')
+    assert encode_site_str(' ') == encode_site_str(None) == 0
+    assert encode_site_str('S296') != encode_site_str('T296')
+    assert encode_site_str('296') != encode_site_str('S296')
+
+    for site_str in ['S296s', '296', 'Y1068', 'T401tS405s', 'S2S3T524287', ' ']:
+        sites = parse_sites(site_str)
+        code = encode_sites(sites)
+        assert code >= 0
+        assert decode_sites(code) == sites
+
+    # More than 3 sites are hashed, the code is stable but can't be decoded
+    sites = parse_sites('S10S20T30Y40')
+    assert len(sites) == 4
+    code = encode_sites(sites)
+    assert code < 0
+    assert code == encode_site_str('Y40S10T30S20')
+    assert code != encode_site_str('S10S20T30Y41')
+    assert decode_sites(code) is None
+
+
+def test_causal_prior_index():
+    index = CausalPriorIndex([('AKT1', encode_site_str('S473'), 'GSK3B', encode_site_str('S9'), 'phosphorylates')],
+                             [('MAPK1', 'JUND', encode_site_str('S100'), 'phosphorylates'),
+                              ('AKT1', 'GSK3B', encode_site_str('S9'), 'inhibits')])
+    assert index.classify([('MAPK1', 'T185', 'JUND', 'S100S'), ('mapk1', None, 'JUND', 'S100'),
+                           ('JUND', 'S100', 'MAPK1', 'Y187'), ('MAPK1', 'T185', 'JUND', 'S73'),
+                           ('AKT1', 'S473S', 'GSK3B', 'S9S'), ('AKT1', 'T308', 'GSK3B', 'S9')]) == \
+           [('phosphorylates',), ('phosphorylates',), ('is-phosphorylated-by',), (),
+            ('phosphorylates', 'inhibits'), ('inhibits',)]
+
+
+def test_network_explanations():
+    # 0 -> 1 -> 2, 3 -> 0 and 3 -> 4
+    explanations, mediators = network_explanations([0, 1, 3, 3], [1, 2, 0, 4], 6,
+                                                   [0, 2, 0, 1, 5], [2, 0, 4, 4, 0], chunk_size=2)
+    assert explanations.tolist() == ['two-step', 'two-step', 'common-upstream', None, None]
+    assert mediators.tolist() == [1, 1, 3, -1, -1]
+
+
+def _correlation_matrix(pairs, feature_cnt):
+    corr = np.full((feature_cnt, feature_cnt), np.nan)
+    p_vals = np.full((feature_cnt, feature_cnt), np.nan)
+    for i, j, r, p in pairs:
+        corr[i, j] = r
+        p_vals[i, j] = p
+    return corr, p_vals
+
+
+def test_compute_correlations():
+    rng = np.random.default_rng(0)
+    matrix = rng.normal(size=(30, 50))
+    matrix[:, 1::2] += matrix[:, ::2] * np.linspace(0.1, 2, 25)
+    upper = np.triu_indices(50, k=1)
+
+    # Tiles of 16 features, so pairs come from diagonal and off-diagonal tiles
+    corr, p_vals = _correlation_matrix(compute_correlations(matrix, block_size=16, workers=2), 50)
+    assert np.allclose(corr[upper], np.corrcoef(matrix, rowvar=False)[upper])
+    assert np.allclose(p_vals[5, 7], stats.pearsonr(matrix[:, 5], matrix[:, 7])[1])
+
+    corr, p_vals = _correlation_matrix(compute_correlations(matrix, 'spearman', block_size=16), 50)
+    spearman = stats.spearmanr(matrix)
+    assert np.allclose(corr[upper], spearman.correlation[upper])
+    assert np.allclose(p_vals[upper], spearman.pvalue[upper])
+
+    all_p = _correlation_matrix(compute_correlations(matrix, block_size=16), 50)[1][upper]
+    passed = stats.false_discovery_control(all_p) <= 0.05
+    pairs = list(compute_correlations(matrix, fdr=0.05, block_size=16))
+    assert 0 < len(pairs) < len(all_p)
+    assert sorted((i, j) for i, j, _, _ in pairs) == sorted(zip(upper[0][passed], upper[1][passed]))
+
+    # Missing values, each pair is correlated over the samples both features have
+    matrix[rng.random(matrix.shape) < 0.1] = np.nan
+    matrix[2:, 4] = np.nan
+    corr, p_vals = _correlation_matrix(compute_correlations(matrix, block_size=16), 50)
+    for i, j in [(0, 1), (2, 17), (20, 45)]:
+        both = ~np.isnan(matrix[:, i]) & ~np.isnan(matrix[:, j])
+        r, p = stats.pearsonr(matrix[both, i], matrix[both, j])
+        assert np.isclose(corr[i, j], r) and np.isclose(p_vals[i, j], p)
+    assert np.isnan(corr[4]).all() and np.isnan(corr[:, 4]).all()
+    # Spearman ranks would depend on the pair, the call fails before any pair is computed
+    try:
+        compute_correlations(matrix, 'spearman')
+        assert False
+    except ValueError:
+        pass
+    corr = _correlation_matrix(compute_correlations(matrix, block_size=16, min_samples=28), 50)[0]
+    observed = (~np.isnan(matrix)).astype(int)
+    common = (observed.T @ observed)[upper]
+    assert (common < 28).any() and (common >= 28).any()
+    assert (np.isnan(corr[upper]) == (common < 28)).all()
+
+
+def _sql_common_upstreams(genes):
+    """The Sif_Relations join find_common_upstreams made before the snapshot"""
+    gene_ids = [ca.get_gene_id(gene) for gene in genes]
+    with ca.cadb:
+        cur = ca.cadb.cursor()
+        upstreams = cur.execute("SELECT s1.Id1 FROM Sif_Relations s1 "
+                                "INNER JOIN Sif_Relations s2 ON (s2.Id1 = s1.Id1 AND s1.Id2 = ? AND s2.Id2 = ? AND "
+                                "s1.Rel = 'controls-state-change-of' AND s2.Rel = s1.Rel)",
+                                gene_ids[:2]).fetchall()
+        for gene_id in gene_ids[2:]:
+            upstream_ids = [upstream[0] for upstream in upstreams]
+            upstreams = cur.execute("SELECT Id1 FROM Sif_Relations WHERE Rel = 'controls-state-change-of' "
+                                    "AND Id2 = ? AND Id1 IN (" + ", ".join("?" * len(upstream_ids)) + ")",
+                                    [gene_id] + upstream_ids).fetchall()
+    symbols = ca.get_gene_symbols(upstream[0] for upstream in upstreams)
+    return sorted(symbols[upstream[0]] for upstream in upstreams)
+
+
+def test_sif_graph_snapshot():
+    with ca.cadb:
+        edges = ca.cadb.execute("SELECT Id1, Id2, Rel FROM Sif_Relations ORDER BY rowid").fetchall()
+
+    with tempfile.TemporaryDirectory() as path:
+        snapshot_file = os.path.join(path, snapshot_file_name)
+        SifGraph.from_database(ca.cadb).save(snapshot_file)
+        graph = SifGraph.load(snapshot_file)
+
+        assert graph.edge_cnt == len(edges)
+        for gene_id in {id1 for id1, _, _ in edges[:20]} | {id2 for _, id2, _ in edges[:20]}:
+            assert graph.targets(gene_id).tolist() == [id2 for id1, id2, _ in edges if id1 == gene_id]
+            assert graph.sources(gene_id).tolist() == [id1 for id1, id2, _ in edges if id2 == gene_id]
+            assert graph.targets(gene_id, 'controls-state-change-of').tolist() == \
+                   [id2 for id1, id2, rel in edges if id1 == gene_id and rel == 'controls-state-change-of']
+        del graph
+
+    for genes in [['AKT1', 'BRAF'], ['AKT1', 'BRAF', 'MAPK1'], ['MAPK1', 'JUND'], ['EGFR', 'AKT1']]:
+        assert sorted(ca.find_common_upstreams(genes) or []) == _sql_common_upstreams(genes)
+
+
+def test_sif_graph_snapshot_written_on_worker_thread():
+    sif_graph, sif_graph_file = ca._sif_graph, ca.db_initializer.sif_graph_file
+    with tempfile.TemporaryDirectory() as path:
+        ca._sif_graph = None
+        ca.db_initializer.sif_graph_file = os.path.join(path, snapshot_file_name)
+        try:
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                graph = executor.submit(ca.get_sif_graph).result()
+            assert os.path.isfile(ca.db_initializer.sif_graph_file)
+            assert graph.edge_cnt == SifGraph.load(ca.db_initializer.sif_graph_file).edge_cnt
+        finally:
+            ca._sif_graph, ca.db_initializer.sif_graph_file = sif_graph, sif_graph_file
+
+
 class TestCommonUpstreams(_IntegrationTest):
     def __init__(self, *args):
         super(TestCommonUpstreams, self).__init__(CausalityModule)
@@ -346,6 +843,58 @@ class TestCommonUpstreams(_IntegrationTest):
         assert reason == "NO_UPSTREAM_FOUND"
 
 
+class TestCommonNeighborhood(_IntegrationTest):
+    def __init__(self, *args):
+        super(TestCommonNeighborhood, self).__init__(CausalityModule)
+
+    def create_message(self):
+        content = KQMLList('FIND-COMMON-NEIGHBORHOOD')
+        genes = KQMLList([agent_clj_from_text('AKT1'), agent_clj_from_text('BRAF'), agent_clj_from_text('MAPK1')])
+        content.set('genes', genes)
+        content.sets('direction', 'upstream')
+        content.sets('steps', '2')
+        msg = get_request(content)
+        return msg, content
+
+    def check_response_to_message(self, output):
+        assert output.head() == 'SUCCESS', output
+        genes = output.get('genes')
+        assert 'EGF' in _get_names_from_list_cljson(genes)
+
+    def create_message_failure(self):
+        content = KQMLList('FIND-COMMON-NEIGHBORHOOD')
+        genes = KQMLList([agent_clj_from_text('AKT1'), agent_clj_from_text('BRAF')])
+        content.set('genes', genes)
+        content.sets('steps', '10')
+        msg = get_request(content)
+        return msg, content
+
+    def check_response_to_message_failure(self, output):
+        assert output.head() == 'FAILURE', output
+        reason = output.gets('reason')
+        assert reason == "INVALID_ARGUMENT"
+
+
+class TestRankRegulators(_IntegrationTest):
+    def __init__(self, *args):
+        super(TestRankRegulators, self).__init__(CausalityModule)
+
+    def create_message(self):
+        content = KQMLList('RANK-REGULATORS')
+        genes = KQMLList([agent_clj_from_text('AKT1'), agent_clj_from_text('BRAF'), agent_clj_from_text('MAPK1')])
+        content.set('genes', genes)
+        content.sets('limit', '500')
+        msg = get_request(content)
+        return msg, content
+
+    def check_response_to_message(self, output):
+        assert output.head() == 'SUCCESS', output
+        regulators = _get_names_from_list_cljson(output.get('regulators'))
+        coverages = [int(coverage.string_value()) for coverage in output.get('coverages')]
+        assert coverages == sorted(coverages, reverse=True)
+        assert coverages[regulators.index('EGF')] == 3
+
+
 class TestMutex(_IntegrationTest):
     def __init__(self, *args):
         super(TestMutex, self).__init__(CausalityModule)
@@ -385,6 +934,82 @@ class TestMutex(_IntegrationTest):
         assert reason == "MISSING_MECHANISM"
 
 
+class TestRankedMutex(_IntegrationTest):
+    def __init__(self, *args):
+        super(TestRankedMutex, self).__init__(CausalityModule)
+
+    def create_message_01_top(self):
+        content = KQMLList('FIND-RANKED-MUTEX')
+        content.set('disease', agent_clj_from_text('breast cancer'))
+        content.sets('limit', '2')
+        msg = get_request(content)
+        return msg, content
+
+    def check_response_to_message_01_top(self, output):
+        assert output.head() == 'SUCCESS', output
+        mutex = output.get('mutex')
+        assert len(mutex) == 2
+        assert mutex[0].gets('score') == '6.249e-10'
+        assert output.gets('next-offset') == '2'
+
+    def create_message_02_gene(self):
+        content = KQMLList('FIND-RANKED-MUTEX')
+        content.set('disease', agent_clj_from_text('breast cancer'))
+        content.set('gene', agent_clj_from_text('GATA3'))
+        content.sets('threshold', '1e-5')
+        msg = get_request(content)
+        return msg, content
+
+    def check_response_to_message_02_gene(self, output):
+        assert output.head() == 'SUCCESS', output
+        mutex = output.get('mutex')
+        assert all('GATA3' in [gene.to_string() for gene in group.get('group')] for group in mutex)
+        assert all(float(group.gets('score')) <= 1e-5 for group in mutex)
+        assert output.gets('next-offset') is None
+
+
+def test_score_mutex():
+    samples = 40
+    altered = {'A': range(0, 10), 'B': range(10, 20), 'C': range(20, 30), 'D': range(0, 25, 2)}
+    with tempfile.TemporaryDirectory() as path:
+        os.mkdir(os.path.join(path, 'BRCA'))
+        with open(os.path.join(path, 'BRCA', matrix_file_name), 'w') as matrix_file:
+            matrix_file.write('\t'.join(['Symbol'] + ['S%d' % i for i in range(samples)]) + '\n')
+            for gene, rows in altered.items():
+                matrix_file.write('\t'.join([gene] + ['1' if i in rows else '0' for i in range(samples)]) + '\n')
+
+        engine = MutexEngine(path, workers=2)
+        exclusive = engine.score('BRCA', ['A', 'B', 'C'], 2000, seed=1)
+        assert exclusive['alterations'] == [10, 10, 10]
+        assert exclusive['coverage'] == 30
+        assert exclusive['overlap'] == 0
+        assert exclusive['p_value'] < 0.01
+
+        overlapping = engine.score('BRCA', ['A', 'D', 'E'], 2000, seed=1)
+        assert overlapping['alterations'] == [10, 13, 0]
+        assert overlapping['overlap'] == 5
+        assert overlapping['p_value'] > 0.5
+
+        assert engine.score('OV', ['A', 'B'], 100) is None
+
+
+class TestScoreMutex(_IntegrationTest):
+    def __init__(self, *args):
+        super(TestScoreMutex, self).__init__(CausalityModule)
+
+    def create_message_failure(self):
+        content = KQMLList('SCORE-MUTEX')
+        content.set('genes', KQMLList([agent_clj_from_text('TP53')]))
+        content.set('disease', agent_clj_from_text('breast cancer'))
+        msg = get_request(content)
+        return msg, content
+
+    def check_response_to_message_failure(self, output):
+        assert output.head() == 'FAILURE', output
+        reason = output.gets('reason')
+        assert reason == "INVALID_ARGUMENT"
+
+
 class TestMutSig(_IntegrationTest):
     def __init__(self, *args):
         super(TestMutSig, self).__init__(CausalityModule)
@@ -518,3 +1143,307 @@ class TestGeneSummary(_IntegrationTest):
         assert output.head() == 'SUCCESS', output
         components = output.get('geneSummary')
         assert 'AKT1' in components.data
+
+
+def test_request_profiler():
+    # Statements are only timed when the profiler is enabled
+    assert type(ca.cadb) is sqlite3.Connection
+
+    with tempfile.TemporaryDirectory() as path:
+        profiler = RequestProfiler(['FIND-MUTEX'], directory=path, keep=2)
+        assert profiler.should_profile('find-mutex') and not profiler.should_profile('FIND-MUTSIG')
+
+        cadb = sqlite3.connect(':memory:', factory=TimedConnection)
+        cadb.execute("CREATE TABLE Numbers(N INTEGER)")
+        for i in range(3):
+            with profiler.profile('FIND-MUTEX', 'request %d' % i):
+                cur = cadb.cursor()
+                cur.executemany("INSERT INTO Numbers VALUES(?)", [(n,) for n in range(10)])
+                assert sum(n for n, in cur.execute("SELECT N FROM Numbers")) == 45 * (i + 1)
+
+        # The oldest profile is removed, the newest lists its statements
+        names = sorted(os.listdir(path))
+        assert len(names) == 4 and [name.endswith('.prof') for name in names] == [True, False, True, False]
+        with open(os.path.join(path, names[-1])) as report:
+            report_str = report.read()
+        assert 'content: request 2' in report_str and 'SQL statements: 2' in report_str
+        assert 'INSERT INTO Numbers VALUES(?)  executemany' in report_str
+        assert 'SELECT N FROM Numbers' in report_str
+        cadb.close()
+
+
+class _ReplayModule:
+    """Answers replayed requests like CausalityModule in testing mode, failing FIND-MUTEX"""
+
+    def __init__(self):
+        self.received = []
+        self._lock = threading.Lock()
+
+    def receive_request(self, msg, content):
+        with self._lock:
+            self.received.append(content.to_string())
+        reply = KQMLList('FAILURE' if content.head() == 'FIND-MUTEX' else 'SUCCESS')
+        return msg, reply
+
+
+def test_record_and_replay():
+    contents = [KQMLList.from_string('(FIND-MUTSIG :gene "TP53" :disease "OV")'),
+                KQMLList.from_string('(FIND-MUTEX :gene "TP53" :disease "BRCA")'),
+                KQMLList.from_string('(FIND-MUTSIG :gene "AKT1" :disease "OV")')]
+    with tempfile.TemporaryDirectory() as path:
+        recorder = RequestRecorder(os.path.join(path, 'requests.jsonl'))
+        for content in contents:
+            recorder.record(content)
+        recording = load_recording(recorder.path)
+    assert recording == [content.to_string() for content in contents]
+
+    module = _ReplayModule()
+    results, elapsed = replay(module, recording * 2, concurrency=2)
+    assert sorted(module.received) == sorted(recording * 2)
+    assert [(task, succeeded) for task, _, succeeded in results] == \
+           [('FIND-MUTSIG', True), ('FIND-MUTEX', False), ('FIND-MUTSIG', True)] * 2
+
+    summary = summarize(results, elapsed)
+    assert summary['requests'] == 6
+    assert summary['tasks']['FIND-MUTSIG']['count'] == 4 and summary['tasks']['FIND-MUTSIG']['failures'] == 0
+    assert summary['tasks']['FIND-MUTEX']['count'] == 2 and summary['tasks']['FIND-MUTEX']['failures'] == 2
+    assert summary['tasks']['FIND-MUTEX']['max'] == max(latency for task, latency, _ in results
+                                                        if task == 'FIND-MUTEX') * 1000
+    assert [percentile(list(range(1, 101)), q) for q in (50, 95, 99, 100)] == [50, 95, 99, 100]
+
+
+def _dispatch(submit, handles):
+    """Submits the handles and returns their replies in delivery order"""
+    replies = []
+    delivered = threading.Event()
+
+    def deliver(reply):
+        replies.append(reply)
+        if len(replies) == len(handles):
+            delivered.set()
+
+    for handle in handles:
+        submit(handle, deliver)
+    assert delivered.wait(10)
+    return replies
+
+
+def _slow_reply():
+    time.sleep(0.3)
+    return 'SLOW'
+
+
+def _failing_reply():
+    raise ValueError('handler failed')
+
+
+def test_lane_keeps_request_order():
+    lane = Lane('test', 2)
+    replies = _dispatch(lambda handle, deliver: lane.submit(handle, deliver),
+                        [_slow_reply, lambda: 'FAST'])
+    lane.shutdown()
+    assert replies == ['SLOW', 'FAST']
+
+
+def test_lane_replies_to_failed_request():
+    lane = Lane('test', 2)
+    replies = _dispatch(lambda handle, deliver: lane.submit(handle, deliver, on_error=lambda: 'INTERNAL_FAILURE'),
+                        [_failing_reply, lambda: 'FAST'])
+    lane.shutdown()
+    assert replies == ['INTERNAL_FAILURE', 'FAST']
+
+
+def test_lane_delivers_outside_lock():
+    lane = Lane('test', 2)
+    replies = []
+    sending = threading.Event()
+    sent = threading.Event()
+    later_ran = threading.Event()
+
+    def blocked_deliver(reply):
+        sending.set()
+        sent.wait(10)
+        replies.append(reply)
+
+    lane.submit(lambda: 'BLOCKED', blocked_deliver)
+    assert sending.wait(10)
+    # A worker stuck sending the first reply leaves the lane and the other worker free
+    start = time.time()
+    lane.submit(lambda: 'SECOND', replies.append)
+    lane.submit(lambda: later_ran.set() or 'THIRD', replies.append)
+    assert later_ran.wait(1) and time.time() - start < 1
+    sent.set()
+    lane.shutdown()
+    assert replies == ['BLOCKED', 'SECOND', 'THIRD']
+
+
+def test_dispatcher_replies_past_deadline():
+    dispatcher = RequestDispatcher({'bulk': 2}, {'SLOW': 'bulk'}, 'bulk', {'SLOW': 0.1})
+    start = time.time()
+    replies = _dispatch(lambda handle, deliver: dispatcher.submit('SLOW' if handle is _slow_reply else 'FAST',
+                                                                  handle, deliver, lambda: 'TIMEOUT'),
+                        [_slow_reply, lambda: 'FAST'])
+    assert time.time() - start < 0.3
+    dispatcher.shutdown()
+    assert replies == ['TIMEOUT', 'FAST']
+
+
+def _post(connection, path, params):
+    connection.request('POST', path, json.dumps(params), {'Content-Type': 'application/json'})
+    response = connection.getresponse()
+    return response, json.loads(response.read().decode('utf-8'))
+
+
+def test_http_server():
+    server = CausalityHttpServer(ca, workers=2)
+    loop = asyncio.new_event_loop()
+    listening = threading.Event()
+    sockets = []
+
+    def serve():
+        asyncio.set_event_loop(loop)
+        listener = loop.run_until_complete(asyncio.start_server(server.handle_connection, '127.0.0.1', 0))
+        sockets.extend(listener.sockets)
+        listening.set()
+        loop.run_forever()
+
+    threading.Thread(target=serve, daemon=True).start()
+    assert listening.wait(10)
+    try:
+        connection = http.client.HTTPConnection('127.0.0.1', sockets[0].getsockname()[1], timeout=10)
+
+        response, payload = _post(connection, '/correlations', {'gene': 'AKT1', 'limit': 3, 'max_p': 0.05})
+        assert response.status == 200
+        assert payload['result'] == ca.find_top_correlations('AKT1', 3, 0.05)
+        assert response.getheader('Server-Timing').startswith('query;dur=')
+        assert response.getheader('X-Response-Time').endswith('ms')
+
+        # Stateless, the same request gives the same correlations
+        assert _post(connection, '/correlations', {'gene': 'AKT1', 'limit': 3, 'max_p': 0.05})[1] == payload
+
+        response, payload = _post(connection, '/common_upstreams', {'genes': ['AKT1', 'BRAF']})
+        assert response.status == 200
+        assert payload['result'] == ca.find_common_upstreams(['AKT1', 'BRAF'])
+
+        response, payload = _post(connection, '/correlations', {})
+        assert response.status == 400
+        assert payload['error'] == 'Missing argument gene'
+        response, payload = _post(connection, '/unknown', {})
+        assert response.status == 404
+
+        # A bug inside a query is a server error, not a missing argument
+        correlations = queries['correlations']
+        queries['correlations'] = lambda ca, q: {}['bug']
+        try:
+            response, payload = _post(connection, '/correlations', {'gene': 'AKT1'})
+            assert response.status == 500
+        finally:
+            queries['correlations'] = correlations
+
+        # The unread body of a too large request ends the connection
+        server.max_body = 10
+        response, payload = _post(connection, '/correlations', {'gene': 'AKT1', 'limit': 3})
+        assert response.status == 413
+        assert response.getheader('Connection') == 'close'
+        connection.close()
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        server.executor.shutdown()
+
+
+class _ReadCounter:
+    """Input lines that count how many were read"""
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.read = 0
+
+    def __iter__(self):
+        for line in self.lines:
+            self.read += 1
+            yield line
+
+
+class _WriteLog:
+    """Output file that notes how many input lines were read before each result"""
+
+    def __init__(self, input_file):
+        self.input_file = input_file
+        self.lines = []
+        self.read_before = []
+
+    def write(self, data):
+        self.lines.append(data)
+        self.read_before.append(self.input_file.read)
+
+
+def test_batch_keeps_input_order():
+    lines = [json.dumps({'query': 'mutsig', 'gene': gene, 'disease': 'OV'})
+             for gene in ['TP53', 'AKT1', 'BRAF', 'MAPK1', 'EGFR', 'KRAS', 'PTEN', 'JUND', 'CREB1']]
+    lines[4] = json.dumps({'query': 'mutsig', 'gene': 'EGFR'})
+    lines[6] = '{not json'
+    input_file = _ReadCounter(lines)
+    output_file = _WriteLog(input_file)
+
+    assert run_batch(input_file, output_file, _resource_dir, processes=2, chunk_size=2, max_pending=2, log=None) == 9
+
+    results = [json.loads(line) for line in output_file.lines]
+    assert [result.get('query', result.get('input')) for result in results] == \
+           [json.loads(line) for line in lines[:6]] + [lines[6]] + [json.loads(line) for line in lines[7:]]
+    assert results[0]['result'] == ca.find_mutation_significance('TP53', 'OV')
+    assert results[4]['error'] == 'Missing argument disease' and 'error' in results[6]
+    # At most max_pending chunks are read ahead of the one being written
+    assert all(read <= (i // 2 + 2) * 2 for i, read in enumerate(output_file.read_before))
+
+
+class TestPerformanceStats(_IntegrationTest):
+    def __init__(self, *args):
+        super(TestPerformanceStats, self).__init__(CausalityModule)
+
+    def create_message_01_mutsig(self):
+        content = KQMLList('FIND-MUTATION-SIGNIFICANCE')
+        gene = agent_clj_from_text('TP53')
+        disease = agent_clj_from_text('Ovarian serous cystadenocarcinoma')
+        content.set('gene', gene)
+        content.set('disease', disease)
+        msg = get_request(content)
+        return msg, content
+
+    def check_response_to_message_01_mutsig(self, output):
+        assert output.head() == 'SUCCESS', output
+
+    def create_message_02_stats(self):
+        content = KQMLList('GET-PERFORMANCE-STATS')
+        msg = get_request(content)
+        return msg, content
+
+    def check_response_to_message_02_stats(self, output):
+        assert output.head() == 'SUCCESS', output
+        tasks = output.get('tasks')
+        task_names = list(map(lambda t: t.gets('task'), tasks))
+        assert 'FIND-MUTATION-SIGNIFICANCE' in task_names
+        mutsig = tasks[task_names.index('FIND-MUTATION-SIGNIFICANCE')]
+        assert int(mutsig.gets('count')) >= 1
+        phases = list(map(lambda p: p.gets('phase'), mutsig.get('phases')))
+        assert 'query' in phases
+
+
+class TestClassifyCorrelations(_IntegrationTest):
+    def __init__(self, *args):
+        super(TestClassifyCorrelations, self).__init__(CausalityModule)
+
+    def create_message(self):
+        content = KQMLList('CLASSIFY-CORRELATIONS')
+        pairs = KQMLList.from_string('((MAPK3 T202 JUND S100S) (AKT1 S473S BRAF NIL))')
+        content.set('pairs', pairs)
+        msg = get_request(content)
+        return msg, content
+
+    def check_response_to_message(self, output):
+        assert output.head() == 'SUCCESS', output
+        classifications = output.get('classifications')
+        assert len(classifications) == 2
+        assert classifications[0].gets('explainable') == 'explainable'
+        assert 'phosphorylates' in [rel.string_value() for rel in classifications[0].get('rel')]
+        assert classifications[1].gets('explainable') == 'unexplainable'
+        assert output.gets('explained') == '1'